@@ -0,0 +1,941 @@
+# Import necessary libraries
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+import requests
+
+import cleaning
+import data_stream
+import live_prices
+import price_history
+import price_stream
+import price_table
+import publisher
+import replay
+import station_index
+import station_search
+import topics
+import wire_format
+
+# Constants
+FUEL_TYPES = ['DL', 'E10', 'P95', 'P98', 'U91', 'PDL', 'EV', 'LPG', 'E85', 'B20']
+BRANDS = ["7-Eleven", "Ampol", "BP", "Caltex", "Coles Express", "EG Ampol", "Metro Fuel", "Mobil", "Shell", "United", "Independent"]
+BENCH_MQTT_HOST = os.environ.get("BENCH_MQTT_HOST", "127.0.0.1") # Local broker (e.g. mosquitto) used by the publish benchmark
+BENCH_MQTT_PORT = int(os.environ.get("BENCH_MQTT_PORT", "1883"))
+TOWN_CENTERS = [(-33.87, 151.21), (-32.93, 151.78), (-34.42, 150.89), (-30.30, 153.11), (-32.25, 148.60), (-35.11, 147.37), (-33.28, 149.10)] # Sydney, Newcastle, Wollongong, Coffs Harbour, Dubbo, Wagga Wagga, Orange
+SUBURBS = ["Coffs Harbour", "Parramatta", "Newcastle", "Wollongong", "Dubbo", "Wagga Wagga", "Orange", "Bathurst", "Tamworth", "Albury"]
+
+
+#   Synthetic Data Generators
+def make_price_payload(n_prices, fuels_per_station=4, seed=0):
+    '''
+    Builds a synthetic "/prices" JSON payload shaped like the NSW FuelCheck API response, with n_prices price entries spread over n_prices / fuels_per_station stations.
+    '''
+    rng = random.Random(seed)
+    n_stations = max(1, n_prices // fuels_per_station)
+
+    stations = []
+    for code in range(n_stations):
+        suburb = rng.choice(SUBURBS)
+        stations.append({
+            "brandid": "",
+            "stationid": "",
+            "brand": rng.choice(BRANDS),
+            "code": str(code),
+            "name": f"Station {code} {suburb}",
+            "address": f"{rng.randint(1, 999)} Pacific Hwy, {suburb} NSW {rng.randint(2000, 2999)}",
+            "location": {"latitude": rng.uniform(-37.5, -28.2), "longitude": rng.uniform(141.0, 153.6)},
+            "state": "NSW"
+        })
+
+    prices = []
+    for i in range(n_prices):
+        prices.append({
+            "stationcode": str(i % n_stations),
+            "state": "NSW",
+            "fueltype": FUEL_TYPES[(i // n_stations) % len(FUEL_TYPES)],
+            "price": round(rng.uniform(150, 230), 1),
+            "lastupdated": f"{rng.randint(1, 28):02d}/05/2025 {rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:00"
+        })
+
+    return {"stations": stations, "prices": prices}
+
+
+def make_dirty_fuel_data(n_prices, dirty_share=0.02, repeat_share=0.1, seed=0):
+    '''
+    Normalized price rows with the defects the cleaning stage handles: missing names, unparseable and negative prices, bad coordinates and timestamps, lower-case fuel codes, and repeated station-fuel rows whose prices and timestamps differ (as when an earlier poll overlaps a later one).
+    '''
+    rng = np.random.default_rng(seed)
+    df = data_stream.normalize_fuel_data(make_price_payload(n_prices, seed=seed))
+    repeats = df.sample(frac=repeat_share, random_state=seed)
+    repeats = repeats.assign(Price=repeats["Price"] + rng.integers(-5, 6, len(repeats)), PriceUpdatedDate=[f"{day:02d}/05/2025 12:00:00" for day in rng.integers(1, 29, len(repeats))])
+    df = pd.concat([df, repeats], ignore_index=True)
+    df["Price"] = df["Price"].astype(object)
+
+    def pick():
+        return rng.random(len(df)) < dirty_share
+
+    df.loc[pick(), "ServiceStationName"] = None
+    df.loc[pick(), "Price"] = "n/a"
+    df.loc[pick(), "Price"] = -1.0
+    df.loc[pick(), "PriceUpdatedDate"] = "not a date"
+    df.loc[pick(), "Latitude"] = 123.0
+    df.loc[pick(), "Suburb"] = None
+    lower = pick()
+    df.loc[lower, "FuelCode"] = df.loc[lower, "FuelCode"].str.lower()
+    return df
+
+
+def make_station_coordinates(n_stations, seed=0):
+    # Station positions concentrated around NSW towns (half of them around Sydney), the rest spread over the state
+    rng = np.random.default_rng(seed)
+    n_spread = n_stations // 5
+    towns = rng.choice(len(TOWN_CENTERS), size=n_stations - n_spread, p=[0.5] + [0.5 / (len(TOWN_CENTERS) - 1)] * (len(TOWN_CENTERS) - 1))
+    centers = np.array(TOWN_CENTERS)[towns]
+    lat = np.concatenate([centers[:, 0] + rng.normal(0, 0.15, len(towns)), rng.uniform(-37.5, -28.2, n_spread)])
+    lon = np.concatenate([centers[:, 1] + rng.normal(0, 0.15, len(towns)), rng.uniform(141.0, 153.6, n_spread)])
+    return lat, lon
+
+
+def make_history_polls(day, n_stations, changes_per_poll, polls_per_day=1440, seed=0):
+    '''
+    Cleaned price rows for one day of 60-second polls: each poll reports changes_per_poll price changes at random stations, as the "/prices/new" endpoint would. Stations keep a fixed suburb/postcode (one of n_stations // 6 areas) and fuel; prices follow a random walk per station.
+    '''
+    rng = np.random.default_rng(seed + day.toordinal())
+    n = polls_per_day * changes_per_poll
+    stations = rng.integers(0, n_stations, n)
+    area = stations % max(1, n_stations // 6)
+    seconds = np.repeat(np.arange(polls_per_day) * 60, changes_per_poll) + rng.integers(0, 60, n)
+    return pd.DataFrame({
+        "StationCode": stations.astype(str),
+        "FuelCode": np.array(FUEL_TYPES)[stations % len(FUEL_TYPES)],
+        "Price": np.round(170 + 20 * np.sin(day.toordinal() / 30 + stations) + rng.normal(0, 2, n), 1),
+        "PriceUpdatedDate": (pd.Timestamp(day) + pd.to_timedelta(seconds, unit="s")).strftime(wire_format.PRICE_DATE_FORMAT),
+        "Suburb": np.array([f"Suburb {a}" for a in range(max(1, n_stations // 6))])[area],
+        "Postcode": (2000 + area).astype(str),
+    })
+
+
+#   Reference Implementations
+def legacy_normalize_fuel_data(data):
+    # Per-row dict building used by data_stream before the columnar normalization stage
+    station_map = {
+        station["code"]: {
+            "ServiceStationName": station.get("name"),
+            "Address": station.get("address"),
+            "Brand": station.get("brand"),
+            "Latitude": station.get("location", {}).get("latitude"),
+            "Longitude": station.get("location", {}).get("longitude")
+        }
+        for station in data.get("stations", [])
+    }
+
+    combined_data = []
+    for price_entry in data.get("prices", []):
+        station_code = price_entry.get("stationcode")
+        station_info = station_map.get(station_code)
+
+        if station_info:
+            full_address = station_info["Address"]
+            try:
+                parts = full_address.split(", ")
+                suburb_postcode = parts[-1].rsplit(" ", 2)
+                suburb = suburb_postcode[0]
+                postcode = suburb_postcode[-1]
+            except Exception:
+                suburb, postcode = None, None
+
+            combined_data.append({
+                "ServiceStationName": station_info["ServiceStationName"],
+                "Address": full_address,
+                "Suburb": suburb,
+                "Postcode": postcode,
+                "Brand": station_info["Brand"],
+                "FuelCode": price_entry.get("fueltype"),
+                "Price": price_entry.get("price"),
+                "PriceUpdatedDate": price_entry.get("lastupdated"),
+                "Latitude": station_info["Latitude"],
+                "Longitude": station_info["Longitude"]
+            })
+
+    return pd.DataFrame(combined_data)
+
+
+def legacy_encode_messages(df):
+    # One json.dumps per row of a hand-built dict, as publish_data did before the compact wire format
+    messages = []
+    for row in df.itertuples():
+        data = {
+            "Index": row.Index,
+            "ServiceStationName": row.ServiceStationName,
+            "Address": row.Address,
+            "Suburb": row.Suburb,
+            "Postcode": row.Postcode,
+            "Brand": row.Brand,
+            "FuelCode": row.FuelCode,
+            "Price": row.Price,
+            "PriceUpdatedDate": row.PriceUpdatedDate,
+            "Latitude": row.Latitude,
+            "Longitude": row.Longitude
+        }
+        messages.append(json.dumps(data).encode("utf-8"))
+    return messages
+
+
+def legacy_clean_fuel_data(df):
+    # Step-by-step cleaning data_stream used before the schema-driven cleaning stage; duplicates keep the first row seen
+    df = df.dropna(subset=["ServiceStationName", "FuelCode", "PriceUpdatedDate", "Latitude", "Longitude", "Price"])
+    df["Suburb"].fillna("Unknown", inplace=True)
+    df["Postcode"].fillna("Unknown", inplace=True)
+    df["FuelCode"] = df["FuelCode"].astype("category")
+    df["Brand"] = df["Brand"].astype("category")
+    df["Latitude"] = pd.to_numeric(df["Latitude"], errors='coerce')
+    df["Longitude"] = pd.to_numeric(df["Longitude"], errors='coerce')
+    df["Price"] = pd.to_numeric(df["Price"], errors='coerce')
+    df = df[
+        (df["Price"] >= 0) &
+        (df["Latitude"].between(-90, 90)) &
+        (df["Longitude"].between(-180, 180))
+    ]
+    df = df.drop_duplicates(subset=["ServiceStationName", "FuelCode", "Latitude", "Longitude"], keep="first")
+    df["Brand"] = df["Brand"].str.title()
+    df["Suburb"] = df["Suburb"].str.title()
+    df["FuelCode"] = df["FuelCode"].str.upper()
+    return df
+
+
+def legacy_poll_new_prices(url_base):
+    # How FuelPriceCheckAPI polled before the token cache and shared session: a fresh token and a fresh connection per request (its fixed 5 s sleep left out)
+    token = requests.get(url_base + replay.TOKEN_PATH, headers={"Authorization": "Basic stub"}, params={"grant_type": "client_credentials"}).json()["access_token"]
+    return requests.get(url_base + replay.NEW_PRICES_PATH, headers={"Authorization": f"Bearer {token}", "apikey": "legacy"})
+
+
+#   Benchmark Helpers
+class LegacyStation:
+    # Per-station object model the dashboard used before the columnar price table
+    def __init__(self, service_station_name, address, brand, latitude, longitude):
+        self.service_station_name = service_station_name
+        self.address = address
+        self.brand = brand
+        self.latitude = latitude
+        self.longitude = longitude
+        self.fuelprice = {}
+
+
+class LegacyFuelprice:
+    def __init__(self, fuelcode, price, price_updated_date):
+        self.fuelcode = fuelcode
+        self.price = price
+        self.price_updated_date = price_updated_date
+
+
+def legacy_build_stations(records):
+    stations = {}
+    for data in records:
+        station_key = data["ServiceStationName"] + data["Address"]
+        if station_key not in stations:
+            stations[station_key] = LegacyStation(data["ServiceStationName"], data["Address"], data["Brand"], data["Latitude"], data["Longitude"])
+        stations[station_key].fuelprice[data["FuelCode"]] = LegacyFuelprice(data["FuelCode"], data["Price"], data["PriceUpdatedDate"])
+    return stations
+
+
+def time_call(func, *args, repeat=3, **kwargs):
+    # Best-of-N wall time in seconds, plus the result of the last call
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def report(name, seconds, baseline=None):
+    speedup = f"  ({baseline / seconds:.1f}x)" if baseline else ""
+    print(f"{name:<40}{seconds * 1000:>10.1f} ms{speedup}")
+
+
+#   Benchmarks
+def bench_api(n_polls=60, poll_interval=0.1, token_lifetime=2.0):
+    print(f"{n_polls} /prices/new polls {poll_interval:g} s apart against the replay stub, tokens valid for {token_lifetime:g} s")
+    stub = replay.StubFuelCheckAPI(replay.synthetic_feed(n_stations=200), speedup=60.0, token_expires_in=token_lifetime).start()
+
+    def run(poll):
+        # (wall seconds, seconds spent in requests, token requests, TCP connections) of n_polls polls
+        tokens, connections = stub.requests[replay.TOKEN_PATH], stub.connections
+        start = time.perf_counter()
+        requesting = 0.0
+        for _ in range(n_polls):
+            request_start = time.perf_counter()
+            poll().raise_for_status()
+            requesting += time.perf_counter() - request_start
+            time.sleep(poll_interval)
+        return time.perf_counter() - start, requesting, stub.requests[replay.TOKEN_PATH] - tokens, stub.connections - connections
+
+    def cached(refresh_margin):
+        api = data_stream.FuelPriceCheckAPI("bench", "Basic stub", url_base=stub.url)
+        api.token_manager.refresh_margin = refresh_margin
+        try:
+            return run(lambda: api.getNewFuelPrice())
+        finally:
+            api.close()
+
+    try:
+        rows = [
+            ("legacy token + connection per request", run(lambda: legacy_poll_new_prices(stub.url))),
+            ("cached token, refreshed on expiry", cached(0.0)),
+            ("cached token, refreshed early", cached(token_lifetime / 2)),
+        ]
+    finally:
+        stub.stop()
+
+    for name, (_, requesting, tokens, connections) in rows:
+        print(f"{name:<40}{tokens:>6} token calls{connections:>6} TCP connections{requesting / n_polls * 1000:>8.2f} ms/poll")
+    (elapsed, _, tokens, connections), (early_elapsed, _, early_tokens, early_connections) = rows[1][1], rows[2][1]
+    # One token per lifetime (per half lifetime when refreshing early) and one keep-alive connection, plus one for the early refresher's own session
+    assert tokens <= elapsed // token_lifetime + 1 and connections == 1, rows[1]
+    assert early_tokens <= early_elapsed // (token_lifetime / 2) + 1 and early_connections <= 2, rows[2]
+
+
+def bench_normalize(n_prices=100_000):
+    print(f"Normalization of a synthetic {n_prices:,}-price payload")
+    payload = make_price_payload(n_prices)
+
+    legacy_s, legacy_df = time_call(legacy_normalize_fuel_data, payload)
+    columnar_s, columnar_df = time_call(data_stream.normalize_fuel_data, payload)
+
+    assert len(legacy_df) == len(columnar_df)
+    report("legacy per-row loop", legacy_s)
+    report("columnar merge + str.extract", columnar_s, legacy_s)
+
+
+def bench_clean(n_prices=200_000):
+    print(f"Cleaning {n_prices:,} normalized prices plus repeats and defects: step-by-step vs schema-driven")
+    df = make_dirty_fuel_data(n_prices)
+
+    def peak_bytes(func):
+        tracemalloc.start()
+        func(df)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore") # The legacy path warns about chained inplace fillna
+        legacy_s, legacy_df = time_call(legacy_clean_fuel_data, df, repeat=5)
+        legacy_peak = peak_bytes(legacy_clean_fuel_data)
+    schema_s, (schema_df, rejected) = time_call(cleaning.clean_fuel_data, df, repeat=5)
+    schema_peak = peak_bytes(cleaning.clean_fuel_data)
+
+    report("legacy dropna/filter/drop_duplicates", legacy_s)
+    report("schema-driven single pass", schema_s, legacy_s)
+    print(f"peak allocations: legacy {legacy_peak / 2**20:.1f} MiB, schema-driven {schema_peak / 2**20:.1f} MiB")
+    print(f"result size: legacy {legacy_df.memory_usage(deep=True).sum() / 2**20:.1f} MiB, schema-driven {schema_df.memory_usage(deep=True).sum() / 2**20:.1f} MiB")
+    print(f"rows kept: legacy {len(legacy_df):,}, schema-driven {len(schema_df):,} of {len(df):,}")
+    print("rejected: " + ", ".join(f"{rule} {count:,}" for rule, count in rejected.items()))
+    # Keep-first dedupe can keep an older repeat, which the latest-wins dedupe replaces with the newer row
+    print(f"duplicates where keep-first kept an older price: {len(schema_df.index.difference(legacy_df.index)):,}")
+
+
+def bench_publish(n_prices=10_000):
+    print(f"Publishing {n_prices:,} records to {BENCH_MQTT_HOST}:{BENCH_MQTT_PORT}")
+    try:
+        socket.create_connection((BENCH_MQTT_HOST, BENCH_MQTT_PORT), timeout=2).close()
+    except OSError:
+        print("No broker reachable, skipped (set BENCH_MQTT_HOST / BENCH_MQTT_PORT)")
+        return
+
+    df = data_stream.normalize_fuel_data(make_price_payload(n_prices))
+    configurations = [
+        ("QoS 2, 0.1 s fixed delay (first 200)", 2, 1, publisher.PacingPolicy.fixed_delay(0.1), df.head(200)),
+        ("QoS 2, unthrottled", 2, 1, publisher.PacingPolicy.unthrottled(), df),
+        ("QoS 1, unthrottled", 1, 1, publisher.PacingPolicy.unthrottled(), df),
+        ("QoS 0, unthrottled", 0, 1, publisher.PacingPolicy.unthrottled(), df),
+        ("QoS 1, batches of 100", 1, 100, publisher.PacingPolicy.unthrottled(), df),
+    ]
+    for name, qos, batch_size, pacing, frame in configurations:
+        with publisher.FuelPricePublisher(host=BENCH_MQTT_HOST, port=BENCH_MQTT_PORT, topic="bench/FuelPrice", qos=qos, pacing=pacing, batch_size=batch_size) as pub:
+            result = pub.publish_dataframe(frame)
+        print(f"{name:<40}{result['records_per_sec']:>10.0f} records/s{result['messages_per_sec']:>10.0f} msg/s"
+              f"   ack p50 {result['ack_latency_ms_p50']:.2f} ms  p95 {result['ack_latency_ms_p95']:.2f} ms")
+
+
+def bench_wire(n_prices=10_000):
+    print(f"Wire format for {n_prices:,} price records")
+    df = data_stream.normalize_fuel_data(make_price_payload(n_prices))
+    stations = df.drop_duplicates(subset="StationCode").to_dict("records")
+
+    legacy_s, legacy_messages = time_call(legacy_encode_messages, df)
+    binary_s, binary_messages = time_call(wire_format.encode_price_messages, df)
+    batched_s, batched_messages = time_call(wire_format.encode_price_messages, df, 500)
+    station_messages = [wire_format.encode_station(station) for station in stations]
+
+    legacy_bytes = sum(map(len, legacy_messages))
+    binary_bytes = sum(map(len, binary_messages))
+    station_bytes = sum(map(len, station_messages))
+    print(f"{'legacy JSON per record':<40}{legacy_bytes / len(df):>10.1f} B/record")
+    print(f"{'binary price message per record':<40}{binary_bytes / len(df):>10.1f} B/record  (+ {station_bytes / len(stations):.1f} B once per station, retained)")
+    print(f"{'binary, batches of 500':<40}{sum(map(len, batched_messages)) / len(df):>10.1f} B/record")
+
+    report("encode: legacy json.dumps per row", legacy_s)
+    report("encode: binary, one record/message", binary_s, legacy_s)
+    report("encode: binary, batches of 500", batched_s, legacy_s)
+
+    def decode_legacy():
+        return [json.loads(message) for message in legacy_messages]
+
+    def decode_binary(messages):
+        decoder = wire_format.WireDecoder()
+        for message in station_messages:
+            decoder.decode(message)
+        return [record for message in messages for record in decoder.decode(message)]
+
+    legacy_s, legacy_records = time_call(decode_legacy)
+    binary_s, binary_records = time_call(decode_binary, binary_messages)
+    batched_s, batched_records = time_call(decode_binary, batched_messages)
+    assert len(legacy_records) == len(binary_records) == len(batched_records)
+    report("decode: legacy json.loads", legacy_s)
+    report("decode: binary, one record/message", binary_s, legacy_s)
+    report("decode: binary, batches of 500", batched_s, legacy_s)
+
+
+def bench_viewport(n_stations=50_000):
+    print(f"Viewport selection and clustering per rerun (2,500 and {n_stations:,} stations)")
+    viewports = {
+        "CBD z15": ((-33.8688, 151.2093), 15),
+        "Sydney z12": ((-33.8688, 151.2093), 12),
+        "NSW z7": ((-32.5, 147.5), 7),
+    }
+    for size in sorted({2_500, n_stations}):
+        lat, lon = make_station_coordinates(size)
+        prices = np.round(np.random.default_rng(1).uniform(150, 230, size), 1)
+
+        build_s, index = time_call(station_index.GridIndex, lat, lon)
+        report(f"{size:,}: build grid index", build_s)
+
+        for name, (center, zoom) in viewports.items():
+            bounds = station_index.viewport_bounds(center, zoom, 1200, 600)
+
+            def select_markers():
+                # Marker positions the dashboard sends to the browser for this viewport
+                in_view = index.query_bbox(*bounds)
+                if station_index.needs_clustering(zoom, len(in_view)):
+                    clusters = station_index.cluster_points(lat[in_view], lon[in_view], prices[in_view], station_index.cluster_cell_deg(zoom))
+                    return clusters["lat"]
+                return in_view
+
+            select_s, markers = time_call(select_markers)
+            # Before the index every station was sent on every rerun, whatever the viewport
+            report(f"{size:,}: {name}, {len(markers):,}/{size:,} markers", select_s)
+
+
+def bench_sessions(n_sessions=50, n_prices=10_000, update_rounds=5):
+    print(f"{n_sessions} concurrent dashboard sessions, {n_prices:,}-record snapshot then {update_rounds} rounds of updates")
+    df = data_stream.normalize_fuel_data(make_price_payload(n_prices))
+    stations = df.drop_duplicates(subset="StationCode").to_dict("records")
+    snapshot_messages = [wire_format.encode_station(station) for station in stations] + wire_format.encode_price_messages(df)
+    rounds = [snapshot_messages]
+    for i in range(update_rounds):
+        updates = df.sample(n=max(1, n_prices // 20), random_state=i).assign(Price=lambda d: d["Price"] + 0.1 * (i + 1))
+        rounds.append(wire_format.encode_price_messages(updates))
+    bounds = station_index.viewport_bounds((-32.5, 147.5), 7, 1200, 600)
+
+    def render(shared):
+        # What each session's rerun reads: the latest snapshot, the selected fuel's prices and the stations in view
+        snapshot = shared.refresh()
+        return len(snapshot.table.select("E10", snapshot.index.query_bbox(*bounds)))
+
+    def per_session():
+        # Before: every session ran its own subscriber, decoder and station table
+        sessions = [(wire_format.WireDecoder(), live_prices.SharedPriceState()) for _ in range(n_sessions)]
+        for messages in rounds:
+            for message in messages:
+                for decoder, shared in sessions:
+                    shared.buffer.put(decoder.decode(message))
+            with ThreadPoolExecutor(max_workers=n_sessions) as pool:
+                drawn = list(pool.map(render, [shared for _, shared in sessions]))
+        return sessions, drawn
+
+    def shared_state():
+        # After: one subscriber and decoder feed one shared state that every session reads
+        decoder, shared = wire_format.WireDecoder(), live_prices.SharedPriceState()
+        for messages in rounds:
+            for message in messages:
+                shared.buffer.put(decoder.decode(message))
+            with ThreadPoolExecutor(max_workers=n_sessions) as pool:
+                drawn = list(pool.map(render, [shared] * n_sessions))
+        return (decoder, shared), drawn
+
+    results = {}
+    for name, func in [("per-session state", per_session), ("shared state", shared_state)]:
+        tracemalloc.start()
+        cpu_started, wall_started = time.process_time(), time.perf_counter()
+        state, drawn = func()
+        cpu_s, wall_s = time.process_time() - cpu_started, time.perf_counter() - wall_started
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del state
+        results[name] = (cpu_s, wall_s, retained, peak, drawn)
+
+    baseline_cpu = results["per-session state"][0]
+    for name, (cpu_s, wall_s, retained, peak, drawn) in results.items():
+        print(f"{name:<20} cpu {cpu_s:7.2f} s  wall {wall_s:7.2f} s  retained {retained / 2**20:7.1f} MiB  peak {peak / 2**20:7.1f} MiB  ({drawn[0]:,} stations per session)")
+    print(f"{'CPU reduction':<20} {baseline_cpu / results['shared state'][0]:.1f}x")
+
+
+def bench_price_table(n_stations=50_000, fuels_per_station=4):
+    print(f"Dashboard price state: per-station objects vs columnar price table (2,500 and {n_stations:,} stations)")
+    for size in sorted({2_500, n_stations}):
+        records = data_stream.normalize_fuel_data(make_price_payload(size * fuels_per_station, fuels_per_station)).to_dict("records")
+
+        price_table.PriceTable().apply(records, 1) # Warm the shared timestamp parse cache so it isn't counted below
+        tracemalloc.start()
+        legacy = legacy_build_stations(records)
+        legacy_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        tracemalloc.start()
+        table = price_table.PriceTable().apply(records, 1)
+        table_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print(f"{size:,}: memory, objects {legacy_bytes / 2**20:.1f} MiB, price table {table_bytes / 2**20:.1f} MiB ({legacy_bytes / table_bytes:.1f}x smaller)")
+
+        def legacy_select():
+            # Walk every station for the ones selling the fuel, then sort for the cheapest and bands
+            selected = [(station.fuelprice["E10"].price, key) for key, station in legacy.items() if "E10" in station.fuelprice and station.fuelprice["E10"].price is not None]
+            selected.sort()
+            cheapest = selected[:10]
+            thresholds = [selected[len(selected) // 3][0], selected[2 * len(selected) // 3][0]] if selected else []
+            bands = [sum(price > threshold for threshold in thresholds) for price, _ in selected]
+            return cheapest, bands
+
+        def table_select():
+            rows = table.select("E10")
+            return table.cheapest("E10", 10, rows), table.price_bands("E10", rows)
+
+        legacy_s, (legacy_cheapest, _) = time_call(legacy_select)
+        table_s, (table_cheapest, _) = time_call(table_select)
+        assert [price for price, _ in legacy_cheapest] == table.prices("E10")[table_cheapest].tolist()
+        report(f"{size:,}: select + cheapest 10 + bands, objects", legacy_s)
+        report(f"{size:,}: select + cheapest 10 + bands, table", table_s, legacy_s)
+
+
+def bench_history(days=365, n_stations=2_500, changes_per_poll=20):
+    print(f"Price history over {days} days of 60-second polls ({changes_per_poll} changes per poll, {n_stations:,} stations)")
+    history_dir = tempfile.mkdtemp(prefix="bench_history_")
+    try:
+        history = price_history.PriceHistory(history_dir)
+        start = pd.Timestamp("2025-01-01")
+
+        # One day through the per-poll path, as the pipeline appends it, then the rest of the year a day at a time
+        first_day = make_history_polls(start.date(), n_stations, changes_per_poll)
+        poll_times = []
+        for poll in range(1440):
+            t = time.perf_counter()
+            history.append(first_day.iloc[poll * changes_per_poll:(poll + 1) * changes_per_poll])
+            poll_times.append(time.perf_counter() - t)
+        t = time.perf_counter()
+        recorded = len(first_day)
+        for offset in range(1, days):
+            recorded += history.append(make_history_polls((start + pd.Timedelta(days=offset)).date(), n_stations, changes_per_poll))
+        bulk_s = time.perf_counter() - t
+        poll_times.sort()
+        print(f"append per poll: p50 {poll_times[len(poll_times) // 2] * 1000:.1f} ms, p95 {poll_times[int(len(poll_times) * 0.95)] * 1000:.1f} ms; "
+              f"remaining {days - 1} days in {bulk_s:.1f} s ({recorded:,} observations)")
+
+        end = start + pd.Timedelta(days=days)
+        last_month = [day for day in history.days() if day >= (end - pd.Timedelta(days=30)).strftime("%Y-%m-%d")]
+
+        def scan_sparkline():
+            # Baseline: read the raw partitions of the window and reduce them
+            raw = pd.concat([history.raw(day) for day in last_month])
+            raw = raw[(raw["station_code"] == "7") & (raw["fuel_code"] == FUEL_TYPES[7 % len(FUEL_TYPES)])]
+            return raw.groupby(raw["updated_at"] // 86400)["price"].last()
+
+        def scan_trend():
+            raw = pd.concat([history.raw(day) for day in last_month])
+            raw = raw[(raw["suburb"] == "Suburb 7") & (raw["fuel_code"] == FUEL_TYPES[7 % len(FUEL_TYPES)])]
+            return raw.groupby(raw["updated_at"] // 86400)["price"].agg(["min", "mean", "max"])
+
+        scan_spark_s, scanned = time_call(scan_sparkline)
+        spark_s, sparkline = time_call(history.station_sparklines, ["7"], FUEL_TYPES[7 % len(FUEL_TYPES)], 30, end)
+        assert sparkline["close"].tolist() == scanned.tolist()
+        report("30-day sparkline, raw scan", scan_spark_s)
+        report("30-day sparkline, rollup", spark_s, scan_spark_s)
+        report("30-day sparklines for 300 stations", time_call(history.station_sparklines, [str(code) for code in range(300)], None, 30, end)[0])
+
+        scan_trend_s, _ = time_call(scan_trend)
+        trend_s, _ = time_call(history.area_trend, FUEL_TYPES[7 % len(FUEL_TYPES)], "Suburb 7", None, end - pd.Timedelta(days=30), end, "day")
+        report("30-day suburb trend, raw scan", scan_trend_s)
+        report("30-day suburb trend, rollup", trend_s, scan_trend_s)
+        report("1-year suburb trend (daily), rollup", time_call(history.area_trend, FUEL_TYPES[7 % len(FUEL_TYPES)], "Suburb 7", None, start, end, "day")[0])
+        report("7-day postcode trend (hourly), rollup", time_call(history.area_trend, FUEL_TYPES[7 % len(FUEL_TYPES)], None, "2007", end - pd.Timedelta(days=7), end, "hour")[0])
+        report("1-year statewide trend (daily), rollup", time_call(history.area_trend, FUEL_TYPES[7 % len(FUEL_TYPES)], None, None, start, end, "day")[0])
+        history.close()
+        raw_bytes = sum(os.path.getsize(history.partition_path(day)) for day in history.days())
+        csv_bytes = len(history.raw(history.days()[0]).to_csv(index=False).encode()) * len(history.days())
+        rollup_bytes = os.path.getsize(os.path.join(history_dir, price_history.ROLLUP_DB_FILE)) # After close(), which folds the WAL into the database
+        print(f"storage: raw partitions {raw_bytes / 2**20:.1f} MiB (~{csv_bytes / 2**20:.0f} MiB as plain CSV), rollups {rollup_bytes / 2**20:.1f} MiB")
+    finally:
+        shutil.rmtree(history_dir, ignore_errors=True)
+
+
+def bench_search(n_stations=50_000, n_queries=1_000, radius_km=10.0, k=10):
+    print(f"Station search queries (10,000 and {n_stations:,} stations, {n_queries:,} queries, k={k}, radius {radius_km:g} km)")
+    for size in sorted({10_000, n_stations}):
+        records = data_stream.normalize_fuel_data(make_price_payload(size * 4, 4)).to_dict("records")
+        lat, lon = make_station_coordinates(size)
+        for record in records:
+            record["Latitude"], record["Longitude"] = lat[int(record["StationCode"])], lon[int(record["StationCode"])]
+        table = price_table.PriceTable().apply(records, 1)
+        table_lat, table_lon = table.latitude[:len(table)], table.longitude[:len(table)]
+
+        build_s, index = time_call(station_index.GridIndex, table_lat, table_lon)
+        extend_s, _ = time_call(station_index.GridIndex(table_lat[:-100], table_lon[:-100]).extend, table_lat[-100:], table_lon[-100:])
+        report(f"{size:,}: full index build", build_s)
+        report(f"{size:,}: add 100 stations incrementally", extend_s, build_s)
+
+        snapshot = live_prices.PriceSnapshot(1, table, index)
+        rng = np.random.default_rng(1)
+        queries = list(zip(*make_station_coordinates(n_queries, seed=1)))
+        queries = [(qlat + rng.normal(0, 0.01), qlon + rng.normal(0, 0.01)) for qlat, qlon in queries] # Near, not on, stations
+        prices = table.prices("E10")
+
+        def brute_nearest():
+            # Baseline: haversine to every station, then a partial sort
+            for qlat, qlon in queries:
+                distances = station_index.haversine_km(qlat, qlon, table_lat, table_lon)
+                np.sort(distances[np.argpartition(distances, k)[:k]])
+
+        def brute_cheapest():
+            results = []
+            for qlat, qlon in queries:
+                distances = station_index.haversine_km(qlat, qlon, table_lat, table_lon)
+                rows = np.flatnonzero((distances <= radius_km) & ~np.isnan(prices))
+                results.append(rows[np.lexsort((distances[rows], prices[rows]))[:k]].tolist())
+            return results
+
+        def indexed_nearest():
+            for qlat, qlon in queries:
+                index.query_nearest(qlat, qlon, k)
+
+        def indexed_radius():
+            for qlat, qlon in queries:
+                index.query_radius(qlat, qlon, radius_km)
+
+        def indexed_cheapest():
+            valid = table.valid[:len(table), wire_format.FUEL_CODE_IDS["E10"]]
+            results = []
+            for qlat, qlon in queries:
+                rows, distances = index.query_radius(qlat, qlon, radius_km, valid)
+                results.append(rows[np.lexsort((distances, prices[rows]))[:k]].tolist())
+            return results
+
+        def api_cheapest():
+            return [station_search.cheapest_within(snapshot, qlat, qlon, radius_km, "E10", k).index.tolist() for qlat, qlon in queries]
+
+        brute_nearest_s, _ = time_call(brute_nearest, repeat=1)
+        nearest_s, _ = time_call(indexed_nearest, repeat=1)
+        radius_s, _ = time_call(indexed_radius, repeat=1)
+        brute_cheapest_s, brute_results = time_call(brute_cheapest, repeat=1)
+        cheapest_s, indexed_results = time_call(indexed_cheapest, repeat=1)
+        api_s, api_results = time_call(api_cheapest, repeat=1)
+        assert brute_results == indexed_results == api_results
+        report(f"{size:,}: k-nearest, brute force", brute_nearest_s / n_queries)
+        report(f"{size:,}: k-nearest, grid", nearest_s / n_queries, brute_nearest_s / n_queries)
+        report(f"{size:,}: radius, grid", radius_s / n_queries)
+        report(f"{size:,}: cheapest E10, brute force", brute_cheapest_s / n_queries)
+        report(f"{size:,}: cheapest E10, grid", cheapest_s / n_queries, brute_cheapest_s / n_queries)
+        report(f"{size:,}: cheapest E10, API incl. frame", api_s / n_queries)
+
+
+def bench_replay(volumes=(1, 10, 100), duration=60.0, n_stations=3_000, poll_interval=1.0):
+    '''
+    End-to-end replay: synthesized price walks at 1x, 10x and 100x the estimated real NSW volume (replay.REAL_CHANGES_PER_MINUTE), served by the stub FuelCheck API with the simulated clock sped up by the same factor, through data_stream.main() in a child process and a local broker to a subscriber standing in for the dashboard. Latency runs from the moment a change becomes visible through the stub to its arrival at the subscriber, so it includes the wait for the next poll.
+    '''
+    print(f"Replay through the pipeline and {BENCH_MQTT_HOST}:{BENCH_MQTT_PORT}, {n_stations:,} stations, {duration:g} s per volume")
+    try:
+        socket.create_connection((BENCH_MQTT_HOST, BENCH_MQTT_PORT), timeout=2).close()
+    except OSError:
+        print("No broker reachable, skipped (set BENCH_MQTT_HOST / BENCH_MQTT_PORT)")
+        return
+
+    import paho.mqtt.client as mqtt
+
+    for volume in volumes:
+        # One real second of replay covers "volume" simulated seconds of real-volume changes
+        feed = replay.synthetic_feed(n_stations, days=(duration + 30) * volume / 86400, seed=volume)
+        stub = replay.StubFuelCheckAPI(feed, speedup=volume, paused=True).start()
+        decoder = wire_format.WireDecoder()
+        lock = threading.Lock()
+        snapshot_received, latencies, publish_latencies = [0], [], []
+
+        regions_topic = topics.regions_topic(publisher.MQTT_TOPIC)
+
+        def on_message(client, userdata, msg):
+            received = time.time()
+            # Like the dashboard, skip the region index and the empty retained messages that delete prices
+            if msg.topic == regions_topic or not msg.payload:
+                return
+            records = [record for record in decoder.decode(msg.payload) if record.get("FuelCode") and record.get("PriceUpdatedDate")]
+            if msg.retain: # Last values from earlier runs, replayed by the broker on subscribe
+                return
+            with lock:
+                for record in records:
+                    at = price_table.parse_timestamp(record["PriceUpdatedDate"])
+                    if at <= feed.start:
+                        snapshot_received[0] += 1
+                        continue
+                    latencies.append((at, received - stub.available_at(at)))
+                    if record.get("PublishedAt"):
+                        publish_latencies.append(received - record["PublishedAt"])
+
+        subscriber = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        subscriber.on_message = on_message
+        subscriber.connect(BENCH_MQTT_HOST, BENCH_MQTT_PORT, 60)
+        subscriber.subscribe(publisher.MQTT_TOPIC + "/#", qos=1)
+        subscriber.loop_start()
+
+        workdir = tempfile.mkdtemp(prefix="bench_replay_")
+        # Unthrottled so the initial snapshot doesn't dominate the run; 200 msg/s pacing is above even the 100x rate
+        process = replay.start_pipeline(stub.url, BENCH_MQTT_HOST, BENCH_MQTT_PORT, poll_interval, workdir, publish_rate=0)
+        try:
+            # Warm-up: the pipeline publishes the full snapshot before the simulated clock starts
+            deadline, last_count = time.time() + 120, -1
+            while time.time() < deadline and process.poll() is None and snapshot_received[0] < len(feed.initial):
+                time.sleep(2)
+                if snapshot_received[0] == last_count and last_count > 0: # Stalled after the pipeline started publishing
+                    break
+                last_count = snapshot_received[0]
+            print(f"{volume:>4}x: snapshot of {snapshot_received[0]:,}/{len(feed.initial):,} prices published, replaying")
+
+            stub.start_clock()
+            time.sleep(duration)
+            measured_until = stub.sim_now()
+            time.sleep(poll_interval + 2) # Let changes fetched at the end of the window arrive
+            peak_rss = replay.peak_rss_mib(process.pid)
+        finally:
+            replay.stop_pipeline(process)
+            subscriber.loop_stop()
+            subscriber.disconnect()
+            stub.stop()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        offered = len(feed.changes_between(feed.start, measured_until))
+        with lock:
+            delivered = np.array([latency for at, latency in latencies if at <= measured_until]) * 1000
+            published = np.array(publish_latencies) * 1000
+        rss = f"{peak_rss:.0f} MiB" if peak_rss is not None else "n/a"
+        print(f"{volume:>4}x: {offered:,} changes offered, {len(delivered):,} delivered, {len(delivered) / duration:.1f} changes/s, pipeline peak RSS {rss}")
+        if len(delivered):
+            p50, p95, p99 = np.percentile(delivered, [50, 95, 99])
+            print(f"{'':>6}available -> received p50 {p50:.0f} ms  p95 {p95:.0f} ms  p99 {p99:.0f} ms")
+        if len(published):
+            p50, p95, p99 = np.percentile(published, [50, 95, 99])
+            print(f"{'':>6}published -> received p50 {p50:.1f} ms  p95 {p95:.1f} ms  p99 {p99:.1f} ms")
+
+
+
+def bench_topics(n_stations=3_000, n_changes=5_000):
+    '''
+    Messages one subscriber receives and decodes under the topic layout sharded by fuel and postcode region: the retained last values replayed on subscribe, then a stream of live changes. A subscriber to the whole tree (the dashboard before sharding) is compared with the dashboard's filters for one fuel at state and city zoom. Stations are the replay feed's, clustered around towns with postcodes that follow them.
+    '''
+    print(f"Sharded topics on {BENCH_MQTT_HOST}:{BENCH_MQTT_PORT}: {n_stations:,} stations, then {n_changes:,} live changes")
+    try:
+        socket.create_connection((BENCH_MQTT_HOST, BENCH_MQTT_PORT), timeout=2).close()
+    except OSError:
+        print("No broker reachable, skipped (set BENCH_MQTT_HOST / BENCH_MQTT_PORT)")
+        return
+
+    import paho.mqtt.client as mqtt
+
+    feed = replay.synthetic_feed(n_stations, days=1.0)
+    snapshot = data_stream.prepare_fuel_data(feed.payload(feed.initial))
+    changes = data_stream.prepare_fuel_data(feed.payload(feed.changes_between(feed.start, feed.end).head(n_changes)))
+    base = f"bench/{uuid.uuid4().hex[:8]}/FuelPrice" # Fresh tree, so no retained messages from earlier runs
+    pub = publisher.FuelPricePublisher(host=BENCH_MQTT_HOST, port=BENCH_MQTT_PORT, topic=base, wire="binary").start()
+    pub.publish_dataframe(snapshot)
+
+    views = [("whole tree", None), ("E10, state (zoom 8)", 8), ("E10, city (zoom 12)", 12)]
+    subscribers = []
+    for name, zoom in views:
+        if zoom is None:
+            filters = [base + "/#"]
+        else:
+            subscriptions = topics.TopicSubscriptions(base)
+            subscriptions.set_regions(pub.regions)
+            subscriptions.want(name, "E10", [station_index.viewport_bounds(TOWN_CENTERS[0], zoom, 1200, 600)]) # The dashboard's map size and margin
+            filters = sorted(subscriptions.filters()) + [subscriptions.regions_topic]
+        counts = {"retained": 0, "live": 0, "records": 0, "decode_s": 0.0, "topics": set()}
+
+        def on_message(client, userdata, msg):
+            started = time.perf_counter()
+            records = [] if msg.topic.endswith("/" + topics.REGIONS_SUBTOPIC) else userdata["decoder"].decode(msg.payload)
+            counts = userdata["counts"]
+            counts["decode_s"] += time.perf_counter() - started
+            counts["retained" if msg.retain else "live"] += 1
+            counts["records"] += len(records)
+            counts["topics"].add(msg.topic)
+
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=f"{base}/{len(subscribers)}", userdata={"decoder": wire_format.WireDecoder(), "counts": counts}) # Distinct ids, or some brokers hand one client's session to the next
+        client.on_message = on_message
+        client.connect(BENCH_MQTT_HOST, BENCH_MQTT_PORT, 60)
+        client.loop_start()
+        subscribers.append((name, filters, client, counts))
+    # Subscribe only once every client is connected: some brokers (amqtt 0.12) replay the retained messages of other clients' subscriptions to a connecting client
+    while not all(client.is_connected() for _, _, client, _ in subscribers):
+        time.sleep(0.1)
+    for _, filters, client, _ in subscribers:
+        client.subscribe([(topic, 0) for topic in filters])
+
+    def wait_idle():
+        # Until no subscriber received anything for a second
+        last = None
+        while True:
+            time.sleep(1)
+            current = [counts["retained"] + counts["live"] for _, _, _, counts in subscribers]
+            if current == last:
+                return
+            last = current
+
+    wait_idle()
+    pub.publish_dataframe(changes)
+    wait_idle()
+    try:
+        baseline = subscribers[0][3]
+        baseline_total = baseline["retained"] + baseline["live"]
+        for name, filters, _, counts in subscribers:
+            total = counts["retained"] + counts["live"]
+            print(f"{name:<22}{len(filters):>4} filters  {counts['retained']:>7,} retained + {counts['live']:>6,} live messages  {counts['records']:>7,} records  decode {counts['decode_s'] * 1000:7.1f} ms  ({baseline_total / total:.1f}x fewer messages)")
+    finally:
+        for _, _, client, _ in subscribers:
+            client.loop_stop()
+            client.disconnect()
+        for topic in baseline["topics"]: # Clear the retained messages of the throwaway tree
+            pub.publish_payload(b"", topic=topic, retain=True)
+        pub.stop()
+
+
+def run_measured(func, *args):
+    '''
+    Runs func(*args) in a forked child and returns (seconds, peak RSS growth in MiB or None, result). The child resets its RSS high-water mark first (Linux /proc/self/clear_refs), so only memory allocated by func counts, not what it inherited.
+    '''
+    def child(conn):
+        try:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+            baseline = replay.peak_rss_mib("self")
+        except OSError:
+            baseline = None
+        start = time.perf_counter()
+        result = func(*args)
+        seconds = time.perf_counter() - start
+        peak = replay.peak_rss_mib("self")
+        conn.send((seconds, peak - baseline if baseline is not None and peak is not None else None, result))
+        conn.close()
+
+    parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.get_context("fork").Process(target=child, args=(child_conn,))
+    process.start()
+    measured = parent_conn.recv()
+    process.join()
+    return measured
+
+
+def bench_stream_parse(payload_mb=50):
+    sample = len(json.dumps(make_price_payload(10_000))) / 10_000
+    body = json.dumps(make_price_payload(int(payload_mb * 1e6 / sample))).encode()
+    print(f"Full /prices snapshot of {len(body) / 1e6:.0f} MB, fetched over local HTTP and normalized (peak RSS growth per run, in a fresh child)")
+
+    class PayloadHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PayloadHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/prices"
+
+    def buffered():
+        # The previous path: response.json() materializes the whole object tree first
+        parse_start = time.perf_counter()
+        data = requests.get(url).json()
+        parse_s = time.perf_counter() - parse_start
+        return parse_s, len(data_stream.normalize_fuel_data(data))
+
+    def streamed():
+        parse_start = time.perf_counter()
+        data = price_stream.read_price_response(requests.get(url, stream=True))
+        parse_s = time.perf_counter() - parse_start
+        return parse_s, len(data_stream.normalize_fuel_data(data))
+
+    paths = [("response.json()", buffered), (f"streamed ({'orjson' if price_stream.orjson else 'json'} batches)", streamed)]
+    try:
+        baseline_s, rows = None, None
+        for name, func in paths:
+            total_s, peak_mib, (parse_s, n_rows) = run_measured(func)
+            assert rows is None or n_rows == rows
+            report(f"{name}: fetch + parse", parse_s, baseline_s)
+            rows, baseline_s = n_rows, baseline_s or parse_s
+            rss = f"peak RSS +{peak_mib:.0f} MiB" if peak_mib is not None else "peak RSS n/a"
+            print(f"{'':<40}fetch + parse + normalize {total_s * 1000:.0f} ms, {rss}")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+BENCHMARKS = {
+    "api": bench_api,
+    "normalize": bench_normalize,
+    "clean": bench_clean,
+    "publish": bench_publish,
+    "wire": bench_wire,
+    "viewport": bench_viewport,
+    "sessions": bench_sessions,
+    "price_table": bench_price_table,
+    "history": bench_history,
+    "search": bench_search,
+    "replay": bench_replay,
+    "stream_parse": bench_stream_parse,
+    "topics": bench_topics,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run data pipeline benchmarks")
+    parser.add_argument("names", nargs="*", help=f"Benchmarks to run, any of {', '.join(BENCHMARKS)} (default: all)")
+    args = parser.parse_args()
+
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(sorted(unknown))}")
+
+    for name in args.names or BENCHMARKS:
+        BENCHMARKS[name]()
+        print()
+
+
+if __name__ == "__main__":
+    main()
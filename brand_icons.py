@@ -0,0 +1,89 @@
+# Import necessary libraries
+import argparse
+import glob
+import json
+import os
+import re
+from functools import lru_cache
+
+# Constants
+ICON_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "icon") # Next to this module, so the dashboard finds the icons whatever directory it is started from
+MANIFEST_FILE = os.path.join(ICON_DIR, "icons.json") # Generated by "python brand_icons.py build", committed with the icons
+STATIC_ICON_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "icons") # Packed icons, served by Streamlit's static file serving (see .streamlit/config.toml)
+STATIC_ICON_PATH = "app/static/icons" # Where Streamlit serves STATIC_ICON_DIR, below the server's base URL path
+ICON_PIXELS = 48 # Packed icon size; markers show them at 30 px, so this stays sharp on high-DPI screens
+DEFAULT_BRAND = "independent" # Icon for brands without one of their own
+CLASS_PREFIX = "fp-brand-"
+
+
+def brand_slug(brand):
+    # Brand name -> icon name, the same way the icon files are named ("EG Ampol" -> "egampol")
+    return re.sub(r"[^a-z0-9-]", "", str(brand).lower().replace(" ", "")) if brand else ""
+
+
+#   Build Step
+def pack_icon(path, output_file, pixels=ICON_PIXELS):
+    # Downscales one icon onto a transparent square canvas and writes it as an optimized PNG
+    from PIL import Image # Build-time only; the dashboard reads the generated manifest
+
+    with Image.open(path) as image:
+        image = image.convert("RGBA")
+        image.thumbnail((pixels, pixels), Image.LANCZOS)
+        canvas = Image.new("RGBA", (pixels, pixels), (0, 0, 0, 0))
+        canvas.paste(image, ((pixels - image.width) // 2, (pixels - image.height) // 2))
+        canvas.save(output_file, format="PNG", optimize=True)
+
+
+def build_manifest(icon_dir=ICON_DIR, manifest_file=MANIFEST_FILE, static_dir=STATIC_ICON_DIR, pixels=ICON_PIXELS):
+    '''
+    Packs every icon_dir/*.png into static_dir as a small PNG and lists them in a JSON manifest of brand -> file name. The dashboard refers to them by URL from one CSS class per brand, so the browser fetches each icon once and caches it instead of receiving them again with every map rerun.
+    '''
+    os.makedirs(static_dir, exist_ok=True)
+    icons = {}
+    for path in sorted(glob.glob(os.path.join(icon_dir, "*.png"))):
+        name = os.path.basename(path)
+        pack_icon(path, os.path.join(static_dir, name), pixels)
+        icons[os.path.splitext(name)[0]] = name
+    if DEFAULT_BRAND not in icons:
+        raise ValueError(f"{icon_dir} has no {DEFAULT_BRAND}.png to fall back to")
+    with open(manifest_file, "w", encoding="utf-8") as f:
+        json.dump({"pixels": pixels, "icons": icons}, f, indent=0, sort_keys=True)
+    return icons
+
+
+#   Runtime Lookup
+@lru_cache(maxsize=1)
+def load_manifest(manifest_file=MANIFEST_FILE):
+    with open(manifest_file, encoding="utf-8") as f:
+        return json.load(f)["icons"]
+
+
+@lru_cache(maxsize=1024)
+def icon_class(brand):
+    # CSS class of a brand's icon, resolved server-side; unknown brands get the default icon instead of a failed fetch
+    slug = brand_slug(brand)
+    return CLASS_PREFIX + (slug if slug in load_manifest() else DEFAULT_BRAND)
+
+
+@lru_cache(maxsize=8)
+def icon_css(base_url_path=""):
+    # One CSS rule per brand pointing at its packed icon, about 1 KB for every brand; base_url_path is Streamlit's server.baseUrlPath
+    prefix = "/" + "/".join(part for part in (base_url_path.strip("/"), STATIC_ICON_PATH) if part)
+    return "".join(f".{CLASS_PREFIX}{slug}{{background-image:url({prefix}/{name})}}" for slug, name in sorted(load_manifest().items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Brand icon utilities")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help=f"Pack {ICON_DIR}/*.png into {STATIC_ICON_DIR} and list them in {MANIFEST_FILE}")
+    build_parser.add_argument("--pixels", type=int, default=ICON_PIXELS)
+    args = parser.parse_args()
+
+    icons = build_manifest(pixels=args.pixels)
+    source_bytes = sum(os.path.getsize(path) for path in glob.glob(os.path.join(ICON_DIR, "*.png")))
+    packed_bytes = sum(os.path.getsize(os.path.join(STATIC_ICON_DIR, name)) for name in icons.values())
+    print(f"Packed {len(icons)} icons ({source_bytes / 1024:.0f} KiB of PNGs) into {STATIC_ICON_DIR} ({packed_bytes / 1024:.0f} KiB)")
+
+
+if __name__ == "__main__":
+    main()
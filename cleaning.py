@@ -0,0 +1,130 @@
+# Import necessary libraries
+import numpy as np
+import pandas as pd
+
+from wire_format import FUEL_CODES, PRICE_DATE_FORMAT
+
+
+# Column Specification Class Definition
+class Column:
+    '''
+    Declared type and validation rules of one column of the cleaned price frame. kind is "text" (kept as is), "category" (optionally case-normalized, with a known vocabulary listed first; other values are kept), "float" (coerced, optionally bounded) or "datetime" (parsed with date_format). Rows missing a required value, or outside the bounds, are rejected; missing optional values get the fill value.
+    '''
+    def __init__(self, kind, required=False, bounds=None, case=None, vocabulary=None, fill=None, date_format=None):
+        self.kind = kind
+        self.required = required
+        self.bounds = bounds # (low, high), inclusive; None for an open side
+        self.case = case # "title", "upper" or "lower"
+        self.vocabulary = vocabulary
+        self.fill = fill
+        self.date_format = date_format
+
+
+    def convert(self, values):
+        # Typed copy of the column, made once; case changes work on the distinct values only
+        if self.kind == "float":
+            return pd.to_numeric(values, errors="coerce").astype(float, copy=False)
+        if self.kind == "datetime":
+            # Each distinct text is parsed once since timestamps repeat heavily; faster than to_datetime(cache=True), which maps results back through a Series
+            codes, uniques = pd.factorize(values)
+            parsed = pd.to_datetime(uniques, format=self.date_format, errors="coerce")
+            return pd.Series(parsed.take(codes, allow_fill=True, fill_value=pd.NaT), index=values.index, name=values.name)
+        if self.kind == "category":
+            return pd.Series(self._categorical(values), index=values.index, name=values.name)
+        return values
+
+
+    def _categorical(self, values):
+        categorical = pd.Categorical(values)
+        if self.case:
+            # Casing can merge categories ("BP" and "Bp"), so codes are remapped through the merged labels
+            new_codes, labels = pd.factorize(getattr(categorical.categories.str, self.case)())
+            codes = np.where(categorical.codes >= 0, new_codes[categorical.codes], -1)
+            categorical = pd.Categorical.from_codes(codes, categories=labels)
+        if self.vocabulary is not None:
+            known = set(self.vocabulary)
+            categorical = categorical.set_categories(list(self.vocabulary) + [label for label in categorical.categories if label not in known])
+        if self.fill is not None and self.fill not in categorical.categories:
+            categorical = categorical.add_categories([self.fill])
+        return categorical
+
+
+# Schema of the cleaned price frame, in output column order
+FUEL_DATA_SCHEMA = {
+    "StationCode": Column("text"),
+    "ServiceStationName": Column("text", required=True),
+    "Address": Column("text"),
+    "Suburb": Column("category", case="title", fill="Unknown"),
+    "Postcode": Column("category", fill="Unknown"),
+    "Brand": Column("category", case="title"),
+    "FuelCode": Column("category", required=True, case="upper", vocabulary=FUEL_CODES),
+    "Price": Column("float", required=True, bounds=(0, None)),
+    "PriceUpdatedDate": Column("datetime", required=True, date_format=PRICE_DATE_FORMAT),
+    "Latitude": Column("float", required=True, bounds=(-90, 90)),
+    "Longitude": Column("float", required=True, bounds=(-180, 180)),
+}
+DEDUPE_KEYS = ["ServiceStationName", "FuelCode", "Latitude", "Longitude"] # One price per station, fuel and location
+LATEST_BY = "PriceUpdatedDate" # Among duplicates the latest price wins; equal timestamps keep the later row
+
+
+def _latest_rows(columns, rows, keys, latest_by):
+    # Positions among rows holding the latest value of latest_by per key, in input order. Only rows whose key repeats are sorted; a stable sort makes equal timestamps keep the later row.
+    key_frame = lambda positions: pd.DataFrame({name: columns[name].array.take(positions) for name in keys})
+    repeated = key_frame(rows).duplicated(keep=False).to_numpy()
+    if not repeated.any():
+        return rows
+    candidates = rows[repeated]
+    order = candidates[np.argsort(columns[latest_by].to_numpy()[candidates], kind="stable")]
+    latest = order[~key_frame(order).duplicated(keep="last").to_numpy()]
+    return np.sort(np.concatenate([rows[~repeated], latest]))
+
+
+def clean_fuel_data(df, schema=FUEL_DATA_SCHEMA, dedupe_keys=DEDUPE_KEYS, latest_by=LATEST_BY):
+    '''
+    Validates and types a normalized price frame in one pass over the columns declared in schema: each column is converted once, every rule narrows a single row mask, duplicates are resolved with the latest timestamp winning, and the surviving rows are taken from each column once at the end.
+
+    Returns (cleaned frame, rejected rows per rule). Rules are "<column>:missing", "<column>:invalid" (present but not convertible), "<column>:out_of_range" and "duplicate"; each rejected row is counted under the first rule it failed, in schema order, with "duplicate" last.
+    '''
+    keep = np.ones(len(df), dtype=bool)
+    rejected = {}
+    columns = {}
+
+    def reject(rule, failed):
+        failed = failed & keep
+        count = int(failed.sum())
+        if count:
+            rejected[rule] = rejected.get(rule, 0) + count
+            keep[failed] = False
+
+    for name, column in schema.items():
+        raw = df[name] if name in df else pd.Series(None, index=df.index, dtype=object, name=name)
+        values = column.convert(raw)
+        if column.required:
+            # Missing in the input, or present but not convertible to the column's type
+            missing = values.isna().to_numpy()
+            absent = missing if values is raw else raw.isna().to_numpy()
+            reject(f"{name}:missing", absent)
+            reject(f"{name}:invalid", missing & ~absent)
+        if column.bounds is not None:
+            low, high = column.bounds
+            numbers = values.to_numpy(dtype=float, na_value=np.nan)
+            outside = np.zeros(len(numbers), dtype=bool)
+            if low is not None:
+                outside |= numbers < low
+            if high is not None:
+                outside |= numbers > high
+            reject(f"{name}:out_of_range", outside)
+        if column.fill is not None:
+            values = values.fillna(column.fill)
+        columns[name] = values
+
+    rows = np.flatnonzero(keep)
+    if dedupe_keys and len(rows):
+        latest = _latest_rows(columns, rows, dedupe_keys, latest_by)
+        if len(latest) < len(rows):
+            rejected["duplicate"] = len(rows) - len(latest)
+            rows = latest
+
+    # The converted columns are wrapped without copying, so the surviving rows are copied exactly once
+    cleaned = pd.DataFrame(columns, copy=False).take(rows)
+    return cleaned, rejected
@@ -2,122 +2,274 @@ import folium
 import streamlit as st
 import paho.mqtt.client as mqtt
 import json
-import queue
+import os
 import threading
 import time
+import uuid
+from collections import deque
 
+import numpy as np
+import pandas as pd
+from branca.element import Template
 from streamlit_folium import st_folium
 
+from brand_icons import icon_class, icon_css
+from live_prices import CoalescingBuffer, SharedPriceState
+from metrics import MARKERS_REGENERATED, MARKERS_RENDERED, MESSAGES_RECEIVED, MQTT_DISCONNECTS, PENDING_UPDATES, PUBLISH_TO_VISIBLE, RERUN_SECONDS, get_logger, start_metrics_server, start_profiler
+from price_history import PriceHistory
+from price_table import BAND_COLOURS
+from publisher import MQTT_BROKER_HOST, MQTT_BROKER_PORT, MQTT_TOPIC
+from station_search import cheapest_within, nearest_stations
+from station_index import cluster_cell_deg, cluster_points, expand_bounds, needs_clustering, radius_bounds, viewport_bounds
+from topics import RegionIndex, TopicSubscriptions, parse_price_topic
+from wire_format import FUEL_CODES, WireDecoder
+
 #   Constants Definition  
 CENTER_START = [-33.8688, 151.2093] # Default map center coordinates (Sydney)
-DEFAULT_IMG = "https://raw.githubusercontent.com/gale2307/Comp5339/main/icon/independent.png" # Default station icon URL
-FUEL_CODES = ['DL', 'E10', 'P95', 'P98', 'U91', 'PDL', 'EV', 'LPG', 'E85', 'B20'] # List of supported fuel types
-REFRESH_SEC = 30 # Map refresh interval in seconds
-
-#   Data Class Definitions  
-class Station:
-    def __init__(self, service_station_name, address, brand, latitude, longitude):
-        self.service_station_name = service_station_name
-        self.address = address
-        self.brand = brand
-        self.latitude = latitude
-        self.longitude = longitude
-        self.fuelprice = {} # Dictionary to store Fuelprice objects, keyed by fuel_code
-
-class Fuelprice:
-    def __init__(self, fuelcode, price, price_updated_date):
-        self.fuelcode = fuelcode
-        self.price = price
-        self.price_updated_date = price_updated_date
-        
+POLL_SEC = 0.5 # How often each session checks the shared state for new data
+MIN_REFRESH_SEC = 1.0 # Data-driven reruns are at least this far apart (debounce)
+MAX_REFRESH_SEC = 10.0 # Upper bound of the debounce, reached under a sustained update stream
+LATENCY_SAMPLES = 200 # Recent publish-to-visible latencies kept per session
+MAP_WIDTH = 1200 # Map size in pixels
+MAP_HEIGHT = 600
+VIEWPORT_MARGIN = 0.25 # Fraction of the viewport added on each side when selecting stations to draw
+CHEAPEST_N = 10 # Rows in the "cheapest in view" table
+PRICE_HISTORY_DIR = "price_history" # Written by data_stream.py; sparklines and trends are hidden until it exists
+SPARKLINE_DAYS = 30 # Days of daily closing prices shown in popups and the cheapest table
+TREND_DAYS = 90 # Days covered by the suburb trend chart
+SEARCH_MODES = ["Cheapest within radius", "Nearest stations"]
+METRICS_PORT = 9151 # Local Prometheus-style /metrics endpoint for this dashboard process (see metrics.py), None to disable
+# Marker styles, sent once in the map header so each marker only carries class names. Brand icons are served from static/icons, see brand_icons.icon_css().
+MARKER_CSS = (
+    ".fp-marker{display:flex;flex-direction:column;align-items:center;gap:1px;font-family:Arial,sans-serif}"
+    ".fp-icon{width:30px;height:30px;border-radius:4px;box-shadow:0 1px 3px rgba(0,0,0,0.2);background-size:contain;background-repeat:no-repeat;background-position:center}"
+    ".fp-price{font-size:12px;color:white;font-weight:bold;padding:2px 4px;border-radius:3px;display:inline-block;white-space:nowrap}"
+    ".fp-count{font-size:12px;color:white;font-weight:bold;background-color:#6c757d;border-radius:50%;min-width:28px;height:28px;line-height:28px;text-align:center;box-shadow:0 1px 3px rgba(0,0,0,0.3)}"
+    + "".join(f".fp-band-{band}{{background-color:{colour}}}" for band, colour in enumerate(BAND_COLOURS))
+)
+
+log = get_logger("dashboard")
+
+#   Marker Rendering Helpers  
+class StationMarkers(folium.MacroElement):
+    # Draws all markers from one compact JSON array of pre-rendered rows. The generated script is identical between
+    # reruns when no price changed, so st_folium sees the same feature group and skips redrawing the layer.
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        (function() {
+            var rows = {{ this.rows_json }};
+            for (var i = 0; i < rows.length; i++) {
+                L.marker([rows[i][0], rows[i][1]], {icon: L.divIcon({html: rows[i][2], className: "empty"})})
+                    .bindPopup(rows[i][3], {maxWidth: 400})
+                    .addTo({{ this._parent.get_name() }});
+            }
+        })();
+        {% endmacro %}
+    """)
+
+    def __init__(self, marker_rows):
+        super().__init__()
+        self._name = "StationMarkers"
+        self.rows_json = "[" + ",".join(marker_rows) + "]"
+
+
+def build_sparkline_svg(day_offsets, closes, days=SPARKLINE_DAYS, width=120, height=24):
+    # Inline SVG polyline of daily closing prices; x is the day within the window, so days without a change stretch the line.
+    if len(closes) < 2:
+        return ""
+    low, high = min(closes), max(closes)
+    points = " ".join(f"{offset * width / max(days - 1, 1):.0f},{(height - 2) - (close - low) * (height - 4) / ((high - low) or 1):.0f}" for offset, close in zip(day_offsets, closes))
+    return f"""<svg width="{width}" height="{height}"><polyline points="{points}" fill="none" stroke="#007bff" stroke-width="1.5"/></svg>"""
+
+
+def build_popup_html(table, row, fuel_code, sparkline=None):
+    # Popup table showing all available fuel prices for the station, plus the selected fuel's recent trend when there is history.
+    price_rows = "".join(
+        f"<tr><td style='padding: 4px;'>{fuel_type}</td><td style='text-align:center; padding: 4px;'>{price}</td><td style='text-align:right; padding: 4px;'>{price_updated_date}</td></tr>" 
+        for fuel_type, price, price_updated_date in table.station_prices(row) # Only fuels with valid prices
+    )
+    sparkline_svg = build_sparkline_svg(*sparkline) if sparkline else ""
+    trend_html = f"<br>{fuel_code}, last {SPARKLINE_DAYS} days ({min(sparkline[1]):g}-{max(sparkline[1]):g}):<br>{sparkline_svg}" if sparkline_svg else ""
+    return f"""<div style="font-size: 14px; min-width: 250px;"><b>{table.name[row]}</b><br>{table.address[row]}<br><br><table style="width: 100%; border-collapse: collapse;"><thead style="background-color: #f0f0f0;"><tr><th style="padding: 5px; border-bottom: 1px solid #ccc;">Fuel</th><th style="padding: 5px; border-bottom: 1px solid #ccc;">Price</th><th style="padding: 5px; border-bottom: 1px solid #ccc;">Updated</th></tr></thead><tbody>{price_rows if price_rows else "<tr><td colspan='3' style='text-align:center; padding: 5px;'>No price data</td></tr>"}</tbody></table>{trend_html}</div>"""
+
+
+def build_icon_html(table, row, fuel_code, band):
+    # Brand icon plus the price of the selected fuel type, coloured by its price band. Styles and icons come from the page CSS.
+    icon_price_val = float(table.prices(fuel_code)[row])
+    return f"""<div class="fp-marker"><div class="fp-icon {icon_class(table.brand[row])}"></div><div class="fp-price fp-band-{band}">{icon_price_val}</div></div>"""
+
+
+def build_marker_row(table, row, fuel_code, band, station_markers, sparklines):
+    # JSON row [lat, lng, icon html, popup html]; the popup is shared by every price band of the station's selected fuel.
+    if ("popup", fuel_code) not in station_markers:
+        station_markers[("popup", fuel_code)] = json.dumps(build_popup_html(table, row, fuel_code, sparklines.get(table.keys[row])))
+    return f"[{float(table.latitude[row])},{float(table.longitude[row])},{json.dumps(build_icon_html(table, row, fuel_code, band))},{station_markers[('popup', fuel_code)]}]"
+
+
+def build_cluster_row(latitude, longitude, count, min_price, median_price, fuel_code):
+    # JSON row for an aggregated marker: station count with the min and median price of the selected fuel.
+    icon_html = f"""<div class="fp-marker"><div class="fp-count">{count}</div><div class="fp-price fp-band-1">{min_price:g}</div></div>"""
+    popup_html = f"""<div style="font-size: 14px; min-width: 200px;"><b>{count} stations</b><br>{fuel_code} min: {min_price:g}<br>{fuel_code} median: {median_price:g}<br><i>Zoom in to see individual stations</i></div>"""
+    return f"[{float(latitude)},{float(longitude)},{json.dumps(icon_html)},{json.dumps(popup_html)}]"
+
+
+def sparkline_day(history):
+    # Day the popups' sparklines are drawn for, None without history. Part of the marker cache key, so popups gain sparklines once the history appears and roll over once a day.
+    return pd.Timestamp.now().normalize() if history is not None else None
+
+
+def needs_popup(marker_cache, table, row, fuel_code, history_day):
+    # Whether the station's popup for the fuel is missing from the shared cache or stale.
+    cached_key, station_markers = marker_cache.get(row, (None, None))
+    return cached_key != (table.stamp[row], history_day) or ("popup", fuel_code) not in station_markers
+
+
+def load_sparklines(history, table, rows, fuel_code, days=SPARKLINE_DAYS):
+    # {station key: (day offsets, daily closing prices)} of the fuel for the given rows, from one rollup query.
+    if history is None or len(rows) == 0:
+        return {}
+    end = pd.Timestamp.now().normalize() + pd.Timedelta(days=1)
+    daily = history.station_sparklines([table.keys[row] for row in rows], fuel_code, days=days, end=end)
+    daily["offset"] = (pd.to_datetime(daily["day"]) - (end - pd.Timedelta(days=days))).dt.days
+    return {station_code: (group["offset"].tolist(), group["close"].tolist()) for station_code, group in daily.groupby("station_code", sort=False)}
+
+
+def cached_marker_row(marker_cache, table, row, fuel_code, band, sparklines, history_day):
+    # Marker row from the shared per-station cache, built on a miss. Rows built before the station last changed, or for another sparkline day, are stale.
+    # Returns (row, whether it was regenerated).
+    cached_key, station_markers = marker_cache.get(row, (None, None))
+    if cached_key != (table.stamp[row], history_day):
+        station_markers = {}
+        marker_cache[row] = ((table.stamp[row], history_day), station_markers)
+    marker_row = station_markers.get((fuel_code, band))
+    if marker_row is not None:
+        return marker_row, False
+    station_markers[(fuel_code, band)] = build_marker_row(table, row, fuel_code, band, station_markers, sparklines)
+    return station_markers[(fuel_code, band)], True
+
+
 #   MQTT Functionality Module  
 def on_connect(client, userdata, connect_flags, reason_code, properties):
     # Callback for when the client receives a CONNACK response from the server.
-    print(f"[{time.strftime('%H:%M:%S')}] MQTT: on_connect called. Result code: {reason_code}")
     if reason_code == 0: # Connection successful
-        print(f"[{time.strftime('%H:%M:%S')}] MQTT: Connected to broker successfully.")
+        log.info("mqtt_connected", host=MQTT_BROKER_HOST, port=MQTT_BROKER_PORT)
         try:
-            topic = "COMP5339/Assignment02/Group07/FuelPrice"
-            client.subscribe(topic) # Subscribe to the designated topic
-            print(f"[{time.strftime('%H:%M:%S')}] MQTT: Subscribed to topic '{topic}'")
+            # Only the fuels and regions the sessions are showing, plus the region index that maps their viewports to topics
+            userdata["subscriptions"].attach(client)
+            log.info("mqtt_subscribed", filters=len(userdata["subscriptions"].subscribed))
         except Exception as e:
-            print(f"[{time.strftime('%H:%M:%S')}] MQTT: Error subscribing: {e}")
+            log.error("mqtt_subscribe_failed", error=str(e))
     else:
-        print(f"[{time.strftime('%H:%M:%S')}] MQTT: Bad connection, rc = {reason_code}")
+        log.error("mqtt_bad_connection", reason_code=str(reason_code))
 
 def on_message(client, userdata, msg):
     # Callback for when a PUBLISH message is received from the server.
-    current_time_str = time.strftime('%H:%M:%S')
     try:
-        # NOTE: Retrieve the message queue instance from userdata, set during client initialization.
-        message_q_from_userdata = userdata 
-        if message_q_from_userdata is None:
-            print(f"[{current_time_str}] MQTT: Error - userdata (message_queue) is None in on_message!")
+        # NOTE: Retrieve the price buffer and wire decoder from userdata, set during client initialization.
+        if userdata is None:
+            log.error("mqtt_userdata_missing")
             return
 
-        if not isinstance(message_q_from_userdata, queue.Queue):
-            print(f"[{current_time_str}] MQTT: Error - userdata is not a Queue instance in on_message! Type: {type(message_q_from_userdata)}")
+        price_buffer_from_userdata = userdata.get("buffer")
+        if not isinstance(price_buffer_from_userdata, CoalescingBuffer):
+            log.error("mqtt_userdata_invalid", buffer_type=type(price_buffer_from_userdata).__name__)
             return
 
-        payload_str = msg.payload.decode('utf-8') # Decode message payload
-        data = json.loads(payload_str) # Parse JSON data
-        message_q_from_userdata.put(data) # Put parsed data into the shared queue
-        
-        # Reduce print frequency for queue size updates
-        q_size = message_q_from_userdata.qsize()
-        if q_size % 50 == 0 or q_size < 5 or q_size > 500: 
-             print(f"[{current_time_str}] MQTT: Message put into userdata queue. Queue size now: {q_size}")
-             
-    except json.JSONDecodeError:
-        print(f"[{current_time_str}] MQTT: Error decoding JSON: {msg.payload}")
+        # A new region index can change which topics the sessions' viewports need
+        if msg.topic == userdata["subscriptions"].regions_topic:
+            userdata["subscriptions"].set_regions(RegionIndex.decode(msg.payload))
+            return
+
+        # An empty retained message deletes the price of a station and fuel that left the snapshot; deleted station messages need no action
+        if not msg.payload:
+            parsed = parse_price_topic(userdata["subscriptions"].base, msg.topic)
+            if parsed is not None:
+                fuel_code, _, station_code = parsed
+                price_buffer_from_userdata.put([{"StationCode": station_code, "FuelCode": fuel_code, "Removed": True}])
+            return
+
+        # Decode binary or JSON payloads; batched messages carry many records, station messages may release held-back prices
+        records = userdata["decoder"].decode(msg.payload)
+        records += userdata["decoder"].take_station_changes() # Corrected station attributes, applied to every row of the station
+        if msg.retain: # Last value replayed by the broker on subscribe, not a live update: keep it out of the latency metric
+            for record in records:
+                record.pop("PublishedAt", None)
+        received_before = price_buffer_from_userdata.received
+        price_buffer_from_userdata.put(records) # Fold into the latest-value table; older pending prices for the same station and fuel are replaced
+        MESSAGES_RECEIVED.inc(outcome="decoded")
+
+        # Log the buffer counters once per 1000 received records
+        if received_before // 1000 != price_buffer_from_userdata.received // 1000:
+            log.debug("price_buffer", **price_buffer_from_userdata.counters())
+
+    except (json.JSONDecodeError, UnicodeDecodeError, ValueError):
+        MESSAGES_RECEIVED.inc(outcome="error")
+        log.warning("mqtt_decode_failed", topic=msg.topic, payload=repr(msg.payload[:80]))
     except Exception as e:
-        print(f"[{current_time_str}] MQTT: Error in on_message: {e}")
+        MESSAGES_RECEIVED.inc(outcome="error")
+        log.error("mqtt_message_failed", topic=msg.topic, error=str(e))
 
 
-def start_mqtt_thread_target(message_q_for_thread): # NOTE: Target function for the MQTT thread, receives the queue instance.
-    # NOTE: Create MQTT client and set the passed queue instance as userdata.
-    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, userdata=message_q_for_thread)
+def start_mqtt_thread_target(price_buffer_for_thread, subscriptions): # NOTE: Target function for the MQTT thread, receives the price buffer instance and the topic subscriptions.
+    # NOTE: Create MQTT client and set the passed price buffer and subscriptions, plus a wire decoder holding station attributes, as userdata.
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, userdata={"buffer": price_buffer_for_thread, "decoder": WireDecoder(), "subscriptions": subscriptions})
     
     client.on_connect = on_connect
-    client.on_message = on_message # on_message will now get the queue from userdata
+    client.on_message = on_message # on_message will now get the buffer and decoder from userdata
     
-    def on_disconnect(client, userdata, rc): # userdata is also passed to on_disconnect
-        print(f"[{time.strftime('%H:%M:%S')}] MQTT: Disconnected with result code {rc}.")
+    def on_disconnect(client, userdata, disconnect_flags, reason_code, properties): # CallbackAPIVersion.VERSION2 signature
+        MQTT_DISCONNECTS.inc()
+        log.warning("mqtt_disconnected", reason_code=str(reason_code), reconnecting=True)
     client.on_disconnect = on_disconnect
 
-    print(f"[{time.strftime('%H:%M:%S')}] MQTT: start_mqtt thread trying to connect...")
+    log.info("mqtt_connecting", host=MQTT_BROKER_HOST, port=MQTT_BROKER_PORT)
     try:
-        client.connect("172.17.34.107", 1883, 60) # Connect to MQTT broker
+        client.connect(MQTT_BROKER_HOST, MQTT_BROKER_PORT, 60) # Connect to MQTT broker
         client.loop_forever() # Blocking loop to process network traffic and dispatch callbacks
     except Exception as e:
-        print(f"[{time.strftime('%H:%M:%S')}] MQTT: Connection/loop error in start_mqtt: {e}")
+        log.error("mqtt_loop_failed", error=str(e))
 
 
 #   Streamlit Application Main Logic  
 
-# Initialize the message queue in session_state if it doesn't exist.
-# This ensures the queue object persists across Streamlit reruns.
-if 'message_queue' not in st.session_state:
-    print(f"[{time.strftime('%H:%M:%S')}] Main: Initializing message_queue in session_state.")
-    st.session_state.message_queue = queue.Queue()
-
-# Start the MQTT background thread only once per session.
-# Pass the queue instance from session_state to the thread.
-if 'mqtt_thread_started' not in st.session_state:
-    print(f"[{time.strftime('%H:%M:%S')}] Main: Starting MQTT background thread...")
-    # NOTE: Pass the queue instance from session_state as an argument to the thread's target function.
-    threading.Thread(target=start_mqtt_thread_target, args=(st.session_state.message_queue,), daemon=True).start()
-    st.session_state.mqtt_thread_started = True
-
-# Initialize other session_state variables for stations, map center, zoom, and default fuelcode.
-if 'stations' not in st.session_state: st.session_state['stations'] = {}
+@st.cache_resource(show_spinner=False)
+def get_shared_prices():
+    # One subscriber and one price state per process, shared by every browser session.
+    log.info("starting_subscriber")
+    shared = SharedPriceState(TopicSubscriptions(MQTT_TOPIC))
+    # NOTE: Pass the shared buffer and subscriptions as arguments to the thread's target function.
+    threading.Thread(target=start_mqtt_thread_target, args=(shared.buffer, shared.subscriptions), daemon=True).start()
+    return shared
+
+
+@st.cache_resource(show_spinner=False)
+def get_price_history():
+    # Read side of the history written by data_stream.py, shared by every session.
+    return PriceHistory(PRICE_HISTORY_DIR)
+
+
+@st.cache_resource(show_spinner=False)
+def get_metrics_server():
+    # One /metrics endpoint per dashboard process, shared by every session.
+    return start_metrics_server(METRICS_PORT) if METRICS_PORT else None
+
+
+# Initialize per-session view state: map center, zoom, and default fuelcode. Prices live in the shared state.
 if 'center' not in st.session_state: st.session_state['center'] = CENTER_START
 if 'zoom' not in st.session_state: st.session_state['zoom'] = 8
 if "fuelcode" not in st.session_state: st.session_state["fuelcode"] = "E10" # Default fuel type
+if "session_id" not in st.session_state: st.session_state["session_id"] = uuid.uuid4().hex # Identifies this session's topic filters in the shared subscriber
+if "rendered_version" not in st.session_state: st.session_state["rendered_version"] = -1 # Shared snapshot version on screen
+if "rendered_at" not in st.session_state: st.session_state["rendered_at"] = 0.0 # time.monotonic() of the last full render
+if "refresh_interval" not in st.session_state: st.session_state["refresh_interval"] = MIN_REFRESH_SEC # Current adaptive debounce
+if "latencies" not in st.session_state: st.session_state["latencies"] = deque(maxlen=LATENCY_SAMPLES) # Publish-to-visible seconds, oldest update per render
 
 # Set page configuration (must be the first Streamlit command).
 st.set_page_config(page_title="Fuelprice dashboard", layout="wide")
 st.title("Real-time Fuelprice dashboard") # Set application title.
+shared_prices = get_shared_prices() # After set_page_config, which must be the first Streamlit command.
+get_metrics_server()
+price_history = get_price_history() if os.path.isdir(PRICE_HISTORY_DIR) else None
 
 # Create a selectbox for fuel code selection.
 # The selected value is stored in session_state and its change triggers a rerun.
@@ -128,114 +280,169 @@ except ValueError:
     default_selectbox_index = FUEL_CODES.index("E10") # Fallback to E10 if saved fuelcode is invalid
 st.session_state["fuelcode"] = st.selectbox("Fuelcode: ", FUEL_CODES, index=default_selectbox_index)
 
-#   Main thread's message processing loop  
-main_thread_mq = st.session_state.message_queue # Get the queue instance from session_state.
-
-current_time_queue_check = time.strftime('%H:%M:%S')
-# NOTE: Log the current size of the message queue (referenced from session_state).
-print(f"[{current_time_queue_check}] Main: Checking st.session_state.message_queue. Current size: {main_thread_mq.qsize()}")
-messages_processed_count = 0
-MAX_MESSAGES_PER_RUN = 500 # Limit the number of messages processed per rerun to prevent long blocking.
-
-# Process messages from the queue until it's empty or the processing limit is reached.
-while not main_thread_mq.empty() and messages_processed_count < MAX_MESSAGES_PER_RUN:
-    if messages_processed_count == 0: # Log entry into the processing loop.
-        print(f"[{time.strftime('%H:%M:%S')}] Main: Entered 'while not main_thread_mq.empty()' loop using st.session_state.message_queue.")
-    messages_processed_count += 1
-    data = main_thread_mq.get() # Retrieve a message from the queue.
-    
-    # Extract data fields safely using .get().
-    station_name = data.get("ServiceStationName")
-    address = data.get("Address")
-    brand = data.get("Brand")
-    latitude = data.get("Latitude")
-    longitude = data.get("Longitude")
-    fuel_code = data.get("FuelCode")
-    price = data.get("Price")
-    price_updated_date = data.get("PriceUpdatedDate")
-
-    # Skip processing if essential station identification or location data is missing.
-    if not (station_name and address and latitude is not None and longitude is not None): 
-        continue
-    
-    station_key = station_name + address # Create a unique key for the station.
-
-    # If station is new, create and store a Station object in session_state.
-    if station_key not in st.session_state['stations']:
-        st.session_state["stations"][station_key] = Station(
-            service_station_name=station_name, address=address, brand=brand, 
-            latitude=latitude, longitude=longitude
-        )
-    
-    # If station exists and fuel data is valid, update or add the fuel price.
-    if station_key in st.session_state['stations'] and fuel_code and price is not None:
-        current_station_obj = st.session_state["stations"][station_key]
-        if fuel_code not in current_station_obj.fuelprice: # New fuel type for this station
-            current_station_obj.fuelprice[fuel_code] = Fuelprice(
-                fuelcode=fuel_code, price=price, price_updated_date=price_updated_date
-            )
-        else: # Existing fuel type, update price and date
-            current_station_obj.fuelprice[fuel_code].price = price
-            current_station_obj.fuelprice[fuel_code].price_updated_date = price_updated_date
-
-# Log the number of messages processed in this run.
-if messages_processed_count > 0:
-    print(f"[{time.strftime('%H:%M:%S')}] Main: Exited 'while not main_thread_mq.empty()' loop. Processed {messages_processed_count} messages from st.session_state.message_queue.")
-elif main_thread_mq.qsize() > 0 : # Queue has items but none were processed (e.g., due to MAX_MESSAGES_PER_RUN).
-    print(f"[{time.strftime('%H:%M:%S')}] Main: st.session_state.message_queue has {main_thread_mq.qsize()} items, but no messages processed.")
-else: # Queue was empty.
-    print(f"[{time.strftime('%H:%M:%S')}] Main: st.session_state.message_queue was empty.")
+#   Shared state refresh  
+stop_profiler = start_profiler("rerun") # Only when "rerun" is in FUEL_PROFILE_STAGES
+ingest_started = time.perf_counter()
+
+# Fold any pending updates into a new snapshot (or just pick up the one another session already built).
+# The snapshot is immutable, so the rest of this run reads it without locking.
+snapshot = shared_prices.refresh()
+price_table = snapshot.table
+buffer_counters = shared_prices.counters()
+PENDING_UPDATES.set(len(shared_prices.buffer))
+
+ingest_sec = time.perf_counter() - ingest_started
+RERUN_SECONDS.observe(ingest_sec, phase="refresh")
 
 #   Map Drawing Logic  
-fg = folium.FeatureGroup(name="Markers") # Create a FeatureGroup to hold map markers.
-markers_added_to_map = 0
-
-# Iterate through all stations stored in session_state.
-for station_key_loop, station_obj_loop in st.session_state["stations"].items():
-    selected_fuel = st.session_state["fuelcode"] # Get the currently selected fuel code.
-
-    # Filter: Skip station if it doesn't have the selected fuel type or if the price is None.
-    if selected_fuel not in station_obj_loop.fuelprice or station_obj_loop.fuelprice[selected_fuel].price is None: 
-        continue
-    # Filter: Skip station if latitude or longitude is missing.
-    if station_obj_loop.latitude is None or station_obj_loop.longitude is None: 
-        continue
-    
-    # Prepare HTML for the marker's popup table, showing all available fuel prices for the station.
-    price_rows = "".join(
-        f"<tr><td style='padding: 4px;'>{fuel_type}</td><td style='text-align:center; padding: 4px;'>{fuel_data.price}</td><td style='text-align:right; padding: 4px;'>{fuel_data.price_updated_date}</td></tr>" 
-        for fuel_type, fuel_data in station_obj_loop.fuelprice.items() if fuel_data.price is not None # Only include rows with valid prices
-    )
-    popup_html = f"""<div style="font-size: 14px; min-width: 250px;"><b>{station_obj_loop.service_station_name}</b><br>{station_obj_loop.address}<br><br><table style="width: 100%; border-collapse: collapse;"><thead style="background-color: #f0f0f0;"><tr><th style="padding: 5px; border-bottom: 1px solid #ccc;">Fuel</th><th style="padding: 5px; border-bottom: 1px solid #ccc;">Price</th><th style="padding: 5px; border-bottom: 1px solid #ccc;">Updated</th></tr></thead><tbody>{price_rows if price_rows else "<tr><td colspan='3' style='text-align:center; padding: 5px;'>No price data</td></tr>"}</tbody></table></div>"""
-    
-    # Prepare brand image URL and the price to display on the icon.
-    brand_str = str(station_obj_loop.brand).lower().replace(" ", "") if station_obj_loop.brand else "unknown"
-    image_url = f"https://raw.githubusercontent.com/gale2307/Comp5339/main/icon/{brand_str}.png"
-    icon_price_val = station_obj_loop.fuelprice[selected_fuel].price # Price for the selected fuel type.
-    
+marker_build_started = time.perf_counter()
+selected_fuel = st.session_state["fuelcode"] # Get the currently selected fuel code.
+marker_cache = shared_prices.marker_cache
+selected_prices = price_table.prices(selected_fuel) # Price of the selected fuel per station row (NaN where missing)
+band_thresholds = price_table.band_thresholds(selected_fuel) # Statewide price bands, so a marker's colour doesn't change when panning
+
+# Only stations inside the viewport (plus a margin for panning) are considered.
+current_map_zoom = st.session_state.get('zoom', 8)
+if st.session_state.get("bounds"):
+    view_bounds = expand_bounds(st.session_state["bounds"], VIEWPORT_MARGIN)
+else: # No bounds reported by the browser yet, estimate them from center and zoom
+    view_bounds = viewport_bounds(st.session_state.get('center', CENTER_START), current_map_zoom, MAP_WIDTH, MAP_HEIGHT, VIEWPORT_MARGIN)
+in_view = price_table.select(selected_fuel, snapshot.index.query_bbox(*view_bounds)) # Skip stations without a price for the selected fuel
+
+marker_rows = []
+markers_regenerated = 0
+clusters_drawn = 0
+
+if needs_clustering(current_map_zoom, len(in_view)):
+    # Low zoom or dense viewport: aggregate nearby stations server-side; single-station cells still get their normal marker.
+    clusters = cluster_points(price_table.latitude[in_view], price_table.longitude[in_view], selected_prices[in_view], cluster_cell_deg(current_map_zoom))
+    first_member = np.full(len(clusters["count"]), -1)
+    first_member[clusters["members"][::-1]] = in_view[::-1]
+    drawn_rows = first_member[clusters["count"] == 1]
+else:
+    clusters = None
+    drawn_rows = in_view
+
+# Sparklines for the popups that have to be (re)built this run, fetched from the history rollups in one query.
+history_day = sparkline_day(price_history)
+sparklines = load_sparklines(price_history, price_table, [row for row in drawn_rows.tolist() if needs_popup(marker_cache, price_table, row, selected_fuel, history_day)], selected_fuel)
+
+# Individual station markers, with price bands computed for all of them at once.
+for station_row, band in zip(drawn_rows.tolist(), price_table.price_bands(selected_fuel, drawn_rows, band_thresholds).tolist()):
     try:
-        # Create a Folium marker with a custom HTML DivIcon.
-        marker = folium.Marker(
-            location=[float(station_obj_loop.latitude), float(station_obj_loop.longitude)], 
-            icon=folium.DivIcon(html=f"""<div style="display: flex; flex-direction: column; align-items: center; gap: 1px; font-family: Arial, sans-serif;"><img src="{image_url}" onerror="this.onerror=null; this.src='{DEFAULT_IMG}';" style="width:30px;height:30px; border-radius:4px; box-shadow: 0 1px 3px rgba(0,0,0,0.2);"><div style="font-size: 12px; color: white; font-weight: bold; background-color: #007bff; padding: 2px 4px; border-radius: 3px; display: inline-block;">{icon_price_val}</div></div>"""), 
-            popup=folium.Popup(popup_html, max_width=400)
-        )
-        fg.add_child(marker) # Add marker to the FeatureGroup.
-        markers_added_to_map += 1
+        marker_row, regenerated = cached_marker_row(marker_cache, price_table, station_row, selected_fuel, band, sparklines, history_day)
+        marker_rows.append(marker_row)
+        markers_regenerated += regenerated
     except Exception as e: 
-        print(f"[{time.strftime('%H:%M:%S')}] Main: Error creating marker for {station_obj_loop.service_station_name}: {e}")
+        log.error("marker_failed", station=price_table.name[station_row], error=str(e))
 
-# Display an info message if no markers were added but stations exist and queue is empty (data might be missing for selected fuel).
-if markers_added_to_map == 0 and len(st.session_state.get('stations', {})) > 0 and st.session_state.message_queue.qsize() == 0 :
+# Aggregated markers for cells holding more than one station.
+if clusters is not None:
+    for i in np.flatnonzero(clusters["count"] > 1):
+        marker_rows.append(build_cluster_row(clusters["lat"][i], clusters["lon"][i], clusters["count"][i], clusters["min"][i], clusters["median"][i], selected_fuel))
+        clusters_drawn += 1
+
+markers_added_to_map = len(marker_rows)
+fg = folium.FeatureGroup(name="Markers") # Create a FeatureGroup to hold map markers.
+StationMarkers(marker_rows).add_to(fg)
+marker_build_sec = time.perf_counter() - marker_build_started
+RERUN_SECONDS.observe(marker_build_sec, phase="markers")
+MARKERS_RENDERED.observe(markers_added_to_map)
+MARKERS_REGENERATED.inc(markers_regenerated)
+
+# Display an info message if no markers were added but stations exist and the buffer is empty (data might be missing for selected fuel).
+if markers_added_to_map == 0 and len(price_table) > 0 and len(shared_prices.buffer) == 0 :
     st.info(f"No stations currently have price data for the selected fuel ({st.session_state['fuelcode']}). Waiting for updates or try another fuel type.")
 
 # Create the Folium map object, centered and zoomed based on session_state.
 current_map_center = st.session_state.get('center', CENTER_START)
-current_map_zoom = st.session_state.get('zoom', 8)
 m = folium.Map(location=current_map_center, zoom_start=current_map_zoom)
+m.get_root().header.add_child(folium.Element(f"<style>{MARKER_CSS}{icon_css(st.get_option('server.baseUrlPath'))}</style>")) # Marker styles; the browser caches the brand icons
 
 # Render the map using st_folium.
-map_render_data = st_folium(m, key="fuel_map", feature_group_to_add=fg, height=600, width=1200, returned_objects=["last_center", "last_zoom"])
+render_started = time.perf_counter()
+map_render_data = st_folium(m, key="fuel_map", feature_group_to_add=fg, height=MAP_HEIGHT, width=MAP_WIDTH, returned_objects=["last_center", "last_zoom", "bounds"])
+render_sec = time.perf_counter() - render_started
+RERUN_SECONDS.observe(render_sec, phase="render")
+
+# Publish-to-visible latency of the updates this run put on screen (needs publish timestamps on the wire and roughly synchronised clocks).
+published_range = shared_prices.published_range(st.session_state["rendered_version"], snapshot.version)
+latency_text = ""
+if published_range is not None:
+    visible_at = time.time()
+    st.session_state["latencies"].append(visible_at - published_range[0])
+    PUBLISH_TO_VISIBLE.observe(visible_at - published_range[0])
+    recent_latencies = sorted(st.session_state["latencies"])
+    latency_text = f", publish to visible {visible_at - published_range[1]:.1f}-{visible_at - published_range[0]:.1f} s (p95 {recent_latencies[int(len(recent_latencies) * 0.95)]:.1f} s)"
+st.session_state["rendered_version"] = snapshot.version
+st.session_state["rendered_at"] = time.monotonic()
+
+# Per-rerun timing breakdown.
+st.caption(f"Rerun timings: snapshot v{snapshot.version}, refresh {ingest_sec * 1000:.0f} ms ({buffer_counters['received']} received, {buffer_counters['coalesced']} coalesced, {buffer_counters['applied']} applied since start), markers {marker_build_sec * 1000:.0f} ms ({markers_regenerated} of {markers_added_to_map} regenerated, {clusters_drawn} clusters, {len(in_view)} of {len(price_table)} stations in view), map render {render_sec * 1000:.0f} ms{latency_text}")
+log.info("rerun", version=snapshot.version, stations=len(price_table), in_view=len(in_view), markers=markers_added_to_map, regenerated=markers_regenerated, clusters=clusters_drawn,
+         refresh_ms=ingest_sec * 1000, markers_ms=marker_build_sec * 1000, render_ms=render_sec * 1000, received=buffer_counters["received"], applied=buffer_counters["applied"])
+
+# Cheapest stations for the selected fuel among those in view, straight from the price table, with their recent trend when there is history.
+cheapest_rows = price_table.cheapest(selected_fuel, CHEAPEST_N, in_view)
+if len(cheapest_rows) > 0:
+    st.subheader(f"Cheapest {selected_fuel} in view")
+    cheapest_df = pd.DataFrame({
+        "Station": [price_table.name[row] for row in cheapest_rows],
+        "Address": [price_table.address[row] for row in cheapest_rows],
+        "Brand": [price_table.brand[row] for row in cheapest_rows],
+        "Price": selected_prices[cheapest_rows],
+    })
+    column_config = {}
+    if price_history is not None:
+        cheapest_sparklines = load_sparklines(price_history, price_table, cheapest_rows.tolist(), selected_fuel)
+        cheapest_df[f"Last {SPARKLINE_DAYS} days"] = [cheapest_sparklines.get(price_table.keys[row], ([], []))[1] for row in cheapest_rows]
+        column_config[f"Last {SPARKLINE_DAYS} days"] = st.column_config.LineChartColumn(f"Last {SPARKLINE_DAYS} days")
+    st.dataframe(cheapest_df, hide_index=True, column_config=column_config)
+
+# Station search: cheapest or nearest stations selling the selected fuel around a point (the map centre by default).
+# The query is kept in session_state and re-run on every rerun, so the results follow live price updates.
+with st.expander(f"Find {selected_fuel} near a location", expanded="search" in st.session_state):
+    with st.form("station_search"):
+        center = st.session_state.get('center', CENTER_START)
+        center_lat, center_lon = (center["lat"], center["lng"]) if isinstance(center, dict) else center # st_folium reports {"lat", "lng"}
+        lat_col, lon_col, mode_col = st.columns(3)
+        search_lat = lat_col.number_input("Latitude", min_value=-90.0, max_value=90.0, value=float(center_lat), format="%.5f")
+        search_lon = lon_col.number_input("Longitude", min_value=-180.0, max_value=180.0, value=float(center_lon), format="%.5f")
+        search_mode = mode_col.radio("Search", SEARCH_MODES)
+        radius_col, count_col = st.columns(2)
+        search_radius = radius_col.slider("Radius (km)", min_value=1, max_value=100, value=10)
+        search_count = count_col.number_input("Results", min_value=1, max_value=50, value=10)
+        if st.form_submit_button("Search"):
+            st.session_state["search"] = {"mode": search_mode, "lat": search_lat, "lon": search_lon, "radius": search_radius, "count": int(search_count)}
+
+    search = st.session_state.get("search")
+    if search:
+        search_started = time.perf_counter()
+        if search["mode"] == SEARCH_MODES[0]:
+            results = cheapest_within(snapshot, search["lat"], search["lon"], search["radius"], selected_fuel, search["count"])
+            description = f"Cheapest {selected_fuel} within {search['radius']} km"
+        else:
+            results = nearest_stations(snapshot, search["lat"], search["lon"], search["count"], selected_fuel)
+            description = f"Nearest stations with {selected_fuel}"
+        search_ms = (time.perf_counter() - search_started) * 1000
+        st.caption(f"{description} of ({search['lat']:.4f}, {search['lon']:.4f}): {len(results)} found in {search_ms:.1f} ms")
+        if not results.empty:
+            st.dataframe(results.drop(columns=["Latitude", "Longitude"]), hide_index=True)
+
+# Suburb trend (daily min/avg/max) from the history rollups, without touching the raw history.
+if price_history is not None:
+    with st.expander(f"{selected_fuel} price trend by suburb"):
+        areas = price_history.areas()
+        suburbs = sorted(set(areas["Suburb"]) - {""})
+        if suburbs:
+            trend_suburb = st.selectbox("Suburb", suburbs, key="trend_suburb")
+            trend = price_history.area_trend(selected_fuel, suburb=trend_suburb, start=pd.Timestamp.now().normalize() - pd.Timedelta(days=TREND_DAYS), freq="day")
+            if trend.empty:
+                st.caption(f"No {selected_fuel} prices recorded for {trend_suburb} in the last {TREND_DAYS} days.")
+            else:
+                st.line_chart(trend.set_index("period")[["min", "avg", "max"]])
+        else:
+            st.caption("No price history recorded yet.")
 
 # If the user interacts with the map (pans or zooms), update session_state to preserve their view.
 if map_render_data and map_render_data.get("last_center") and map_render_data.get("last_zoom"):
@@ -243,13 +450,40 @@ if map_render_data and map_render_data.get("last_center") and map_render_data.ge
         st.session_state['zoom'] != map_render_data["last_zoom"]):
         st.session_state['center'] = map_render_data["last_center"]
         st.session_state['zoom'] = map_render_data["last_zoom"]
+# Keep the visible bounds too, so the next rerun queries exactly the area on screen.
+bounds_data = (map_render_data or {}).get("bounds") or {}
+if bounds_data.get("_southWest") and bounds_data.get("_northEast") and bounds_data["_southWest"].get("lat") is not None:
+    st.session_state["bounds"] = (bounds_data["_southWest"]["lat"], bounds_data["_southWest"]["lng"], bounds_data["_northEast"]["lat"], bounds_data["_northEast"]["lng"])
+
+# Report the selected fuel and the areas this session needs (viewport plus margin, and the search circle) to the shared subscriber,
+# which resubscribes to the matching fuel/region topics when the union over all sessions changes.
+def report_view():
+    areas = [expand_bounds(st.session_state["bounds"], VIEWPORT_MARGIN) if st.session_state.get("bounds") else view_bounds]
+    if st.session_state.get("search"):
+        areas.append(radius_bounds(st.session_state["search"]["lat"], st.session_state["search"]["lon"], st.session_state["search"]["radius"]))
+    shared_prices.subscriptions.want(st.session_state["session_id"], selected_fuel, areas)
+
+report_view()
+
+#   Event-Driven Refresh Mechanism  
+# Instead of sleeping on the script thread, a fragment checks the shared state every POLL_SEC (a version comparison and a status line)
+# and triggers a full rerun only when there is new data and the debounce interval since the last render has passed.
+@st.fragment(run_every=POLL_SEC)
+def watch_for_updates():
+    if not shared_prices.subscriptions.touch(st.session_state["session_id"]):
+        report_view() # Filters expired while the session sat idle past the linger time
+    if not shared_prices.pending(st.session_state["rendered_version"]):
+        # Idle feed: let the next update through quickly.
+        st.session_state["refresh_interval"] = max(MIN_REFRESH_SEC, st.session_state["refresh_interval"] / 2)
+    elif time.monotonic() - st.session_state["rendered_at"] >= st.session_state["refresh_interval"]:
+        # Busy feed: space reruns further apart so each one folds in a bigger batch.
+        st.session_state["refresh_interval"] = min(MAX_REFRESH_SEC, st.session_state["refresh_interval"] * 1.5)
+        st.rerun()
+    last_update = shared_prices.last_update
+    st.caption(f"Live: showing v{st.session_state['rendered_version']}, refresh debounce {st.session_state['refresh_interval']:.1f} s" + (f", last update {time.time() - last_update:.0f} s ago" if last_update else ", waiting for data"))
+
 
-#   Periodic Refresh Mechanism  
-main_thread_mq_at_end = st.session_state.message_queue # Get queue reference for final log.
-current_time_before_rerun = time.strftime('%H:%M:%S')
-print(f"[{current_time_before_rerun}] Main: Reached end of script. Preparing to sleep for {REFRESH_SEC}s then rerun. Remaining st.session_state.message_queue size: {main_thread_mq_at_end.qsize()}")
-time.sleep(REFRESH_SEC) # Pause execution for REFRESH_SEC seconds.
-try:
-    st.rerun() # Trigger a rerun of the Streamlit script from the top.
-except Exception as e:
-    print(f"[{time.strftime('%H:%M:%S')}] Main: Exception during st.rerun() call: {e}")
\ No newline at end of file
+RERUN_SECONDS.observe(time.perf_counter() - ingest_started, phase="total")
+if stop_profiler is not None:
+    stop_profiler()
+watch_for_updates()
@@ -1,28 +1,176 @@
 # Import necessary libraries
+import argparse
 import requests
 import pandas as pd
 import json
+import os
+import re
 from datetime import datetime, timezone
 import time
-import paho.mqtt.client as mqtt
+import threading
+import asyncio
+import signal
 
 # For Generate Unique Transaction Id for accesing API
 import uuid
 import config_secret
+from cleaning import clean_fuel_data
+from metrics import FETCH_SECONDS, POLL_RECORDS, REJECTED_ROWS, STEP_SECONDS, get_logger, start_metrics_server
+from price_history import PriceHistory
+from price_stream import read_price_response
+from price_store import PriceStore, migrate_csv
+from publisher import FuelPricePublisher, PacingPolicy, MQTT_BROKER_HOST, MQTT_BROKER_PORT
+from pipeline import Pipeline
 
 # Constants
 API_KEY = config_secret.API_KEY
 AuthorizationHeader = config_secret.AuthorizationHeader
-POLL_COOLDOWN = 60
+API_BASE_URL = "https://api.onegov.nsw.gov.au"
+POLL_COOLDOWN = 60 # Fixed polling period in seconds, independent of how long publishing takes
+PIPELINE_REPORT_INTERVAL = 300 # Seconds between pipeline stage latency / queue depth reports, None to disable
+TOKEN_REFRESH_MARGIN = 300 # Refresh the access token this many seconds before it expires
+HTTP_POOL_SIZE = 4 # Keep-alive connections kept open per host
+MIN_REQUEST_INTERVAL = 0 # Optional minimum seconds between API requests (0 = no client-side throttling)
+FUEL_DATA_COLUMNS = ["StationCode", "ServiceStationName", "Address", "Suburb", "Postcode", "Brand", "FuelCode", "Price", "PriceUpdatedDate", "Latitude", "Longitude"]
+PRICE_DB_FILE = "fuel_prices.db" # SQLite price store (current prices + change history)
+PRICE_HISTORY_DIR = "price_history" # Daily compressed history partitions and hourly/daily rollups, None to disable
+CSV_EXPORT_FILE = None # Optional CSV export of the current snapshot, off unless set here or with --csv-export
+CSV_EXPORT_INTERVAL = 600 # Minimum seconds between CSV exports while running; one more is written on shutdown
+LEGACY_CSV_FILE = "integrated_fuel_data.csv" # Written after every poll by earlier versions: imported into an empty price store, and the default --csv-export file
+STATION_CACHE_FILE = "station_cache.json" # Station reference data cached between runs
+STATION_CACHE_FORCE_INTERVAL = 600 # Minimum seconds between forced reference refreshes for unknown station codes
+STATION_CACHE_MAX_HELD = 10000 # Price rows for unknown stations held back for a later retry; the oldest are dropped beyond this
+PRICE_FIELDS = ["stationcode", "fueltype", "price", "lastupdated"] # Price fields of a "/prices" or "/prices/new" payload
+PUBLISH_QOS = 1 # QoS 1 needs one PUBACK per message instead of QoS 2's four-way handshake
+PUBLISH_PACING = PacingPolicy.per_second(200) # Or PacingPolicy.fixed_delay(0.1) / PacingPolicy.unthrottled()
+REPUBLISH_SNAPSHOT = False # Replay the whole startup snapshot, e.g. after the broker lost its retained messages
+PUBLISH_BATCH_SIZE = 1 # Records per MQTT message; above 1, records are packed into one message on the base topic
+WIRE_FORMAT = "binary" # "binary" (compact, see wire_format.py) or "json"
+STAMP_PUBLISH_TIME = True # Binary price messages carry their publish time, for the dashboard's publish-to-visible latency
+STREAM_PRICE_SNAPSHOT = True # Parse the full "/prices" snapshot incrementally while it downloads (see price_stream.py) instead of response.json()
+METRICS_PORT = 9150 # Local Prometheus-style /metrics endpoint (see metrics.py), None to disable
+ADDRESS_PATTERN = r"(?:.*,\s*)?(?P<Suburb>[^,]+?)\s+(?:[A-Z]{2,3}|NEW SOUTH WALES)(?:\s+AUSTRALIA)?\s+(?P<Postcode>\d{4})\s*$" # Suburb and postcode at the end of an address
+
+
+log = get_logger("data_stream")
+
+
+# Access Token Manager Class Definition
+class AccessTokenManager:
+    '''
+    Caches the OAuth bearer token until shortly before "expires_in" and refreshes it early in a background thread, so API calls never pay for a token round-trip while the cached token is still valid. requests.Session is not thread-safe, so the background refresh uses a keep-alive session of its own; session is only used from the caller's thread.
+    '''
+    def __init__(self, session, url, AuthorizationHeader, refresh_margin=TOKEN_REFRESH_MARGIN):
+        self.session = session
+        self.url = url
+        self.AuthorizationHeader = AuthorizationHeader
+        self.refresh_margin = refresh_margin
+        self.token_requests = 0 # Number of token round-trips made so far
+
+        self._lock = threading.Lock()
+        self._access_token = None
+        self._expires_at = 0.0
+        self._refresh_thread = None
+        self._refresh_session = None # Created by the first background refresh
+
+
+    def _request_token(self, session):
+        query_getAccessToken = {"grant_type":"client_credentials"}
+        headers_getAccessToken = {'Authorization': self.AuthorizationHeader}
+
+        response = session.get(self.url, headers=headers_getAccessToken, params=query_getAccessToken)
+        response.raise_for_status()
+        token_json = response.json()
+
+        # The API returns expires_in as a string of seconds; treat a missing value as "do not cache"
+        try:
+            expires_in = float(token_json.get("expires_in", 0))
+        except (TypeError, ValueError):
+            expires_in = 0.0
+
+        self._access_token = token_json["access_token"]
+        self._expires_at = time.monotonic() + expires_in
+        self.token_requests += 1
+
+
+    def _refresh_in_background(self):
+        try:
+            with self._lock:
+                # Another caller may already have refreshed the token
+                if time.monotonic() < self._expires_at - self.refresh_margin:
+                    return
+                if self._refresh_session is None:
+                    self._refresh_session = requests.Session()
+                self._request_token(self._refresh_session)
+        except Exception as e:
+            # Keep serving the cached token, the next call retries once it really expires
+            log.warning("token_refresh_failed", error=str(e))
+
+
+    def get_token(self):
+        now = time.monotonic()
+
+        # No usable token: block until a fresh one is fetched
+        if self._access_token is None or now >= self._expires_at:
+            with self._lock:
+                if self._access_token is None or time.monotonic() >= self._expires_at:
+                    self._request_token(self.session)
+            return self._access_token
+
+        # Token still valid but close to expiry: refresh early without blocking the caller
+        if now >= self._expires_at - self.refresh_margin:
+            if self._refresh_thread is None or not self._refresh_thread.is_alive():
+                self._refresh_thread = threading.Thread(target=self._refresh_in_background, daemon=True)
+                self._refresh_thread.start()
+
+        return self._access_token
+
+
+    def close(self):
+        with self._lock:
+            if self._refresh_session is not None:
+                self._refresh_session.close()
+
+
+# Client-side Rate Limiter Class Definition
+class RateLimiter:
+    '''
+    Enforces a minimum interval between consecutive API requests. Only sleeps for whatever is left of the interval, so a poll that already waited POLL_COOLDOWN seconds is not delayed at all.
+    '''
+    def __init__(self, min_interval=0.0):
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._last_request = None
+
+
+    def wait(self):
+        if not self.min_interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if self._last_request is not None:
+                remaining = self._last_request + self.min_interval - now
+                if remaining > 0:
+                    time.sleep(remaining)
+            self._last_request = time.monotonic()
 
 
 # FuelPrice API Client Class Definition
 class FuelPriceCheckAPI:
-    def __init__(self, API_KEY, AuthorizationHeader):
-        self.url_base = "https://api.onegov.nsw.gov.au" # Base Url
+    def __init__(self, API_KEY, AuthorizationHeader, url_base=API_BASE_URL, min_request_interval=0.0):
+        self.url_base = url_base # Base Url
         self.API_KEY = API_KEY
         self.AuthorizationHeader = AuthorizationHeader
 
+        # One keep-alive session shared by every endpoint, so TLS handshakes happen once per connection rather than per request
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.token_manager = AccessTokenManager(self.session, self.url_base + "/oauth/client_credential/accesstoken", AuthorizationHeader)
+        self.rate_limiter = RateLimiter(min_request_interval)
+
     
     def get_datetime_now():
         return datetime.now(timezone.utc).strftime("%d/%m/%Y %I:%M:%S %p")
@@ -32,31 +180,11 @@ class FuelPriceCheckAPI:
         return str(uuid.uuid4())
 
     def get_accesstoken(self):
-        # Config url api prameters for getting accesstoken
-        url_subpart = "/oauth/client_credential/accesstoken"
-
-        url = self.url_base + url_subpart
-
-        query_getAccessToken = {"grant_type":"client_credentials"}
-
-        headers_getAccessToken = {'Authorization': self.AuthorizationHeader}
+        # Cached bearer token, only requested from the API when missing or about to expire
+        return self.token_manager.get_token()
 
-        # Get the web result for accesstoken
-        response = requests.get(url, headers=headers_getAccessToken, params=query_getAccessToken)
-
-        # Get the accesstoken from the web result
-        access_token = response.json()["access_token"]
-
-        return access_token
-
-
-    def getFuelPrice(self):
-        '''
-        Returns all current fuel prices for all service stations. There may be restrictions on how often this API request can be made. It is recommended to execute this call in a separate api client as response can be over 2 mb. This API returns data for NSW.
-        '''
-        # Config url api prameters for getting fuel price
-        url_subpart = "/FuelPriceCheck/v1/fuel/prices"
 
+    def _get(self, url_subpart, extra_headers=None, stream=False):
         url = self.url_base + url_subpart
 
         headers = {
@@ -66,12 +194,19 @@ class FuelPriceCheckAPI:
             'transactionid': FuelPriceCheckAPI.get_unique_transactionId(),
             'requesttimestamp': FuelPriceCheckAPI.get_datetime_now()
         }
+        if extra_headers:
+            headers.update(extra_headers)
 
-        time.sleep(5)
+        self.rate_limiter.wait()
 
-        response = requests.get(url, headers=headers)
+        return self.session.get(url, headers=headers, stream=stream)
 
-        return response
+
+    def getFuelPrice(self, stream=False):
+        '''
+        Returns all current fuel prices for all service stations. There may be restrictions on how often this API request can be made. It is recommended to execute this call in a separate api client as response can be over 2 mb. This API returns data for NSW. With stream=True the body is left unread for incremental parsing.
+        '''
+        return self._get("/FuelPriceCheck/v1/fuel/prices", stream=stream)
 
 
 
@@ -79,235 +214,467 @@ class FuelPriceCheckAPI:
         '''
         Returns all new current prices that have been submitted since the last "/fuelpricecheck/v1/fuel/prices" or "/fuelpricecheck/v1/fuel/prices/new" request using the apikey on the current day. This API returns data for NSW.
         '''
-        # Config url api prameters for getting fuel price
-        url_subpart = "/FuelPriceCheck/v1/fuel/prices/new"
+        return self._get("/FuelPriceCheck/v1/fuel/prices/new")
 
-        url = self.url_base + url_subpart
 
-        headers = {
-            'Authorization': f'Bearer {self.get_accesstoken()}',
-            'Content-Type': 'application/json; charset=utf-8',
-            'apikey': self.API_KEY,
-            'transactionid': FuelPriceCheckAPI.get_unique_transactionId(),
-            'requesttimestamp': FuelPriceCheckAPI.get_datetime_now()
-        }
+    def getFuelPriceReference(self, modified_since_datetime=None):
+        '''
+        Returns lists of reference data (brands, fuel types, stations, ...). With modified_since_datetime (UTC, dd/MM/yyyy hh:mm:ss AM/PM) the API answers 304 Not Modified when nothing changed since then.
+        '''
+        extra_headers = {'if-modified-since': modified_since_datetime} if modified_since_datetime else None
+        return self._get("/FuelCheckRefData/v1/fuel/lovs", extra_headers)
+
+
+    def close(self):
+        self.token_manager.close()
+        self.session.close()
+
+# Station Reference Cache Class Definition
+class StationCache:
+    '''
+    Local, disk-persisted copy of station reference data (name, address, brand, location) keyed by station code. It is refreshed only through conditional "if-modified-since" reference requests, and price deltas are enriched from it instead of relying on the stations sent with each payload. Prices for stations it doesn't know yet are held back and retried with every later payload.
+    '''
+    def __init__(self, fuelpriceAPI, cache_file=STATION_CACHE_FILE, force_interval=STATION_CACHE_FORCE_INTERVAL, max_held=STATION_CACHE_MAX_HELD):
+        self.fuelpriceAPI = fuelpriceAPI
+        self.cache_file = cache_file
+        self.force_interval = force_interval
+        self.max_held = max_held
+        self.stations = {} # Raw API station records keyed by station code
+        self.held = None # Price rows (PRICE_FIELDS) whose station code is not in the cache yet
+        self.last_modified = None # Time of the last successful reference request, in the API's datetime format
+        self._last_forced = None
+        self._frame = None # Stations DataFrame, rebuilt lazily after the cache changes
+        self.load()
+
+
+    def load(self):
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, encoding="utf-8") as f:
+                cached = json.load(f)
+            self.stations = cached.get("stations", {})
+            self.last_modified = cached.get("last_modified")
+            self._frame = None
+        except (OSError, ValueError) as e:
+            log.warning("station_cache_unreadable", file=self.cache_file, error=str(e))
+
+
+    def save(self):
+        if not self.cache_file:
+            return
+        # Write to a temporary file first so a crash never leaves a truncated cache behind
+        tmp_file = self.cache_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump({"last_modified": self.last_modified, "stations": self.stations}, f)
+        os.replace(tmp_file, self.cache_file)
+
+
+    def update(self, station_records):
+        # Merge station records (from a reference response or a price payload) into the cache
+        changed = False
+        for station in station_records:
+            code = str(station.get("code"))
+            if self.stations.get(code) != station:
+                self.stations[code] = station
+                changed = True
+        if changed:
+            self._frame = None
+        return changed
+
+
+    def refresh(self, force=False):
+        '''
+        Conditionally re-downloads the reference data. Returns True if the cache changed. force=True skips the if-modified-since header (used when a price references an unknown station), at most once per force_interval seconds. The reference API has no per-station lookup, so a forced refresh re-downloads every station.
+        '''
+        if force:
+            now = time.monotonic()
+            if self._last_forced is not None and now - self._last_forced < self.force_interval:
+                return False
+            self._last_forced = now
 
-        time.sleep(5)
+        requested_at = FuelPriceCheckAPI.get_datetime_now()
+        response = self.fuelpriceAPI.getFuelPriceReference(None if force or not self.stations else self.last_modified)
 
-        response = requests.get(url, headers=headers)
+        if response.status_code == 304:
+            self.last_modified = requested_at
+            self.save()
+            return False
+        response.raise_for_status()
 
-        return response
+        # Reference stations come wrapped as {"items": [...]}
+        stations = response.json().get("stations", {})
+        changed = self.update(stations.get("items", []) if isinstance(stations, dict) else stations)
+        self.last_modified = requested_at
+        self.save()
+        return changed
 
-# Data Retrieval, Integration, and Cleaning Functions
-def clean_and_display_fuel_data(df, column_width=70):
-    # Drop rows with missing critical information
-    df = df.dropna(subset=["ServiceStationName", "FuelCode", "PriceUpdatedDate", "Latitude", "Longitude", "Price"])
 
-    # Fill missing values in non-critical columns
-    df["Suburb"].fillna("Unknown", inplace=True)
-    df["Postcode"].fillna("Unknown", inplace=True)
+    def missing(self, station_codes):
+        return sorted(set(map(str, station_codes)) - self.stations.keys())
 
-    # Convert FuelCode and Brand to categorical
-    df["FuelCode"] = df["FuelCode"].astype("category")
-    df["Brand"] = df["Brand"].astype("category")
 
-    # Ensure Latitude, Longitude, and Price are numeric
-    df["Latitude"] = pd.to_numeric(df["Latitude"], errors='coerce')
-    df["Longitude"] = pd.to_numeric(df["Longitude"], errors='coerce')
-    df["Price"] = pd.to_numeric(df["Price"], errors='coerce')
+    def stations_frame(self):
+        if self._frame is None:
+            self._frame = build_stations_frame(self.stations.values())
+        return self._frame
 
-    # Remove invalid coordinates or prices
-    df = df[
-        (df["Price"] >= 0) &
-        (df["Latitude"].between(-90, 90)) &
-        (df["Longitude"].between(-180, 180))
-    ]
 
-    # Drop duplicate station-fuel-location combos
-    df = df.drop_duplicates(subset=["ServiceStationName", "FuelCode", "Latitude", "Longitude"], keep="first")
+    def enrich(self, data):
+        '''
+        Joins a price payload with cached station details. Stations included in the payload are merged into the cache first; codes still unknown trigger a forced (rate-limited, full) reference refresh. Prices whose station remains unknown are held back instead of dropped, and go through again with the first later payload after their station has arrived, from a payload or a refresh.
+        '''
+        if self.update(data.get("stations", [])):
+            self.save()
 
-    # Standardize text fields
-    df["Brand"] = df["Brand"].str.title()
-    df["Suburb"] = df["Suburb"].str.title()
-    df["FuelCode"] = df["FuelCode"].str.upper()
+        prices = pd.DataFrame(data.get("prices", []), columns=PRICE_FIELDS)
+        prices["stationcode"] = prices["stationcode"].astype(str)
+        if self.held is not None:
+            prices = pd.concat([self.held, prices], ignore_index=True) if len(prices) else self.held
+            self.held = None
 
-    return df  
+        missing = self.missing(prices["stationcode"])
+        if missing:
+            try:
+                self.refresh(force=True)
+            except requests.RequestException as e:
+                log.warning("station_refresh_failed", error=str(e))
+            missing = self.missing(missing)
+        if missing:
+            unresolved = prices["stationcode"].isin(missing).to_numpy()
+            self.held = prices[unresolved].tail(self.max_held)
+            prices = prices[~unresolved]
+            log.warning("unknown_stations_held", count=len(missing), prices=len(self.held), codes=",".join(missing[:10]))
 
-def fetch_and_save_fuel_data(fuelpriceAPI, output_file="integrated_fuel_data.csv", column_width=70):
-    # Step 1: Fetch data from the API
-    response = fuelpriceAPI.getFuelPrice()
-    data = response.json()
-
-    # Step 2: Create station mapping
-    station_map = {
-        station["code"]: {
-            "ServiceStationName": station.get("name"),
-            "Address": station.get("address"),
-            "Brand": station.get("brand"),
-            "Latitude": station.get("location", {}).get("latitude"),
-            "Longitude": station.get("location", {}).get("longitude")
-        }
-        for station in data.get("stations", [])
-    }
+        return normalize_fuel_data({"prices": prices}, stations=self.stations_frame())
 
-    # Step 3: Combine station info with prices
-    combined_data = []
-    for price_entry in data.get("prices", []):
-        station_code = price_entry.get("stationcode")
-        station_info = station_map.get(station_code)
 
-        if station_info:
-            full_address = station_info["Address"]
-            try:
-                parts = full_address.split(", ")
-                suburb_postcode = parts[-1].rsplit(" ", 2)
-                suburb = suburb_postcode[0]
-                postcode = suburb_postcode[-1]
-            except Exception:
-                suburb, postcode = None, None
-
-            combined_data.append({
-                "ServiceStationName": station_info["ServiceStationName"],
-                "Address": full_address,
-                "Suburb": suburb,
-                "Postcode": postcode,
-                "Brand": station_info["Brand"],
-                "FuelCode": price_entry.get("fueltype"),
-                "Price": price_entry.get("price"),
-                "PriceUpdatedDate": price_entry.get("lastupdated"),
-                "Latitude": station_info["Latitude"],
-                "Longitude": station_info["Longitude"]
-            })
-
-    # Step 4: Clean
-    df = pd.DataFrame(combined_data)
-    cleaned_df = clean_and_display_fuel_data(df)
-
-    # Step 5: Save to CSV
-    cleaned_df.to_csv(output_file, index=False)
-    # print(f"Saved: {output_file}")
+    def held_keys(self):
+        # (StationCode, FuelCode) of the held price rows: still current prices, only not enriched yet
+        if self.held is None:
+            return pd.DataFrame({"StationCode": pd.Series(dtype=str), "FuelCode": pd.Series(dtype=str)})
+        return pd.DataFrame({"StationCode": self.held["stationcode"].astype(str).to_numpy(), "FuelCode": self.held["fueltype"].astype(str).str.strip().str.upper().to_numpy()})
 
+# Data Retrieval, Integration, and Cleaning Functions
+def clean_and_display_fuel_data(df, column_width=70):
+    # Validate, type and deduplicate in one pass against the declared schema (see cleaning.FUEL_DATA_SCHEMA); the latest price per station, fuel and location wins
+    cleaned, rejected = clean_fuel_data(df)
+    for rule, count in rejected.items():
+        REJECTED_ROWS.inc(count, rule=rule)
+    if rejected:
+        log.info("rows_rejected", total=sum(rejected.values()), kept=len(cleaned), **rejected)
+    return cleaned
+
+def build_stations_frame(station_records):
+    # One row per station, with suburb/postcode parsed from the address
+    stations = pd.DataFrame.from_records(
+        (
+            (station.get("code"), station.get("name"), station.get("address"), station.get("brand"),
+             (station.get("location") or {}).get("latitude"), (station.get("location") or {}).get("longitude"))
+            for station in station_records
+        ),
+        columns=["StationCode", "ServiceStationName", "Address", "Brand", "Latitude", "Longitude"]
+    )
+
+    # Station codes arrive as either strings or integers depending on the endpoint
+    stations["StationCode"] = stations["StationCode"].astype(str)
+
+    # Parse "<street>, <Suburb> <STATE> <postcode>" addresses in one vectorized pass, once per station rather than once per price
+    suburb_postcode = stations["Address"].str.extract(ADDRESS_PATTERN, flags=re.IGNORECASE)
+    stations["Suburb"] = suburb_postcode["Suburb"]
+    stations["Postcode"] = suburb_postcode["Postcode"]
+
+    return stations
+
+def normalize_fuel_data(data, stations=None):
+    '''
+    Turns a "/prices" or "/prices/new" JSON payload into one row per price, joined with its station details. Stations and prices are loaded as columnar DataFrames and joined with a merge on station code, so no Python-level loop runs per price. A prebuilt stations frame (e.g. from StationCache) can be passed instead of the stations in the payload, and "prices" may already be a DataFrame (as from price_stream.parse_price_stream).
+    '''
+    if stations is None:
+        stations = build_stations_frame(data.get("stations", []))
+    prices = pd.DataFrame(
+        data.get("prices", []), columns=PRICE_FIELDS
+    ).rename(columns={"stationcode": "StationCode", "fueltype": "FuelCode", "price": "Price", "lastupdated": "PriceUpdatedDate"})
+    prices["StationCode"] = prices["StationCode"].astype(str)
+
+    # Prices for stations unknown to the stations frame are dropped
+    df = prices.merge(stations, on="StationCode", how="inner")
+
+    return df[FUEL_DATA_COLUMNS]
+
+def prepare_fuel_data(data, station_cache=None):
+    # Combine station info with prices (via the station cache when available), then clean
+    with STEP_SECONDS.time(step="normalize"):
+        if station_cache is not None:
+            df = station_cache.enrich(data)
+        else:
+            df = normalize_fuel_data(data)
+    with STEP_SECONDS.time(step="clean"):
+        return clean_and_display_fuel_data(df)
+
+def store_fuel_data(cleaned_df, store, full_snapshot=False, output_file=CSV_EXPORT_FILE, history=None):
+    # Upsert into the price store and record the prices in the time-series history, then optionally export the deduplicated snapshot to CSV
+    with STEP_SECONDS.time(step="store"):
+        store.upsert(cleaned_df, full_snapshot=full_snapshot)
+    if history is not None:
+        with STEP_SECONDS.time(step="history"):
+            history.append(cleaned_df)
+    if output_file:
+        with STEP_SECONDS.time(step="csv_export"):
+            store.export_csv(output_file)
+
+def fetch_price_snapshot(fuelpriceAPI):
+    # Full "/prices" payload, parsed while it downloads when STREAM_PRICE_SNAPSHOT is set
+    if STREAM_PRICE_SNAPSHOT:
+        return read_price_response(fuelpriceAPI.getFuelPrice(stream=True))
+    return fuelpriceAPI.getFuelPrice().json()
+
+def fetch_and_save_fuel_data(fuelpriceAPI, store, station_cache=None, output_file=CSV_EXPORT_FILE, column_width=70, history=None):
+    # Step 1: Fetch data from the API
+    data = fetch_price_snapshot(fuelpriceAPI)
 
-    return cleaned_df
+    # Step 2: Combine station info with prices and clean, keeping the station cache warm with the full station list
+    cleaned_df = prepare_fuel_data(data, station_cache)
 
-def update_fuel_data(fuelpriceAPI, existing_file="integrated_fuel_data.csv", output_file="integrated_fuel_data.csv"):
-    # Step 1: Load existing data
-    # existing_df = pd.read_csv(existing_file)
+    # Step 3: Store the full snapshot, then optionally export it to CSV
+    store_fuel_data(cleaned_df, store, full_snapshot=True, output_file=output_file, history=history)
 
-    # Step 2: Fetch new data, return early if no new data
+    return cleaned_df
+
+def update_fuel_data(fuelpriceAPI, store, station_cache=None, output_file=CSV_EXPORT_FILE, history=None):
+    # Step 1: Fetch new data, return early if no new data
     response = fuelpriceAPI.getNewFuelPrice()
     new_data_json = response.json()
-    if not new_data_json.get("stations", []):
+    if not new_data_json.get("prices", []):
         return pd.DataFrame()
 
-    # Step 3: Extract station mapping
-    station_map = {
-        station["code"]: {
-            "ServiceStationName": station.get("name"),
-            "Address": station.get("address"),
-            "Brand": station.get("brand"),
-            "Latitude": station.get("location", {}).get("latitude"),
-            "Longitude": station.get("location", {}).get("longitude")
-        }
-        for station in new_data_json.get("stations", [])
-    }
-
-    # Step 4: Extract new fuel prices (subset of full dataset)
-    new_price_rows = []
-    for price in new_data_json.get("prices", []):
-        station_code = price.get("stationcode")
-        station_info = station_map.get(station_code)
-        if station_info:
-            full_address = station_info["Address"]
-            try:
-                parts = full_address.split(", ")
-                suburb_postcode = parts[-1].rsplit(" ", 2)
-                suburb = suburb_postcode[0]
-                postcode = suburb_postcode[-1]
-            except Exception:
-                suburb, postcode = None, None
-
-            new_price_rows.append({
-                "ServiceStationName": station_info["ServiceStationName"],
-                "Address": full_address,
-                "Suburb": suburb,
-                "Postcode": postcode,
-                "Brand": station_info["Brand"],
-                "FuelCode": price.get("fueltype"),
-                "Latitude": station_info["Latitude"],
-                "Longitude": station_info["Longitude"],
-                "Price": price.get("price"),
-                "PriceUpdatedDate": price.get("lastupdated")
-            })
-
-    # Step 5: Clean
-    df = pd.DataFrame(new_price_rows)
-    cleaned_df = clean_and_display_fuel_data(df)
-
-    # Step 6: Save updated file
-    cleaned_df.to_csv(output_file, mode='a', header=False, index=False)
+    # Step 2: Combine station info with new fuel prices (subset of full dataset) and clean
+    cleaned_df = prepare_fuel_data(new_data_json, station_cache)
+
+    # Step 3: Upsert the new prices and append them to the history, then optionally re-export the deduplicated snapshot
+    store_fuel_data(cleaned_df, store, output_file=output_file, history=history)
 
     return cleaned_df
 
-# Data Publishing Function
-def publish_data(df):
-    # 1. Create client
-    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+# Change Detection Class Definition
+class ChangeDetector:
+    '''
+    Sits between cleaning and publishing and keeps only records whose price differs from the last one published for the same (StationCode, FuelCode). The last-published state lives in memory and is persisted in the price store, so a restart does not republish prices subscribers already hold. Records the broker did not acknowledge are held back with defer() and go out again with the next batch. Not thread-safe: the pipeline only uses it from the publish stage.
+    '''
+    KEYS = ["StationCode", "FuelCode"]
 
-    
-    # 2. Connect to broker
-    client.connect("172.17.34.107", 1883, keepalive=60)
-    
-    # 3. Start the network loop in a background thread
-    client.loop_start()
-    
-    # 4. Publish periodically
-    for row in df.itertuples():
-    
-        data = {
-            "Index": row.Index, 
-            "ServiceStationName": row.ServiceStationName,
-            "Address": row.Address, 
-            "Suburb": row.Suburb, 
-            "Postcode": row.Postcode, 
-            "Brand": row.Brand, 
-            "FuelCode": row.FuelCode, 
-            "Price": row.Price, 
-            "PriceUpdatedDate": row.PriceUpdatedDate, 
-            "Latitude": row.Latitude, 
-            "Longitude": row.Longitude
-        }
-    
-        client.publish("COMP5339/Assignment02/Group07/FuelPrice", json.dumps(data), qos=2)
-    
-        time.sleep(0.1)
-    
-    # 5. Clean up
-    client.loop_stop()
-    client.disconnect()
+    def __init__(self, store):
+        self.store = store
+        self.published = store.load_published().set_index(self.KEYS)
+        self.pending = None # Deferred records not yet acknowledged by the broker
+        self.initial = True # The next batch is the startup snapshot
 
-def main():
-    print("Start data stream")
+
+    def _keys(self, df):
+        return pd.MultiIndex.from_frame(df[self.KEYS].astype({"StationCode": str}))
+
+
+    def changes(self, df):
+        '''
+        Returns (changed_df, is_initial_snapshot). The initial snapshot is flagged so the caller knows unchanged records are already served by the broker's retained messages and must not be replayed. Deferred records come first, except where df holds a newer price for the same key.
+        '''
+        is_initial, self.initial = self.initial, False
+        pending, self.pending = self.pending, None
+        if df.empty:
+            return (df if pending is None else pending), is_initial
+
+        keys = self._keys(df)
+        previous = self.published["Price"].reindex(keys)
+        changed = previous.isna().to_numpy() | (previous.to_numpy() != df["Price"].to_numpy())
+        if pending is None:
+            return df[changed], is_initial
+        pending = pending[~self._keys(pending).isin(keys)]
+        return pd.concat([pending, df[changed]], ignore_index=True), is_initial
+
+
+    def removed(self, snapshot, held=None):
+        '''
+        Published (StationCode, FuelCode) keys missing from a full snapshot, whose retained messages the broker still serves, with each station's Postcode and StationGone (no price left in the snapshot). held lists the keys of snapshot prices the station cache held back (see StationCache.held_keys); they are still current and are not removed. Deferred records for removed keys are dropped.
+        '''
+        current = snapshot if held is None or held.empty else pd.concat([snapshot[self.KEYS], held], ignore_index=True)
+        gone = ~self.published.index.isin(self._keys(current))
+        removed = self.published.index[gone].to_frame(index=False)
+        if self.pending is not None:
+            self.pending = self.pending[~self._keys(self.pending).isin(self.published.index[gone])]
+        if removed.empty:
+            return removed.assign(Postcode=pd.Series(dtype=object), StationGone=pd.Series(dtype=bool))
+        postcodes = self.store.stations(removed["StationCode"].unique()).set_index("StationCode")["Postcode"]
+        return removed.assign(
+            Postcode=removed["StationCode"].map(postcodes),
+            StationGone=~removed["StationCode"].isin(current["StationCode"].astype(str)),
+        )
+
+
+    def forget(self, removed):
+        # Keys whose retained messages were deleted are no longer published
+        if removed.empty:
+            return
+        self.published = self.published[~self.published.index.isin(self._keys(removed))]
+        self.store.delete_published(removed)
+
+
+    def defer(self, df):
+        # Unacknowledged records are retried with the next batch; a later deferral of the same key replaces the earlier one
+        if df.empty:
+            return
+        if self.pending is not None:
+            kept = self.pending[~self._keys(self.pending).isin(self._keys(df))]
+            df = pd.concat([kept, df], ignore_index=True)
+        self.pending = df
+
+
+    def mark_published(self, df):
+        # Record successfully published prices in memory and in the store
+        if df.empty:
+            return
+        latest = df[self.KEYS + ["Price", "PriceUpdatedDate"]].astype({"StationCode": str}).drop_duplicates(subset=self.KEYS, keep="last").set_index(self.KEYS)
+        kept = self.published[~self.published.index.isin(latest.index)]
+        self.published = pd.concat([kept, latest]) if not kept.empty else latest
+        self.store.save_published(latest.reset_index())
+
+# Data Publishing Function
+def publish_data(df, publisher):
+    # Publish every row through the long-lived publisher and report throughput and ack latency
+    report = publisher.publish_dataframe(df)
+    if report["records"]:
+        log.info("published", records=report["records"], messages=report["messages"], messages_per_sec=report["messages_per_sec"],
+                 ack_ms_p50=report["ack_latency_ms_p50"], ack_ms_p95=report["ack_latency_ms_p95"])
+    if report["unacked"]:
+        log.warning("publish_unacked", messages=report["unacked"], records=int((~report["delivered"]).sum()), retrying=True)
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Poll the FuelCheck API, store the prices and publish changes over MQTT")
+    parser.add_argument("--csv-export", nargs="?", const=LEGACY_CSV_FILE, default=CSV_EXPORT_FILE, metavar="FILE", help=f"Also export the current snapshot as CSV every {CSV_EXPORT_INTERVAL} s and on shutdown (default file: {LEGACY_CSV_FILE})")
+    args = parser.parse_args(argv)
+    csv_file = args.csv_export
+
+    log.info("starting", api=API_BASE_URL, broker=f"{MQTT_BROKER_HOST}:{MQTT_BROKER_PORT}", poll_seconds=POLL_COOLDOWN)
+    metrics_server = start_metrics_server(METRICS_PORT) if METRICS_PORT else None
     # Construct API client class
-    fuelpriceAPI = FuelPriceCheckAPI(API_KEY, AuthorizationHeader)
-
-    # Retrieve and publish current price
-    print("Retrieving data from API\n")
-    cleaned_df = fetch_and_save_fuel_data(fuelpriceAPI)
-    print("Publishing data to MQTT Broker\n")
-    publish_data(cleaned_df)
-
-    # Periodically check and publish price updates
-    while(True):
-        print(f"Sleeping for {POLL_COOLDOWN} seconds\n")
-        time.sleep(POLL_COOLDOWN)
-        print("Retrieving data from API\n")
-        updated_df = update_fuel_data(fuelpriceAPI)
-        if updated_df.empty:
-            print("No updates to be published\n")
-        else:
-            print("Publishing data to MQTT Broker\n")
-            publish_data(updated_df)
+    fuelpriceAPI = FuelPriceCheckAPI(API_KEY, AuthorizationHeader, url_base=API_BASE_URL, min_request_interval=MIN_REQUEST_INTERVAL)
+
+    # Open the price store, importing the CSV written by earlier versions before it gets overwritten
+    store = PriceStore(PRICE_DB_FILE)
+    if store.is_empty() and os.path.exists(LEGACY_CSV_FILE):
+        log.info("migrating_csv", csv=LEGACY_CSV_FILE, db=PRICE_DB_FILE)
+        migrate_csv(LEGACY_CSV_FILE, store)
+    history = PriceHistory(PRICE_HISTORY_DIR) if PRICE_HISTORY_DIR else None
+
+    # Load the station cache from disk and refresh it only if the reference data changed
+    station_cache = StationCache(fuelpriceAPI)
+    try:
+        station_cache.refresh()
+    except requests.RequestException as e:
+        log.warning("station_refresh_failed", error=str(e), cached_stations=len(station_cache.stations))
+
+    # Connect the publisher once and keep the connection for the lifetime of the stream
+    publisher = FuelPricePublisher(host=MQTT_BROKER_HOST, port=MQTT_BROKER_PORT, qos=PUBLISH_QOS, pacing=PUBLISH_PACING, batch_size=PUBLISH_BATCH_SIZE, wire=WIRE_FORMAT, stamp_publish_time=STAMP_PUBLISH_TIME).start()
+    # Subscribers map their viewport to topic filters through the retained region index, which has to cover every known station even when the startup snapshot isn't republished
+    try:
+        publisher.publish_regions(store.current_snapshot())
+    except ConnectionError as e:
+        log.warning("region_index_not_published", error=str(e)) # Sent with the next published prices instead
+
+    # Only prices that differ from the last published ones are sent
+    change_detector = ChangeDetector(store)
+
+    # Pipeline stages: fetch -> normalize -> store -> publish, each in its own worker thread with bounded queues between them
+    snapshot_fetched = threading.Event()
+
+    def fetch(tick):
+        # The first successful poll takes the full snapshot, every later one only the new prices
+        if not snapshot_fetched.is_set():
+            log.info("fetching_snapshot")
+            with FETCH_SECONDS.time(endpoint="prices"):
+                data = fetch_price_snapshot(fuelpriceAPI)
+            POLL_RECORDS.observe(len(data.get("prices", [])), endpoint="prices")
+            snapshot_fetched.set()
+            return True, data
+        with FETCH_SECONDS.time(endpoint="prices_new"):
+            data = fuelpriceAPI.getNewFuelPrice().json()
+        POLL_RECORDS.observe(len(data.get("prices", [])), endpoint="prices_new")
+        if not data.get("prices", []):
+            if change_detector.pending is None:
+                log.debug("no_new_prices")
+                return None
+            log.debug("retrying_unacked", records=len(change_detector.pending)) # An empty poll still carries unacknowledged records to the publish stage
+        return False, data
+
+    def normalize(item):
+        # A full snapshot also carries the keys of prices held back for unknown stations, which must not count as removed
+        full_snapshot, data = item
+        cleaned_df = prepare_fuel_data(data, station_cache)
+        return full_snapshot, cleaned_df, station_cache.held_keys() if full_snapshot else None
+
+    next_csv_export = [0.0]
+
+    def save(item):
+        # Rewriting the whole CSV is as costly as the snapshot is large, so it happens at most every CSV_EXPORT_INTERVAL seconds
+        full_snapshot, cleaned_df, held = item
+        export = csv_file if csv_file and time.monotonic() >= next_csv_export[0] else None
+        store_fuel_data(cleaned_df, store, full_snapshot=full_snapshot, output_file=export, history=history)
+        if export:
+            next_csv_export[0] = time.monotonic() + CSV_EXPORT_INTERVAL
+        return full_snapshot, cleaned_df, held
+
+    def publish(item):
+        # The change detector is only used from this stage, so each diff sees every earlier batch's outcome. Only acknowledged records count as published; the rest are retried with the next batch.
+        full_snapshot, cleaned_df, held = item
+        removed = change_detector.removed(cleaned_df, held) if full_snapshot else None
+        changed_df, initial = change_detector.changes(cleaned_df)
+        if initial:
+            if REPUBLISH_SNAPSHOT:
+                changed_df = cleaned_df
+            log.info("initial_snapshot", changed=len(changed_df), prices=len(cleaned_df), removed=0 if removed is None else len(removed), republish=REPUBLISH_SNAPSHOT)
+        if changed_df.empty and (removed is None or removed.empty):
+            log.debug("no_changes", prices=len(cleaned_df))
+            return None
+        try:
+            if removed is not None and not removed.empty:
+                # Prices gone from the snapshot are deleted from the broker; unacknowledged deletions stay published and are retried with the next full snapshot
+                cleared, unacked = publisher.publish_removals(removed)
+                change_detector.forget(removed[cleared])
+                log.info("retained_prices_cleared", prices=int(cleared.sum()), stations=removed.loc[cleared & removed["StationGone"], "StationCode"].nunique(), unacked=unacked)
+            report = publish_data(changed_df, publisher)
+        except ConnectionError:
+            change_detector.defer(changed_df)
+            raise
+        delivered = report["delivered"]
+        change_detector.mark_published(changed_df[delivered])
+        change_detector.defer(changed_df[~delivered])
+        return changed_df
+
+    stream = Pipeline(fetch, [("normalize", normalize), ("store", save), ("publish", publish)], period=POLL_COOLDOWN, report_interval=PIPELINE_REPORT_INTERVAL)
+
+    async def run():
+        # Ctrl+C / SIGTERM stop polling; records already fetched are still stored and published
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stream.stop)
+            except (NotImplementedError, RuntimeError):
+                pass # Not supported on this platform, KeyboardInterrupt still ends the process
+        await stream.run()
+
+    try:
+        asyncio.run(run())
+    finally:
+        log.info("stopping")
+        publisher.stop()
+        fuelpriceAPI.close()
+        if csv_file:
+            log.info("csv_exported", csv=csv_file, prices=store.export_csv(csv_file))
+        store.close()
+        if history is not None:
+            history.close()
+        if metrics_server is not None:
+            metrics_server.shutdown()
 
 
 if __name__ == "__main__":
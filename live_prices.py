@@ -0,0 +1,140 @@
+# Import necessary libraries
+import threading
+import time
+from collections import deque
+
+from price_table import PriceTable, station_key
+from station_index import GridIndex
+
+# Constants
+PUBLISHED_HISTORY = 1000 # Versions whose publish times are kept for latency measurement
+
+
+# Coalescing Buffer Class Definition
+class CoalescingBuffer:
+    '''
+    Latest-value-wins buffer between the MQTT thread and the dashboard. Records are folded into a dict keyed by (station, fuel) as they arrive, so a newer price for the same station and fuel replaces the pending one instead of queueing behind it. The reader swaps the whole dict out in one step. Memory is bounded by the number of stations and fuels, not by the message backlog.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {} # (station key, fuel code) -> latest record not yet applied
+        self.received = 0 # Records handed to put()
+        self.coalesced = 0 # Records that replaced a pending record for the same station and fuel
+        self.applied = 0 # Records taken out by drain()
+
+
+    @staticmethod
+    def key(record):
+        return station_key(record), record.get("FuelCode")
+
+
+    def put(self, records):
+        with self._lock:
+            for record in records:
+                key = self.key(record)
+                if key in self._pending:
+                    self.coalesced += 1
+                self._pending[key] = record
+            self.received += len(records)
+
+
+    def drain(self):
+        # Swap in a fresh dict and hand back every pending change at once
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self.applied += len(pending)
+        return list(pending.values())
+
+
+    def __len__(self):
+        return len(self._pending)
+
+
+    def counters(self):
+        with self._lock:
+            return {"received": self.received, "coalesced": self.coalesced, "applied": self.applied, "pending": len(self._pending)}
+
+
+# Price Snapshot Class Definition
+class PriceSnapshot:
+    '''
+    Immutable view of the shared price state at one version: a PriceTable plus the spatial index over its station rows. Any number of sessions can read a snapshot without locking while the next one is being built.
+    '''
+    def __init__(self, version, table, index):
+        self.version = version
+        self.table = table
+        self.index = index # GridIndex over the table's station rows
+
+
+# Shared Price State Class Definition
+class SharedPriceState:
+    '''
+    Price state shared by every dashboard session in the process. One MQTT subscriber feeds the CoalescingBuffer; refresh() folds the pending updates into a new PriceSnapshot and bumps the version. The price table, spatial index and rendered markers exist once per process instead of once per browser session, and a new session gets the full current map from the latest snapshot straight away.
+    '''
+    def __init__(self, subscriptions=None):
+        self.buffer = CoalescingBuffer()
+        self.subscriptions = subscriptions # topics.TopicSubscriptions of the subscriber feeding the buffer, when it filters by fuel and region
+        if subscriptions is not None:
+            subscriptions.on_dropped = self.drop_prices
+        self.marker_cache = {} # station row -> ((table stamp, sparkline day) the rows were built for, {marker key: marker row, "popup": popup html})
+        self._lock = threading.Lock()
+        self._snapshot = PriceSnapshot(0, PriceTable(), GridIndex([], []))
+        self.last_applied = 0 # Updates folded in by the most recent refresh that found any
+        self.last_update = None # time.time() of the most recent refresh that found updates
+        self._published = deque(maxlen=PUBLISHED_HISTORY) # (version, oldest, newest publish time of the updates in that version)
+
+
+    def snapshot(self):
+        return self._snapshot
+
+
+    def refresh(self):
+        # Applies pending updates (if any) and returns the latest snapshot. Only one caller applies at a time; the others get the result.
+        with self._lock:
+            self._apply_pending()
+            return self._snapshot
+
+
+    def _apply_pending(self):
+        # Caller holds self._lock
+        updates = self.buffer.drain()
+        if not updates:
+            return
+        old = self._snapshot
+        table = old.table.apply(updates, old.version + 1)
+        # Only stations added since the last snapshot are indexed, and only stations whose location was corrected are re-filed
+        index = old.index if len(table) == len(old.table) else old.index.extend(table.latitude[len(old.table):len(table)], table.longitude[len(old.table):len(table)])
+        if len(table.moved):
+            index = index.move(table.moved, table.latitude[table.moved], table.longitude[table.moved])
+        self._snapshot = PriceSnapshot(old.version + 1, table, index)
+        self.last_applied = len(updates)
+        self.last_update = time.time()
+        published = [record["PublishedAt"] for record in updates if record.get("PublishedAt")]
+        if published:
+            self._published.append((self._snapshot.version, min(published), max(published)))
+
+
+    def drop_prices(self, fuel_code, keep):
+        # Called by the subscriptions when topics were unsubscribed: prices of the fuel outside the regions in "keep" stop updating, so they are cleared (after the updates already received) until the broker replays them on a later subscribe
+        with self._lock:
+            self._apply_pending()
+            old = self._snapshot
+            table = old.table.clear_outside(fuel_code, keep, old.version + 1)
+            self._snapshot = PriceSnapshot(old.version + 1, table, old.index)
+
+
+    def pending(self, since_version):
+        # Whether there is anything newer than since_version, applied or still waiting in the buffer
+        return self._snapshot.version != since_version or len(self.buffer) > 0
+
+
+    def published_range(self, after_version, up_to_version):
+        # (oldest, newest) publish time of the updates in versions (after_version, up_to_version], or None if unknown
+        ranges = [(oldest, newest) for version, oldest, newest in list(self._published) if after_version < version <= up_to_version]
+        if not ranges:
+            return None
+        return min(oldest for oldest, _ in ranges), max(newest for _, newest in ranges)
+
+
+    def counters(self):
+        return dict(self.buffer.counters(), version=self._snapshot.version, stations=len(self._snapshot.table))
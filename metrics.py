@@ -0,0 +1,378 @@
+# Import necessary libraries
+import bisect
+import cProfile
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Constants
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0) # Seconds
+COUNT_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000, 50000) # Records or markers
+RATE_BUCKETS = (1, 10, 50, 100, 200, 500, 1000, 5000, 10000, 50000) # Messages per second
+DEPTH_BUCKETS = (0, 1, 2, 4, 8, 16, 64, 256, 1024, 4096) # Items waiting in a queue or buffer
+METRICS_HOST = "127.0.0.1" # /metrics is only served locally; put a scraper or reverse proxy in front for anything else
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8" # Prometheus text exposition format
+PROFILE_STAGES = frozenset(filter(None, os.environ.get("FUEL_PROFILE_STAGES", "").split(","))) # Stages to profile, e.g. "fetch,normalize", or "*" for all
+PROFILER = os.environ.get("FUEL_PROFILER", "cprofile") # "cprofile" (.prof, for pstats/snakeviz) or "pyinstrument" (.html)
+PROFILE_DIR = "profiles"
+LOGGER_ROOT = "fuelprice" # Parent of every logger handed out by get_logger
+LOG_FORMAT = os.environ.get("FUEL_LOG_FORMAT", "logfmt") # "logfmt" or "json"
+LOG_LEVEL = os.environ.get("FUEL_LOG_LEVEL", "INFO")
+
+
+# Metric Class Definitions
+class Metric:
+    '''
+    Base of the metric types: a named, documented value per combination of label values, safe to update from any thread.
+    '''
+    kind = None
+
+    def __init__(self, name, help, labelnames=(), registry=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {} # Label values -> state
+        (REGISTRY if registry is None else registry).register(self)
+
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+
+    def _label_text(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape_label(value)}"' for name, value in pairs) + "}"
+
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, state in values:
+            lines.extend(self._samples(key, state))
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+    def _samples(self, key, state):
+        return [f"{self.name}{self._label_text(key)} {_number(state)}"]
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels))
+
+
+    def _samples(self, key, state):
+        return [f"{self.name}{self._label_text(key)} {_number(state)}"]
+
+
+class Histogram(Metric):
+    '''
+    Cumulative-bucket histogram (Prometheus semantics: a value lands in every bucket whose upper bound is >= it), plus the sum and count of all observations.
+    '''
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labelnames, registry)
+
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+
+    def time(self, **labels):
+        # Context manager observing the seconds spent in its block
+        return _Timer(self, labels)
+
+
+    def count(self, **labels):
+        state = self._values.get(self._key(labels))
+        return state[2] if state else 0
+
+
+    def _samples(self, key, state):
+        counts, total, count = state
+        lines, cumulative = [], 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            lines.append(f"{self.name}_bucket{self._label_text(key, [('le', _number(bound))])} {cumulative}")
+        lines.append(f"{self.name}_sum{self._label_text(key)} {_number(total)}")
+        lines.append(f"{self.name}_count{self._label_text(key)} {count}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.perf_counter() - self.started
+        self.histogram.observe(self.seconds, **self.labels)
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Registry Class Definition
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.metrics = {}
+
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self.metrics[metric.name] = metric
+
+
+    def render(self):
+        # Every metric in the Prometheus text exposition format
+        with self._lock:
+            metrics = list(self.metrics.values())
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+
+REGISTRY = Registry()
+
+
+#   Metrics Endpoint
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", METRICS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Scrapes every few seconds would flood the structured log
+
+
+def start_metrics_server(port, host=METRICS_HOST, registry=None):
+    '''
+    Serves the registry at http://host:port/metrics from a daemon thread. Returns the server (shutdown() stops it), or None when the port is taken, e.g. by a second dashboard process on the same machine.
+    '''
+    handler = type("MetricsHandler", (MetricsRequestHandler,), {"registry": REGISTRY if registry is None else registry})
+    try:
+        server = ThreadingHTTPServer((host, port), handler)
+    except OSError as e:
+        get_logger("metrics").warning("metrics_server_unavailable", host=host, port=port, error=str(e))
+        return None
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    get_logger("metrics").info("metrics_server_started", url=f"http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+#   Profiling Hook
+def profiling(name):
+    return name in PROFILE_STAGES or "*" in PROFILE_STAGES
+
+
+def start_profiler(name):
+    '''
+    Starts the configured profiler when stage "name" is selected in FUEL_PROFILE_STAGES. Returns a function that stops it and writes PROFILE_DIR/<name>-<time>.prof (or .html for pyinstrument), or None when the stage isn't profiled.
+    '''
+    if not profiling(name):
+        return None
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{time.perf_counter_ns() % 1_000_000:06d}")
+
+    if PROFILER == "pyinstrument":
+        from pyinstrument import Profiler # Optional; only needed when selected
+
+        profiler = Profiler()
+        profiler.start()
+
+        def stop():
+            profiler.stop()
+            with open(path + ".html", "w", encoding="utf-8") as f:
+                f.write(profiler.output_html())
+        return stop
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+    def stop():
+        profiler.disable()
+        profiler.dump_stats(path + ".prof")
+    return stop
+
+
+def profile_stage(name, func):
+    # Wraps func so every call is profiled when stage "name" is selected; returns func itself otherwise
+    if not profiling(name):
+        return func
+
+    @wraps(func)
+    def profiled(*args, **kwargs):
+        stop = start_profiler(name)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stop()
+    return profiled
+
+
+#   Structured Logging
+class StructuredFormatter(logging.Formatter):
+    '''
+    One line per record with the time, level, logger, event name and the record's key=value fields, as logfmt or as a JSON object.
+    '''
+    def __init__(self, output=LOG_FORMAT):
+        super().__init__()
+        self.output = output
+
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "event": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        if self.output == "json":
+            return json.dumps(entry, default=str)
+        return " ".join(f"{key}={_logfmt_value(value)}" for key, value in entry.items())
+
+
+def _logfmt_value(value):
+    if isinstance(value, float):
+        return f"{value:.6g}"
+    text = str(value)
+    if not text or any(char in text for char in ' ="\n\\'):
+        return json.dumps(text)
+    return text
+
+
+class EventLogger:
+    '''
+    Thin wrapper over a logging.Logger that takes an event name plus key=value fields, e.g. log.info("published", records=120, messages_per_sec=180.5).
+    '''
+    def __init__(self, logger):
+        self.logger = logger
+
+
+    def _log(self, level, event, fields, exc_info=False):
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, event, extra={"fields": fields}, exc_info=exc_info, stacklevel=3)
+
+
+    def debug(self, event, **fields):
+        self._log(logging.DEBUG, event, fields)
+
+
+    def info(self, event, **fields):
+        self._log(logging.INFO, event, fields)
+
+
+    def warning(self, event, **fields):
+        self._log(logging.WARNING, event, fields)
+
+
+    def error(self, event, **fields):
+        self._log(logging.ERROR, event, fields)
+
+
+    def exception(self, event, **fields):
+        self._log(logging.ERROR, event, fields, exc_info=True)
+
+
+def configure_logging(level=LOG_LEVEL, output=LOG_FORMAT):
+    # Installs the structured handler once; later calls (e.g. from every Streamlit rerun) are no-ops
+    root = logging.getLogger(LOGGER_ROOT)
+    if not root.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(StructuredFormatter(output))
+        root.addHandler(handler)
+        root.setLevel(level)
+        root.propagate = False # Keep our lines out of the host application's (e.g. Streamlit's) root handlers
+    return root
+
+
+def get_logger(name):
+    configure_logging()
+    return EventLogger(logging.getLogger(f"{LOGGER_ROOT}.{name}"))
+
+
+#   Pipeline Metrics
+FETCH_SECONDS = Histogram("fuelprice_api_fetch_seconds", "FuelCheck API request time, including reading and parsing the body", ["endpoint"])
+POLL_RECORDS = Histogram("fuelprice_poll_records", "Price records returned per poll", ["endpoint"], buckets=COUNT_BUCKETS)
+STEP_SECONDS = Histogram("fuelprice_step_seconds", "Time per processing step (normalize, clean, store, history, csv_export)", ["step"])
+REJECTED_ROWS = Counter("fuelprice_rejected_rows_total", "Price rows dropped by the cleaning step, by the first schema rule they failed", ["rule"])
+STAGE_SECONDS = Histogram("fuelprice_pipeline_stage_seconds", "Time per item in each pipeline stage", ["stage"])
+STAGE_ITEMS = Counter("fuelprice_pipeline_items_total", "Items handled by each pipeline stage, by outcome (processed, dropped, error)", ["stage", "outcome"])
+QUEUE_DEPTH = Histogram("fuelprice_pipeline_queue_depth", "Items waiting in front of a stage, sampled whenever one is queued", ["stage"], buckets=DEPTH_BUCKETS)
+TICKS_SKIPPED = Counter("fuelprice_pipeline_ticks_skipped_total", "Polls skipped because the pipeline was still busy")
+PUBLISH_RATE = Histogram("fuelprice_publish_messages_per_second", "MQTT messages per second over each publish call, pacing included", buckets=RATE_BUCKETS)
+PUBLISHED_MESSAGES = Counter("fuelprice_published_messages_total", "MQTT messages handed to the broker, by outcome (sent, failed)", ["outcome"])
+ACK_SECONDS = Histogram("fuelprice_broker_ack_seconds", "Publish-to-ack latency of MQTT messages")
+
+#   Dashboard Metrics
+RERUN_SECONDS = Histogram("fuelprice_dashboard_rerun_seconds", "Dashboard rerun time by phase (refresh, markers, render, total)", ["phase"])
+MARKERS_RENDERED = Histogram("fuelprice_dashboard_markers_rendered", "Map markers sent to the browser per rerun", buckets=COUNT_BUCKETS)
+MARKERS_REGENERATED = Counter("fuelprice_dashboard_markers_regenerated_total", "Marker rows rebuilt instead of taken from the marker cache")
+MQTT_DISCONNECTS = Counter("fuelprice_dashboard_mqtt_disconnects_total", "Times the dashboard's shared subscriber lost its broker connection")
+MESSAGES_RECEIVED = Counter("fuelprice_dashboard_messages_total", "MQTT messages received by the dashboard, by outcome (decoded, error)", ["outcome"])
+PENDING_UPDATES = Gauge("fuelprice_dashboard_pending_updates", "Decoded price updates waiting to be folded into the shared snapshot")
+TOPIC_FILTERS = Gauge("fuelprice_dashboard_topic_filters", "MQTT topic filters the shared subscriber holds for its sessions' fuels and regions")
+RESUBSCRIPTIONS = Counter("fuelprice_dashboard_resubscriptions_total", "Changes to the shared subscriber's topic filters")
+PUBLISH_TO_VISIBLE = Histogram("fuelprice_dashboard_publish_to_visible_seconds", "Time from publish to the update being on screen, oldest update per render")
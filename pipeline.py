@@ -0,0 +1,179 @@
+# Import necessary libraries
+import asyncio
+import time
+from collections import deque
+
+from metrics import QUEUE_DEPTH, STAGE_ITEMS, STAGE_SECONDS, TICKS_SKIPPED, get_logger, profile_stage
+
+# Constants
+DEFAULT_QUEUE_SIZE = 2 # Items buffered between two stages before the upstream stage has to wait
+LATENCY_WINDOW = 100 # Recent per-stage latencies kept for reporting
+_STOP = object() # Sentinel passed down the queues on shutdown
+
+log = get_logger("pipeline")
+
+
+# Stage Metrics Class Definition
+class StageMetrics:
+    def __init__(self, name):
+        self.name = name
+        self.processed = 0
+        self.dropped = 0 # Items the stage filtered out (returned None)
+        self.errors = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW) # Seconds per item
+        self.last_latency = None
+
+
+    def record(self, seconds):
+        self.processed += 1
+        self.last_latency = seconds
+        self.latencies.append(seconds)
+        STAGE_SECONDS.observe(seconds, stage=self.name)
+        STAGE_ITEMS.inc(stage=self.name, outcome="processed")
+
+
+    def record_dropped(self):
+        self.dropped += 1
+        STAGE_ITEMS.inc(stage=self.name, outcome="dropped")
+
+
+    def record_error(self):
+        self.errors += 1
+        STAGE_ITEMS.inc(stage=self.name, outcome="error")
+
+
+    def snapshot(self):
+        latencies = sorted(self.latencies)
+        return {
+            "processed": self.processed,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "last_s": self.last_latency,
+            "avg_s": sum(latencies) / len(latencies) if latencies else None,
+            "p95_s": latencies[int(len(latencies) * 0.95)] if latencies else None,
+            "max_s": latencies[-1] if latencies else None,
+        }
+
+
+# Pipeline Class Definition
+class Pipeline:
+    '''
+    Fixed-rate asyncio pipeline. A source callable runs on a fixed schedule (tick k starts at start + k * period, so slow downstream stages never make the schedule drift), and its results flow through a chain of stages connected by bounded queues. A full queue blocks the stage in front of it, which is the backpressure: when the pipeline falls behind, the source skips ticks instead of piling up work.
+
+    Source and stage callables are ordinary blocking functions and run in worker threads. A stage that returns None drops the item. stop() ends the schedule; every item already in flight is still processed before run() returns. Stages named in FUEL_PROFILE_STAGES ("source" for the source) run under the profiler, see metrics.profile_stage.
+    '''
+    def __init__(self, source, stages, period, queue_size=DEFAULT_QUEUE_SIZE, report_interval=None):
+        self.source = profile_stage("source", source) # source(tick) -> item or None
+        self.stages = [(name, profile_stage(name, func)) for name, func in stages] # [(name, func)] with func(item) -> item or None
+        self.period = period
+        self.report_interval = report_interval
+        self.queues = [asyncio.Queue(maxsize=queue_size) for _ in stages]
+        self.metrics = {name: StageMetrics(name) for name in ["source"] + [name for name, _ in stages]}
+        self.ticks_skipped = 0
+        self._stopping = asyncio.Event()
+
+
+    def stop(self):
+        self._stopping.set()
+
+
+    def snapshot(self):
+        # Per-stage latency/counter figures and current queue depths
+        return {
+            "stages": {name: metrics.snapshot() for name, metrics in self.metrics.items()},
+            "queue_depth": {name: queue.qsize() for (name, _), queue in zip(self.stages, self.queues)},
+            "ticks_skipped": self.ticks_skipped,
+        }
+
+
+    def format_snapshot(self):
+        snapshot = self.snapshot()
+        parts = []
+        for name, stage in snapshot["stages"].items():
+            latency = f"{stage['last_s'] * 1000:.0f}ms" if stage["last_s"] is not None else "-"
+            depth = snapshot["queue_depth"].get(name)
+            parts.append(f"{name}: n={stage['processed']} last={latency}" + (f" q={depth}" if depth is not None else ""))
+        return " | ".join(parts) + f" | skipped ticks={snapshot['ticks_skipped']}"
+
+
+    async def _run_source(self):
+        metrics = self.metrics["source"]
+        start = time.monotonic()
+        tick = 0
+        while not self._stopping.is_set():
+            began = time.perf_counter()
+            try:
+                item = await asyncio.to_thread(self.source, tick)
+            except Exception as e:
+                metrics.record_error()
+                log.error("source_failed", tick=tick, error=str(e))
+            else:
+                metrics.record(time.perf_counter() - began)
+                if item is None:
+                    metrics.record_dropped()
+                else:
+                    await self._put(0, item) # Blocks while the next stage is saturated
+
+            # Next tick on the fixed schedule; ticks already missed are skipped rather than run back to back
+            next_tick = int((time.monotonic() - start) / self.period) + 1
+            skipped = max(0, next_tick - tick - 1)
+            self.ticks_skipped += skipped
+            TICKS_SKIPPED.inc(skipped)
+            tick = next_tick
+            delay = start + tick * self.period - time.monotonic()
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=max(0.0, delay))
+            except asyncio.TimeoutError:
+                pass
+        await self.queues[0].put(_STOP)
+
+
+    async def _put(self, index, item):
+        await self.queues[index].put(item)
+        QUEUE_DEPTH.observe(self.queues[index].qsize(), stage=self.stages[index][0])
+
+
+    async def _run_stage(self, index):
+        name, func = self.stages[index]
+        metrics = self.metrics[name]
+        inbox = self.queues[index]
+        outbox = self.queues[index + 1] if index + 1 < len(self.queues) else None
+        while True:
+            item = await inbox.get()
+            if item is _STOP:
+                if outbox is not None:
+                    await outbox.put(_STOP)
+                return
+
+            began = time.perf_counter()
+            try:
+                result = await asyncio.to_thread(func, item)
+            except Exception as e:
+                metrics.record_error()
+                log.error("stage_failed", stage=name, error=str(e))
+                continue
+            metrics.record(time.perf_counter() - began)
+
+            if result is None:
+                metrics.record_dropped()
+            elif outbox is not None:
+                await self._put(index + 1, result)
+
+
+    async def _report(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=self.report_interval)
+            except asyncio.TimeoutError:
+                log.info("pipeline_report", summary=self.format_snapshot())
+
+
+    async def run(self):
+        tasks = [asyncio.create_task(self._run_source())]
+        tasks += [asyncio.create_task(self._run_stage(i)) for i in range(len(self.stages))]
+        reporter = asyncio.create_task(self._report()) if self.report_interval else None
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            if reporter is not None:
+                reporter.cancel()
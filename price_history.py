@@ -0,0 +1,328 @@
+# Import necessary libraries
+import argparse
+import glob
+import gzip
+import os
+import sqlite3
+import threading
+
+import numpy as np
+import pandas as pd
+
+from wire_format import PRICE_DATE_FORMAT
+
+# Constants
+DEFAULT_HISTORY_DIR = "price_history"
+ROLLUP_DB_FILE = "rollups.db" # Inside the history directory, next to the raw partitions
+RAW_COLUMNS = ["station_code", "fuel_code", "price", "updated_at", "suburb", "postcode"]
+GZIP_LEVEL = 6 # Each append adds one gzip member to the day's partition
+HOURLY_RETENTION_DAYS = 90 # Hourly area rollups older than this are dropped (daily ones and the raw partitions are kept), None to keep all
+
+# Timestamps are PriceUpdatedDate as epoch seconds (the wall-clock time read as UTC, like the wire format); hours and days count from the epoch
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS latest ( -- newest recorded observation per station and fuel, so re-fetched prices are not recorded twice
+    station_code TEXT NOT NULL,
+    fuel_code TEXT NOT NULL,
+    updated_at INTEGER NOT NULL,
+    PRIMARY KEY (station_code, fuel_code)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS areas (
+    area_id INTEGER PRIMARY KEY,
+    suburb TEXT NOT NULL,
+    postcode TEXT NOT NULL,
+    UNIQUE (suburb, postcode)
+);
+
+CREATE TABLE IF NOT EXISTS hourly_area ( -- price statistics per fuel, suburb/postcode and hour
+    fuel_code TEXT NOT NULL,
+    area_id INTEGER NOT NULL,
+    hour INTEGER NOT NULL,
+    min_price REAL,
+    max_price REAL,
+    sum_price REAL, -- sum and count rather than the average, so hours and areas can be combined
+    count INTEGER,
+    PRIMARY KEY (fuel_code, area_id, hour)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS daily_area ( -- the same per day, for long-range trends
+    fuel_code TEXT NOT NULL,
+    area_id INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    min_price REAL,
+    max_price REAL,
+    sum_price REAL,
+    count INTEGER,
+    PRIMARY KEY (fuel_code, area_id, day)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS daily_station ( -- open/min/max/close per station, fuel and day, for sparklines
+    station_code TEXT NOT NULL,
+    fuel_code TEXT NOT NULL,
+    day INTEGER NOT NULL,
+    open_price REAL,
+    open_at INTEGER,
+    close_price REAL,
+    close_at INTEGER,
+    min_price REAL,
+    max_price REAL,
+    count INTEGER,
+    PRIMARY KEY (station_code, fuel_code, day)
+) WITHOUT ROWID;
+"""
+
+UPSERT_AREA = """
+INSERT INTO {table} VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (fuel_code, area_id, {bucket}) DO UPDATE SET
+    min_price = MIN(min_price, excluded.min_price), max_price = MAX(max_price, excluded.max_price),
+    sum_price = sum_price + excluded.sum_price, count = count + excluded.count
+"""
+
+UPSERT_DAILY_STATION = """
+INSERT INTO daily_station VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (station_code, fuel_code, day) DO UPDATE SET
+    open_price = CASE WHEN excluded.open_at < open_at THEN excluded.open_price ELSE open_price END,
+    open_at = MIN(open_at, excluded.open_at),
+    close_price = CASE WHEN excluded.close_at >= close_at THEN excluded.close_price ELSE close_price END,
+    close_at = MAX(close_at, excluded.close_at),
+    min_price = MIN(min_price, excluded.min_price), max_price = MAX(max_price, excluded.max_price),
+    count = count + excluded.count
+"""
+
+UPSERT_LATEST = """
+INSERT INTO latest VALUES (?, ?, ?)
+ON CONFLICT (station_code, fuel_code) DO UPDATE SET updated_at = MAX(updated_at, excluded.updated_at)
+"""
+
+
+def epoch_seconds(value):
+    # Anything pd.Timestamp understands -> epoch seconds on the history's clock
+    return pd.Timestamp(value).value // 10**9
+
+
+# Price History Class Definition
+class PriceHistory:
+    '''
+    Time-series history of every recorded price. Raw observations go to append-only, gzip-compressed partitions with one file per day of PriceUpdatedDate (raw/YYYY-MM-DD.csv.gz); each append adds one gzip member, so nothing already written is rewritten. The same appends maintain downsampled rollups in an indexed SQLite file: min/avg/max per fuel and suburb/postcode by hour (for the last HOURLY_RETENTION_DAYS) and by day, and daily open/min/max/close per station and fuel. Trend and sparkline queries read only the rollups, never the raw history; rebuild_rollups() regenerates them from the partitions.
+    '''
+    def __init__(self, history_dir=DEFAULT_HISTORY_DIR, hourly_retention_days=HOURLY_RETENTION_DAYS):
+        self.history_dir = history_dir
+        self.raw_dir = os.path.join(history_dir, "raw")
+        os.makedirs(self.raw_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(history_dir, ROLLUP_DB_FILE), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self._area_ids = {} # (suburb, postcode) -> area_id, filled as areas are seen
+        self.hourly_retention_days = hourly_retention_days
+        self._pruned_day = None # Newest day hourly rollups were pruned for
+
+
+    def partition_path(self, day):
+        return os.path.join(self.raw_dir, f"{day}.csv.gz")
+
+
+    def append(self, df):
+        '''
+        Records cleaned price rows (the pipeline's DataFrame columns). Rows without a parseable PriceUpdatedDate are skipped, as are observations not newer than the one already recorded for the same station and fuel, so overlapping polls and full snapshots after a restart don't inflate the history.
+
+        Returns the number of observations recorded.
+        '''
+        if df.empty:
+            return 0
+        updated_at = pd.to_datetime(df["PriceUpdatedDate"], format=PRICE_DATE_FORMAT, errors="coerce")
+        records = pd.DataFrame({
+            "station_code": df["StationCode"].astype(str).to_numpy(),
+            "fuel_code": df["FuelCode"].astype(str).to_numpy(),
+            "price": pd.to_numeric(df["Price"], errors="coerce").to_numpy(),
+            "updated_at": updated_at.to_numpy().astype("datetime64[s]").astype(np.int64),
+            "suburb": df["Suburb"].astype(object).where(df["Suburb"].notna(), "").astype(str).to_numpy() if "Suburb" in df else "",
+            "postcode": df["Postcode"].astype(object).where(df["Postcode"].notna(), "").astype(str).to_numpy() if "Postcode" in df else "",
+        })
+        records = records[updated_at.notna().to_numpy() & records["price"].notna().to_numpy()]
+        records = records.sort_values("updated_at", kind="stable").drop_duplicates(subset=["station_code", "fuel_code", "updated_at"], keep="last")
+        if records.empty:
+            return 0
+
+        with self._lock, self.conn:
+            # Stage the batch, then keep only observations newer than the latest recorded one
+            self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS staged_history (position INTEGER, station_code TEXT, fuel_code TEXT, updated_at INTEGER)")
+            self.conn.execute("DELETE FROM staged_history")
+            self.conn.executemany("INSERT INTO staged_history VALUES (?, ?, ?, ?)", zip(range(len(records)), records["station_code"], records["fuel_code"], records["updated_at"].tolist()))
+            new_positions = [position for (position,) in self.conn.execute(
+                """SELECT s.position FROM staged_history s LEFT JOIN latest l
+                       ON l.station_code = s.station_code AND l.fuel_code = s.fuel_code
+                   WHERE l.updated_at IS NULL OR s.updated_at > l.updated_at"""
+            )]
+            records = records.iloc[sorted(new_positions)]
+            if records.empty:
+                return 0
+
+            # The raw partitions are written before the rollups commit, so the rollups never count an observation the archive lacks
+            self._write_partitions(records)
+            self._update_rollups(records)
+            self._prune_hourly(int(records["updated_at"].max()) // 86400)
+
+        return len(records)
+
+
+    def _write_partitions(self, records):
+        days = records["updated_at"].to_numpy() // 86400
+        for day in np.unique(days):
+            path = self.partition_path(np.datetime64(int(day), "D"))
+            write_header = not os.path.exists(path)
+            with gzip.open(path, "at", compresslevel=GZIP_LEVEL, newline="") as f:
+                records[days == day].to_csv(f, columns=RAW_COLUMNS, header=write_header, index=False)
+
+
+    def _resolve_areas(self, suburbs, postcodes):
+        # area_id of every (suburb, postcode) pair, registering new ones
+        pairs = list(zip(suburbs, postcodes))
+        unseen = set(pairs) - self._area_ids.keys()
+        if unseen:
+            self.conn.executemany("INSERT OR IGNORE INTO areas (suburb, postcode) VALUES (?, ?)", unseen)
+            self._area_ids.update(((suburb, postcode), area_id) for area_id, suburb, postcode in self.conn.execute("SELECT area_id, suburb, postcode FROM areas"))
+        return [self._area_ids[pair] for pair in pairs]
+
+
+    def _update_rollups(self, records):
+        # Aggregate the batch in pandas first, so the database sees one upsert per bucket rather than one per observation
+        updated_at = records["updated_at"].to_numpy()
+        records = records.assign(hour=updated_at // 3600, day=updated_at // 86400)
+
+        for table, bucket in (("hourly_area", "hour"), ("daily_area", "day")):
+            areas = records.groupby(["fuel_code", "suburb", "postcode", bucket], sort=False)["price"].agg(["min", "max", "sum", "count"]).reset_index()
+            areas.insert(1, "area_id", self._resolve_areas(areas.pop("suburb"), areas.pop("postcode")))
+            self.conn.executemany(UPSERT_AREA.format(table=table, bucket=bucket), areas.itertuples(index=False, name=None))
+
+        # Records are sorted by updated_at, so first/last are the day's open and close within the batch
+        daily = records.groupby(["station_code", "fuel_code", "day"], sort=False).agg(
+            open_price=("price", "first"), open_at=("updated_at", "first"),
+            close_price=("price", "last"), close_at=("updated_at", "last"),
+            min_price=("price", "min"), max_price=("price", "max"), count=("price", "count"),
+        ).reset_index()
+        self.conn.executemany(UPSERT_DAILY_STATION, daily.itertuples(index=False, name=None))
+
+        latest = records.groupby(["station_code", "fuel_code"], sort=False)["updated_at"].max().reset_index()
+        self.conn.executemany(UPSERT_LATEST, latest.itertuples(index=False, name=None))
+
+
+    def _prune_hourly(self, newest_day):
+        # Drops hourly rollups past the retention window, at most once per day of data
+        if self.hourly_retention_days is None or newest_day == self._pruned_day:
+            return
+        self.conn.execute("DELETE FROM hourly_area WHERE hour < ?", ((newest_day - self.hourly_retention_days) * 24,))
+        self._pruned_day = newest_day
+
+
+    def rebuild_rollups(self):
+        # Regenerates every rollup from the raw partitions, e.g. after a crash between a partition write and its rollup commit
+        with self._lock, self.conn:
+            for table in ("latest", "hourly_area", "daily_area", "daily_station", "areas"):
+                self.conn.execute(f"DELETE FROM {table}")
+            self._area_ids, self._pruned_day = {}, None
+            for day in self.days():
+                records = self.raw(day).sort_values("updated_at", kind="stable")
+                self._update_rollups(records)
+                self._prune_hourly(int(records["updated_at"].max()) // 86400)
+
+
+    #   Queries
+    def _read(self, query, params=()):
+        with self._lock:
+            return pd.read_sql_query(query, self.conn, params=params)
+
+
+    def days(self):
+        # Days (YYYY-MM-DD) with a raw partition, oldest first
+        return sorted(os.path.basename(path)[:-len(".csv.gz")] for path in glob.glob(os.path.join(self.raw_dir, "*.csv.gz")))
+
+
+    def raw(self, day):
+        # Every observation recorded for one day (YYYY-MM-DD); updated_at is in epoch seconds
+        path = self.partition_path(day)
+        if not os.path.exists(path):
+            return pd.DataFrame(columns=RAW_COLUMNS)
+        return pd.read_csv(path, dtype={"station_code": str, "fuel_code": str, "suburb": str, "postcode": str}, keep_default_na=False, na_values={"price": [""]})
+
+
+    def areas(self):
+        # Every (suburb, postcode) seen in the history
+        return self._read("SELECT suburb AS Suburb, postcode AS Postcode FROM areas ORDER BY suburb, postcode")
+
+
+    def area_trend(self, fuel_code, suburb=None, postcode=None, start=None, end=None, freq="hour"):
+        '''
+        Min/avg/max price of one fuel per hour (freq="hour", within the hourly retention window) or day (freq="day") with PriceUpdatedDate in [start, end), for a suburb, a postcode, both, or the whole state when neither is given. avg is the mean of the recorded prices.
+        '''
+        table, bucket, seconds, label = {
+            "hour": ("hourly_area", "hour", 3600, "strftime('%Y-%m-%dT%H:00', hour * 3600, 'unixepoch')"),
+            "day": ("daily_area", "day", 86400, "date(day * 86400, 'unixepoch')"),
+        }[freq]
+        conditions, params = ["fuel_code = ?"], [fuel_code]
+        if suburb is not None or postcode is not None:
+            area_conditions = []
+            if suburb is not None:
+                area_conditions.append("suburb = ?")
+                params.append(suburb)
+            if postcode is not None:
+                area_conditions.append("postcode = ?")
+                params.append(str(postcode))
+            conditions.append(f"area_id IN (SELECT area_id FROM areas WHERE {' AND '.join(area_conditions)})")
+        if start is not None:
+            conditions.append(f"{bucket} >= ?")
+            params.append(epoch_seconds(start) // seconds)
+        if end is not None:
+            conditions.append(f"{bucket} < ?")
+            params.append(-(-epoch_seconds(end) // seconds))
+        return self._read(
+            f"""SELECT {label} AS period, MIN(min_price) AS min, SUM(sum_price) / SUM(count) AS avg, MAX(max_price) AS max, SUM(count) AS count
+                FROM {table} WHERE {" AND ".join(conditions)} GROUP BY {bucket} ORDER BY {bucket}""",
+            params
+        )
+
+
+    def station_sparklines(self, station_codes, fuel_code=None, days=30, end=None):
+        '''
+        Daily open/min/max/close of each station's prices over the "days" days before end (default: tomorrow, i.e. including today), one row per station, fuel and day with at least one recorded price.
+        '''
+        station_codes = [str(code) for code in station_codes]
+        if not station_codes:
+            return pd.DataFrame(columns=["station_code", "fuel_code", "day", "open", "min", "max", "close"])
+        end_day = epoch_seconds(pd.Timestamp(end).normalize() if end is not None else pd.Timestamp.now().normalize() + pd.Timedelta(days=1)) // 86400
+
+        conditions = [f"station_code IN ({','.join('?' * len(station_codes))})", "day >= ?", "day < ?"]
+        params = station_codes + [end_day - days, end_day]
+        if fuel_code is not None:
+            conditions.append("fuel_code = ?")
+            params.append(fuel_code)
+        return self._read(
+            f"""SELECT station_code, fuel_code, date(day * 86400, 'unixepoch') AS day, open_price AS open, min_price AS min, max_price AS max, close_price AS close
+                FROM daily_station WHERE {" AND ".join(conditions)} ORDER BY station_code, fuel_code, day""",
+            params
+        )
+
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fuel price history utilities")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    rebuild_parser = subparsers.add_parser("rebuild", help="Regenerate the rollups from the raw partitions")
+    rebuild_parser.add_argument("--dir", default=DEFAULT_HISTORY_DIR)
+    args = parser.parse_args()
+
+    history = PriceHistory(args.dir)
+    try:
+        history.rebuild_rollups()
+        print(f"Rebuilt rollups from {len(history.days())} daily partitions in {args.dir}")
+    finally:
+        history.close()
+
+
+if __name__ == "__main__":
+    main()
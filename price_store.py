@@ -0,0 +1,308 @@
+# Import necessary libraries
+import argparse
+import os
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+import pandas as pd
+
+from wire_format import PRICE_DATE_FORMAT
+
+# Constants
+DEFAULT_DB_FILE = "fuel_prices.db"
+LEGACY_STATION_PREFIX = "legacy:" # Station codes synthesized for CSV rows that predate StationCode
+
+# DataFrame column -> table column, in the order the pipeline's DataFrames use
+STATION_COLUMNS = {
+    "StationCode": "station_code",
+    "ServiceStationName": "name",
+    "Address": "address",
+    "Suburb": "suburb",
+    "Postcode": "postcode",
+    "Brand": "brand",
+    "Latitude": "latitude",
+    "Longitude": "longitude",
+}
+PRICE_COLUMNS = {
+    "StationCode": "station_code",
+    "FuelCode": "fuel_code",
+    "Price": "price",
+    "PriceUpdatedDate": "price_updated_date",
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS stations (
+    station_code TEXT PRIMARY KEY,
+    name TEXT,
+    address TEXT,
+    suburb TEXT,
+    postcode TEXT,
+    brand TEXT,
+    latitude REAL,
+    longitude REAL
+);
+
+CREATE TABLE IF NOT EXISTS current_prices (
+    station_code TEXT NOT NULL,
+    fuel_code TEXT NOT NULL,
+    price REAL,
+    price_updated_date TEXT,
+    updated_at TEXT, -- ISO 8601 copy of price_updated_date, sortable for range queries
+    PRIMARY KEY (station_code, fuel_code)
+);
+CREATE INDEX IF NOT EXISTS idx_current_prices_fuel ON current_prices (fuel_code);
+
+CREATE TABLE IF NOT EXISTS price_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    station_code TEXT NOT NULL,
+    fuel_code TEXT NOT NULL,
+    price REAL,
+    price_updated_date TEXT,
+    updated_at TEXT,
+    recorded_at TEXT NOT NULL -- UTC time the change was stored
+);
+CREATE INDEX IF NOT EXISTS idx_price_history_station ON price_history (station_code, fuel_code, updated_at);
+CREATE INDEX IF NOT EXISTS idx_price_history_time ON price_history (updated_at);
+
+CREATE TABLE IF NOT EXISTS published_prices ( -- last price published to MQTT, used for change detection across restarts
+    station_code TEXT NOT NULL,
+    fuel_code TEXT NOT NULL,
+    price REAL,
+    price_updated_date TEXT,
+    PRIMARY KEY (station_code, fuel_code)
+);
+"""
+
+SELECT_PRICES = """
+SELECT s.station_code AS StationCode, s.name AS ServiceStationName, s.address AS Address,
+       s.suburb AS Suburb, s.postcode AS Postcode, s.brand AS Brand, p.fuel_code AS FuelCode,
+       p.price AS Price, p.price_updated_date AS PriceUpdatedDate, s.latitude AS Latitude, s.longitude AS Longitude
+FROM {table} p JOIN stations s ON s.station_code = p.station_code
+"""
+
+
+def _date_text(values):
+    # PriceUpdatedDate as the API's text (cleaned frames carry datetimes), with None for missing values
+    if pd.api.types.is_datetime64_any_dtype(values):
+        values = values.dt.strftime(PRICE_DATE_FORMAT)
+    return values.astype(object).where(values.notna(), None)
+
+
+# Price Store Class Definition
+class PriceStore:
+    '''
+    SQLite-backed fuel price store. current_prices holds the latest price per (station code, FuelCode) and is upserted on every poll, while price_history keeps one indexed row per actual price change. Snapshot, per-station and time-range reads all go through indexes instead of scanning a CSV.
+    '''
+    def __init__(self, db_file=DEFAULT_DB_FILE):
+        self.db_file = db_file
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+
+    def is_empty(self):
+        return self.conn.execute("SELECT NOT EXISTS (SELECT 1 FROM current_prices)").fetchone()[0] == 1
+
+
+    def upsert(self, df, full_snapshot=False):
+        '''
+        Upserts cleaned price rows and records every changed price in price_history. Older prices never overwrite newer ones. With full_snapshot=True the rows are treated as the complete current state, so prices missing from them are removed from current_prices (history keeps them).
+
+        Returns the number of price rows that changed.
+        '''
+        if df.empty and not full_snapshot:
+            return 0
+
+        stations = df[list(STATION_COLUMNS)].drop_duplicates(subset="StationCode", keep="last")
+        prices = df[list(PRICE_COLUMNS)]
+        updated_at = pd.to_datetime(prices["PriceUpdatedDate"], format=PRICE_DATE_FORMAT, errors="coerce").dt.strftime("%Y-%m-%dT%H:%M:%S")
+        recorded_at = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+
+        station_rows = stations.astype(object).where(stations.notna(), None).itertuples(index=False, name=None)
+        price_rows = zip(
+            prices["StationCode"].astype(str), prices["FuelCode"].astype(str),
+            prices["Price"].astype(float), _date_text(prices["PriceUpdatedDate"]),
+            updated_at.astype(object).where(updated_at.notna(), None)
+        )
+
+        with self._lock, self.conn:
+            self.conn.executemany(
+                """INSERT INTO stations VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (station_code) DO UPDATE SET
+                       name = excluded.name, address = excluded.address, suburb = excluded.suburb, postcode = excluded.postcode,
+                       brand = excluded.brand, latitude = excluded.latitude, longitude = excluded.longitude""",
+                station_rows
+            )
+
+            # Stage the batch so the change detection and upsert run as two set-based statements
+            self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS staged_prices (station_code TEXT, fuel_code TEXT, price REAL, price_updated_date TEXT, updated_at TEXT)")
+            self.conn.execute("DELETE FROM staged_prices")
+            self.conn.executemany("INSERT INTO staged_prices VALUES (?, ?, ?, ?, ?)", price_rows)
+
+            changed = self.conn.execute(
+                """INSERT INTO price_history (station_code, fuel_code, price, price_updated_date, updated_at, recorded_at)
+                   SELECT s.station_code, s.fuel_code, s.price, s.price_updated_date, s.updated_at, ?
+                   FROM staged_prices s LEFT JOIN current_prices c
+                       ON c.station_code = s.station_code AND c.fuel_code = s.fuel_code
+                   WHERE c.station_code IS NULL
+                      OR ((c.price IS NOT s.price OR c.price_updated_date IS NOT s.price_updated_date)
+                          AND IFNULL(s.updated_at, '') >= IFNULL(c.updated_at, ''))""",
+                (recorded_at,)
+            ).rowcount
+
+            self.conn.execute(
+                """INSERT INTO current_prices SELECT * FROM staged_prices WHERE true
+                   ON CONFLICT (station_code, fuel_code) DO UPDATE SET
+                       price = excluded.price, price_updated_date = excluded.price_updated_date, updated_at = excluded.updated_at
+                   WHERE IFNULL(excluded.updated_at, '') >= IFNULL(current_prices.updated_at, '')"""
+            )
+
+            if full_snapshot:
+                self.conn.execute(
+                    """DELETE FROM current_prices WHERE NOT EXISTS (
+                           SELECT 1 FROM staged_prices s
+                           WHERE s.station_code = current_prices.station_code AND s.fuel_code = current_prices.fuel_code)"""
+                )
+
+        return changed
+
+
+    def _read(self, query, params=()):
+        with self._lock:
+            return pd.read_sql_query(query, self.conn, params=params)
+
+
+    def current_snapshot(self, fuel_code=None):
+        # Latest price for every station, optionally limited to one fuel type
+        query = SELECT_PRICES.format(table="current_prices")
+        if fuel_code is None:
+            return self._read(query)
+        return self._read(query + " WHERE p.fuel_code = ?", (fuel_code,))
+
+
+    def station_prices(self, station_code):
+        # Latest price of every fuel at one station
+        return self._read(SELECT_PRICES.format(table="current_prices") + " WHERE p.station_code = ?", (str(station_code),))
+
+
+    def history(self, start=None, end=None, station_code=None, fuel_code=None):
+        '''
+        Price changes with PriceUpdatedDate in [start, end), optionally for one station and/or fuel. start and end accept anything pd.Timestamp understands.
+        '''
+        conditions, params = [], []
+        if station_code is not None:
+            conditions.append("p.station_code = ?")
+            params.append(str(station_code))
+        if fuel_code is not None:
+            conditions.append("p.fuel_code = ?")
+            params.append(fuel_code)
+        if start is not None:
+            conditions.append("p.updated_at >= ?")
+            params.append(pd.Timestamp(start).strftime("%Y-%m-%dT%H:%M:%S"))
+        if end is not None:
+            conditions.append("p.updated_at < ?")
+            params.append(pd.Timestamp(end).strftime("%Y-%m-%dT%H:%M:%S"))
+
+        query = SELECT_PRICES.format(table="price_history")
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        return self._read(query + " ORDER BY p.updated_at", params)
+
+
+    def load_published(self):
+        # Last published price per (StationCode, FuelCode)
+        return self._read("SELECT station_code AS StationCode, fuel_code AS FuelCode, price AS Price, price_updated_date AS PriceUpdatedDate FROM published_prices")
+
+
+    def stations(self, station_codes):
+        # Stored attributes of the given stations, whether or not they still have a current price
+        station_codes = [str(code) for code in station_codes]
+        columns = ", ".join(f"{column} AS {name}" for name, column in STATION_COLUMNS.items())
+        if not station_codes:
+            return pd.DataFrame(columns=list(STATION_COLUMNS))
+        return self._read(f"SELECT {columns} FROM stations WHERE station_code IN ({','.join('?' * len(station_codes))})", station_codes)
+
+
+    def delete_published(self, df):
+        # Forget the published price of each (StationCode, FuelCode) in df, once its retained message is deleted from the broker
+        rows = zip(df["StationCode"].astype(str), df["FuelCode"].astype(str))
+        with self._lock, self.conn:
+            self.conn.executemany("DELETE FROM published_prices WHERE station_code = ? AND fuel_code = ?", rows)
+
+
+    def save_published(self, df):
+        rows = zip(
+            df["StationCode"].astype(str), df["FuelCode"].astype(str), df["Price"].astype(float),
+            _date_text(df["PriceUpdatedDate"])
+        )
+        with self._lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO published_prices VALUES (?, ?, ?, ?)", rows)
+
+
+    def export_csv(self, output_file):
+        # Optional CSV export of the current snapshot, one row per station and fuel
+        df = self.current_snapshot()
+        df.to_csv(output_file, index=False)
+        return len(df)
+
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+
+# CSV Migration Function
+def migrate_csv(csv_file, store):
+    '''
+    Imports an existing integrated_fuel_data.csv into the store. Every row is replayed in PriceUpdatedDate order, so repeated appends become history entries and the newest price per station and fuel ends up in current_prices. Files written before StationCode existed get a synthetic code built from the station name and address.
+    '''
+    df = pd.read_csv(csv_file, dtype={"Postcode": str, "StationCode": str})
+    if df.empty:
+        return 0
+
+    if "StationCode" not in df.columns:
+        df["StationCode"] = LEGACY_STATION_PREFIX + df["ServiceStationName"].astype(str) + "|" + df["Address"].astype(str)
+
+    df["_updated_at"] = pd.to_datetime(df["PriceUpdatedDate"], format=PRICE_DATE_FORMAT, errors="coerce")
+    df = df.sort_values("_updated_at", kind="stable").drop(columns="_updated_at")
+
+    # Duplicated (station, fuel) rows are upserted in separate batches so each becomes its own history entry
+    imported = 0
+    batch_number = df.groupby(["StationCode", "FuelCode"]).cumcount()
+    for _, batch in df.groupby(batch_number, sort=True):
+        imported += store.upsert(batch)
+    return imported
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fuel price store utilities")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    migrate_parser = subparsers.add_parser("migrate", help="Import an existing CSV into the store")
+    migrate_parser.add_argument("csv_file", nargs="?", default="integrated_fuel_data.csv")
+    migrate_parser.add_argument("--db", default=DEFAULT_DB_FILE)
+
+    export_parser = subparsers.add_parser("export", help="Export the current snapshot as CSV")
+    export_parser.add_argument("csv_file", nargs="?", default="integrated_fuel_data.csv")
+    export_parser.add_argument("--db", default=DEFAULT_DB_FILE)
+
+    args = parser.parse_args()
+
+    if args.command == "migrate" and not os.path.exists(args.csv_file):
+        parser.error(f"{args.csv_file} does not exist")
+
+    store = PriceStore(args.db)
+    try:
+        if args.command == "migrate":
+            print(f"Imported {migrate_csv(args.csv_file, store)} price changes from {args.csv_file} into {args.db}")
+        else:
+            print(f"Exported {store.export_csv(args.csv_file)} rows from {args.db} to {args.csv_file}")
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
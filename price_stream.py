@@ -0,0 +1,194 @@
+# Import necessary libraries
+import codecs
+import json
+import re
+import sys
+
+import pandas as pd
+
+try:
+    import orjson # Optional faster decoder for item batches; json is used without it
+    loads = orjson.loads
+except ImportError:
+    orjson = None
+    loads = json.loads
+
+# Constants
+PRICE_FIELDS = ["stationcode", "fueltype", "price", "lastupdated"] # Price item fields kept, in normalize_fuel_data's column order
+STREAM_CHUNK_BYTES = 256 * 1024 # Bytes read from the response per iteration
+PRICE_CHUNK_ROWS = 50_000 # Price items collected in Python lists before they are packed into a DataFrame chunk
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+DECODER = json.JSONDecoder()
+
+
+# Columnar Price Builder Class Definition
+class PriceColumns:
+    '''
+    Collects price items field by field and packs them into DataFrame chunks every chunk_rows items, so the payload never exists as one list of dicts. Repeated strings (fuel codes, timestamps) are interned to share one object per distinct value.
+    '''
+    def __init__(self, chunk_rows=PRICE_CHUNK_ROWS):
+        self.chunk_rows = chunk_rows
+        self.chunks = []
+        self._columns = {field: [] for field in PRICE_FIELDS}
+
+
+    def extend(self, items):
+        columns = self._columns
+        columns["stationcode"].extend([item.get("stationcode") for item in items])
+        columns["fueltype"].extend([_intern(item.get("fueltype")) for item in items])
+        columns["price"].extend([item.get("price") for item in items])
+        columns["lastupdated"].extend([_intern(item.get("lastupdated")) for item in items])
+        if len(columns["price"]) >= self.chunk_rows:
+            self.flush()
+
+
+    def flush(self):
+        if self._columns["price"]:
+            chunk = pd.DataFrame(self._columns, columns=PRICE_FIELDS)
+            chunk["price"] = pd.to_numeric(chunk["price"], errors="coerce")
+            self.chunks.append(chunk)
+            self._columns = {field: [] for field in PRICE_FIELDS}
+
+
+    def frame(self):
+        self.flush()
+        if not self.chunks:
+            return pd.DataFrame(columns=PRICE_FIELDS)
+        return pd.concat(self.chunks, ignore_index=True) if len(self.chunks) > 1 else self.chunks[0]
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+#   Incremental Scanner
+class JsonStreamReader:
+    '''
+    Pull-based reader over an iterable of byte chunks that decodes one JSON value (or one batch of array items) at a time with a C decoder, keeping only the unconsumed tail of the input in memory.
+    '''
+    def __init__(self, chunks, encoding="utf-8"):
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder(encoding)()
+        self.buffer = ""
+        self.pos = 0
+        self.offset = 0 # Characters dropped from the front of the buffer so far
+        self.eof = False
+
+
+    def _fill(self):
+        # Appends the next chunk, dropping consumed text; False once the input is exhausted
+        if self.eof:
+            return False
+        chunk = next(self._chunks, None)
+        self.eof = chunk is None
+        self.offset += self.pos
+        self.buffer = self.buffer[self.pos:] + self._decoder.decode(chunk or b"", final=self.eof)
+        self.pos = 0
+        return True
+
+
+    def peek(self):
+        # Next non-whitespace character ("" at the end of the input), reading more as needed
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ""
+
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Expected {char!r} in JSON stream, found {found!r}")
+        self.pos += 1
+
+
+    def value(self):
+        # A value is only accepted when more input follows it, so a number cut at a chunk boundary is never taken as complete
+        self.peek()
+        while True:
+            try:
+                value, end = DECODER.raw_decode(self.buffer, self.pos)
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+
+    def array_items(self):
+        for batch in self.array_batches():
+            yield from batch
+
+
+    def array_batches(self):
+        '''
+        Yields the items of a JSON array in batches: every complete object item already buffered is decoded with one loads() call, the item cut at the chunk boundary is left for the next batch. Items that aren't objects, or a "}," inside a string that spoils a batch, fall back to one item at a time.
+        '''
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        batch_from = 0 # Stream offset up to which a batch already failed
+        while True:
+            batch = None
+            cut = self.buffer.rfind("},", self.pos)
+            if cut > self.pos and self.offset + cut >= batch_from:
+                try:
+                    batch = loads("[" + self.buffer[self.pos:cut + 1] + "]")
+                    self.pos = cut + 1
+                except ValueError:
+                    batch_from = self.offset + cut + 1
+            yield batch or [self.value()]
+            separator = self.peek()
+            self.pos += 1
+            if separator == "]":
+                return
+            if separator != ",":
+                raise ValueError(f"Expected ',' or ']' in JSON array, found {separator!r}")
+
+
+def _parse_stream(chunks, prices):
+    reader = JsonStreamReader(chunks)
+    data = {}
+    reader.expect("{")
+    if reader.peek() == "}":
+        return data
+    while True:
+        key = reader.value()
+        reader.expect(":")
+        if key == "prices" and reader.peek() == "[":
+            for batch in reader.array_batches():
+                prices.extend(batch)
+        elif key == "stations" and reader.peek() == "[":
+            data["stations"] = list(reader.array_items())
+        else:
+            data[key] = reader.value()
+        separator = reader.peek()
+        reader.pos += 1
+        if separator == "}":
+            return data
+        if separator != ",":
+            raise ValueError(f"Expected ',' or '}}' in JSON object, found {separator!r}")
+
+
+def parse_price_stream(chunks, chunk_rows=PRICE_CHUNK_ROWS):
+    '''
+    Incrementally parses a "/prices"-shaped JSON body from an iterable of byte chunks (e.g. response.iter_content() on a stream=True request). Returns the payload dict with "stations" as records and "prices" as one DataFrame built from columnar chunks, which normalize_fuel_data accepts in place of the list of price dicts.
+    '''
+    prices = PriceColumns(chunk_rows)
+    data = _parse_stream(chunks, prices)
+    data.setdefault("stations", [])
+    data["prices"] = prices.frame()
+    return data
+
+
+def read_price_response(response, chunk_bytes=STREAM_CHUNK_BYTES, **kwargs):
+    # Parses a stream=True response body as it downloads and releases the connection afterwards
+    try:
+        return parse_price_stream(response.iter_content(chunk_bytes), **kwargs)
+    finally:
+        response.close()
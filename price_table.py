@@ -0,0 +1,221 @@
+# Import necessary libraries
+from datetime import datetime, timezone
+from functools import lru_cache
+
+import numpy as np
+
+from topics import postcode_region
+from wire_format import FUEL_CODES, FUEL_CODE_IDS, PRICE_DATE_FORMAT, format_timestamp
+
+# Constants
+INITIAL_CAPACITY = 1024 # Station rows allocated up front; capacity doubles when it runs out
+BAND_COLOURS = ["#28a745", "#007bff", "#dc3545"] # Cheapest, middle and most expensive third of the selected fuel's prices
+
+
+@lru_cache(maxsize=65536)
+def parse_timestamp(text):
+    # PriceUpdatedDate text -> epoch seconds (0 when missing or malformed); inverse of wire_format.format_timestamp
+    if not text:
+        return 0
+    try:
+        return int(datetime.strptime(text, PRICE_DATE_FORMAT).replace(tzinfo=timezone.utc).timestamp())
+    except (TypeError, ValueError):
+        return 0
+
+
+def station_key(record):
+    # Interned station id: the FuelCheck station code, or name and address for records without one
+    return str(record.get("StationCode") or f"{record.get('ServiceStationName')}|{record.get('Address')}")
+
+
+# Price Table Class Definition
+class PriceTable:
+    '''
+    Columnar station and price store. Every station gets an interned row number; static attributes are append-only columns and prices live in station x FUEL_CODES matrices (price, updated timestamp, validity), so selecting the stations that sell a fuel, finding the cheapest ones or colouring by price band are single NumPy operations instead of walks over per-station objects.
+
+    Tables are treated as immutable once built: apply() returns a new table with its own copy of the price matrices. The station columns are shared and appended to beyond the row count of any older table; a record that corrects an existing station's attributes makes the new table copy them first. Older tables therefore stay valid while newer ones are built. apply() must only be called on the newest table.
+    '''
+    def __init__(self):
+        self.ids = {} # station key -> row
+        self.size = 0 # Rows in use; arrays below are allocated with spare capacity
+        self.keys = [] # row -> station key
+        self.name = []
+        self.address = []
+        self.brand = []
+        self.region = [] # Postcode region (see topics), which decides the topics a station's prices arrive on
+        self.latitude = np.empty(0)
+        self.longitude = np.empty(0)
+        self.price = np.empty((0, len(FUEL_CODES))) # NaN where the station has no price for the fuel
+        self.updated = np.zeros((0, len(FUEL_CODES)), dtype=np.uint32) # PriceUpdatedDate as epoch seconds, as on the wire
+        self.valid = np.zeros((0, len(FUEL_CODES)), dtype=bool)
+        self.stamp = np.zeros(0, dtype=np.int64) # Version in which each row last changed, for cache invalidation
+        self.moved = np.empty(0, dtype=np.int64) # Existing rows whose coordinates the apply() that built this table changed
+        self._owns_stations = True # Station columns are not shared with an older table
+
+
+    def __len__(self):
+        return self.size
+
+
+    def _copy_prices(self):
+        table = PriceTable.__new__(PriceTable)
+        table.__dict__.update(self.__dict__)
+        table.price = self.price.copy()
+        table.updated = self.updated.copy()
+        table.valid = self.valid.copy()
+        table.stamp = self.stamp.copy()
+        table.moved = np.empty(0, dtype=np.int64)
+        table._owns_stations = False
+        return table
+
+
+    def _reserve(self, size):
+        capacity = len(self.latitude)
+        if size <= capacity:
+            return
+        extra = max(size, 2 * capacity, INITIAL_CAPACITY) - capacity
+        self.latitude = np.concatenate([self.latitude, np.full(extra, np.nan)])
+        self.longitude = np.concatenate([self.longitude, np.full(extra, np.nan)])
+        self.price = np.concatenate([self.price, np.full((extra, len(FUEL_CODES)), np.nan)])
+        self.updated = np.concatenate([self.updated, np.zeros((extra, len(FUEL_CODES)), dtype=np.uint32)])
+        self.valid = np.concatenate([self.valid, np.zeros((extra, len(FUEL_CODES)), dtype=bool)])
+        self.stamp = np.concatenate([self.stamp, np.zeros(extra, dtype=np.int64)])
+
+
+    def _intern(self, key, record):
+        row = self.size
+        self._reserve(row + 1)
+        self.ids[key] = row
+        self.keys.append(key)
+        self.name.append(record.get("ServiceStationName"))
+        self.address.append(record.get("Address"))
+        self.brand.append(record.get("Brand"))
+        self.region.append(postcode_region(record.get("Postcode")))
+        self.latitude[row] = record.get("Latitude")
+        self.longitude[row] = record.get("Longitude")
+        self.size += 1
+        return row
+
+
+    def _update(self, row, record):
+        # Overwrites the station's attributes where record differs from them; returns (changed, moved)
+        attributes = (record.get("ServiceStationName"), record.get("Address"), record.get("Brand"), postcode_region(record.get("Postcode")))
+        latitude, longitude = float(record["Latitude"]), float(record["Longitude"])
+        moved = latitude != self.latitude[row] or longitude != self.longitude[row]
+        if not moved and attributes == (self.name[row], self.address[row], self.brand[row], self.region[row]):
+            return False, False
+        if not self._owns_stations:
+            # Older tables keep reading the columns as they were
+            self.name, self.address, self.brand, self.region = list(self.name), list(self.address), list(self.brand), list(self.region)
+            self.latitude, self.longitude = self.latitude.copy(), self.longitude.copy()
+            self._owns_stations = True
+        self.name[row], self.address[row], self.brand[row], self.region[row] = attributes
+        self.latitude[row], self.longitude[row] = latitude, longitude
+        return True, moved
+
+
+    def apply(self, records, version):
+        '''
+        Returns a new table with the records applied (latest record wins per station and fuel). Station attributes in a record overwrite the ones held for its station, so corrected names, brands or locations show up; rows whose coordinates changed are listed in the new table's "moved". Rows touched get stamp = version. Records without station name, address or location are skipped, as are prices for fuel codes outside FUEL_CODES; records flagged "Removed" clear the price of their station and fuel instead.
+        '''
+        table = self._copy_prices()
+        rows, fuels, prices, updated = [], [], [], []
+        moved = set()
+        for record in records:
+            # A removed price carries only its station and fuel
+            if record.get("Removed"):
+                row, fuel = table.ids.get(station_key(record)), FUEL_CODE_IDS.get(record.get("FuelCode"))
+                if row is not None and fuel is not None:
+                    table.price[row, fuel] = np.nan
+                    table.valid[row, fuel] = False
+                    table.stamp[row] = version
+                continue
+            # Skip processing if essential station identification or location data is missing.
+            if not (record.get("ServiceStationName") and record.get("Address") and record.get("Latitude") is not None and record.get("Longitude") is not None):
+                continue
+            key = station_key(record)
+            row = table.ids.get(key)
+            if row is None:
+                row = table._intern(key, record)
+                table.stamp[row] = version
+            else:
+                changed, row_moved = table._update(row, record)
+                if changed:
+                    table.stamp[row] = version
+                if row_moved and row < self.size:
+                    moved.add(row)
+
+            fuel = FUEL_CODE_IDS.get(record.get("FuelCode"))
+            if fuel is not None and record.get("Price") is not None:
+                rows.append(row)
+                fuels.append(fuel)
+                prices.append(record["Price"])
+                updated.append(parse_timestamp(record.get("PriceUpdatedDate")))
+
+        if rows:
+            table.price[rows, fuels] = prices
+            table.updated[rows, fuels] = updated
+            table.valid[rows, fuels] = True
+            table.stamp[rows] = version
+        table.moved = np.array(sorted(moved), dtype=np.int64)
+        return table
+
+
+    def clear_outside(self, fuel_code, regions, version):
+        # Returns a new table without the fuel's prices at stations outside "regions", e.g. after their topics were unsubscribed; rows cleared get stamp = version
+        table = self._copy_prices()
+        fuel = FUEL_CODE_IDS[fuel_code]
+        outside = np.fromiter((region not in regions for region in self.region), dtype=bool, count=self.size)
+        rows = np.flatnonzero(outside & self.valid[:self.size, fuel])
+        table.price[rows, fuel] = np.nan
+        table.valid[rows, fuel] = False
+        table.stamp[rows] = version
+        return table
+
+
+    #   Vectorized Queries
+    def prices(self, fuel_code):
+        # Price of one fuel for every station row (NaN where missing)
+        return self.price[:self.size, FUEL_CODE_IDS[fuel_code]]
+
+
+    def select(self, fuel_code, rows=None):
+        # Rows (optionally limited to "rows") that have a valid price for the fuel
+        valid = self.valid[:self.size, FUEL_CODE_IDS[fuel_code]]
+        if rows is None:
+            return np.flatnonzero(valid)
+        rows = np.asarray(rows, dtype=np.int64)
+        return rows[valid[rows]]
+
+
+    def cheapest(self, fuel_code, n, rows=None):
+        # Up to n rows with the lowest price for the fuel, cheapest first
+        rows = self.select(fuel_code, rows)
+        prices = self.prices(fuel_code)[rows]
+        if len(rows) > n:
+            keep = np.argpartition(prices, n)[:n]
+            rows, prices = rows[keep], prices[keep]
+        return rows[np.argsort(prices, kind="stable")]
+
+
+    def band_thresholds(self, fuel_code, bands=len(BAND_COLOURS)):
+        # Price boundaries splitting all valid prices of the fuel into equally sized bands
+        prices = self.prices(fuel_code)[self.select(fuel_code)]
+        if len(prices) == 0:
+            return np.empty(0)
+        return np.quantile(prices, np.arange(1, bands) / bands)
+
+
+    def price_bands(self, fuel_code, rows, thresholds=None):
+        # Band index (0 = cheapest) of each row's price for the fuel
+        thresholds = self.band_thresholds(fuel_code) if thresholds is None else thresholds
+        return np.searchsorted(thresholds, self.prices(fuel_code)[rows], side="right")
+
+
+    def station_prices(self, row):
+        # [(fuel code, price, PriceUpdatedDate text)] for every fuel the station has a price for, for popups
+        return [
+            (FUEL_CODES[fuel], float(self.price[row, fuel]), format_timestamp(int(self.updated[row, fuel])))
+            for fuel in np.flatnonzero(self.valid[row])
+        ]
+
@@ -0,0 +1,380 @@
+# Import necessary libraries
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+import pandas as pd
+import paho.mqtt.client as mqtt
+
+import topics
+import wire_format
+from metrics import ACK_SECONDS, PUBLISH_RATE, PUBLISHED_MESSAGES, get_logger
+
+# Constants
+MQTT_BROKER_HOST = os.environ.get("MQTT_BROKER_HOST", "172.17.34.107") # Override to point the pipeline and dashboard at a local broker
+MQTT_BROKER_PORT = int(os.environ.get("MQTT_BROKER_PORT", 1883))
+MQTT_TOPIC = "COMP5339/Assignment02/Group07/FuelPrice"
+PUBLISH_COLUMNS = ["StationCode", "ServiceStationName", "Address", "Suburb", "Postcode", "Brand", "FuelCode", "Price", "PriceUpdatedDate", "Latitude", "Longitude"]
+MAX_INFLIGHT = 100 # Unacknowledged messages allowed on the wire before publish() blocks
+CONNECT_TIMEOUT = 30 # Seconds to wait for the broker before giving up on a publish
+LATENCY_SAMPLES = 10000 # Recent publish-to-ack latencies kept for percentile reporting
+NO_ROWS = np.empty(0, dtype=np.intp) # Rows carried by a message that holds no prices
+
+log = get_logger("publisher")
+
+
+# Pacing Policy Class Definition
+class PacingPolicy:
+    '''
+    Token bucket that paces outgoing messages. Tokens refill at "rate" per second up to "burst"; each message consumes one. A rate of None means unthrottled.
+    '''
+    def __init__(self, rate=None, burst=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._last_refill = time.monotonic()
+
+
+    @classmethod
+    def fixed_delay(cls, delay):
+        # One message every "delay" seconds, like the original time.sleep(0.1) between publishes
+        return cls(rate=1.0 / delay, burst=1) if delay > 0 else cls.unthrottled()
+
+
+    @classmethod
+    def per_second(cls, rate, burst=None):
+        return cls(rate=rate, burst=burst if burst is not None else max(1, int(rate // 10)))
+
+
+    @classmethod
+    def unthrottled(cls):
+        return cls(rate=None)
+
+
+    def acquire(self):
+        if self.rate is None:
+            return
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+            self._last_refill = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            time.sleep((1 - self._tokens) / self.rate)
+
+
+    def __repr__(self):
+        if self.rate is None:
+            return "PacingPolicy.unthrottled()"
+        return f"PacingPolicy(rate={self.rate:g}, burst={self.burst})"
+
+
+# Fuel Price Publisher Class Definition
+class FuelPricePublisher:
+    '''
+    Long-lived MQTT publisher. It keeps one connection open (paho reconnects automatically), bounds the number of unacknowledged messages, paces sends with a PacingPolicy and can pack many records into one message. DataFrames are serialized to JSON in a single vectorized pass.
+
+    Topics are sharded by fuel and postcode region (see topics) so subscribers can filter on the broker. Single-record messages go to "<topic>/<FuelCode>/<region>/<StationCode>" as retained messages when retain_latest is set, so the broker holds the last value per station and fuel and new subscribers get the current state of the shards they subscribe to without a replay. Batched messages go to "<topic>/<FuelCode>/<region>", one batch per fuel and region, and are never retained. The bounding box of every region is kept on the retained "<topic>/Regions" topic.
+
+    Prices that leave the snapshot are deleted from the broker with empty retained messages (see removal_messages).
+
+    With wire="json" every message is a JSON object (or array, when batched) carrying all station attributes. With wire="binary" (see wire_format) static station attributes are sent once on a retained "<topic>/Station/<region>/<StationCode>" topic and price messages carry only station id, fuel enum, price and timestamp; rows the binary format cannot represent fall back to JSON. With stamp_publish_time, binary price messages also carry the time they were handed to the broker, so subscribers can measure publish-to-display latency.
+    '''
+    def __init__(self, host=MQTT_BROKER_HOST, port=MQTT_BROKER_PORT, topic=MQTT_TOPIC, qos=1, pacing=None, batch_size=1, max_inflight=MAX_INFLIGHT, keepalive=60, client_id="", retain_latest=True, wire="json", stamp_publish_time=False):
+        self.host = host
+        self.port = port
+        self.topic = topic
+        self.qos = qos
+        self.pacing = pacing if pacing is not None else PacingPolicy.unthrottled()
+        self.batch_size = max(1, batch_size)
+        self.keepalive = keepalive
+        self.retain_latest = retain_latest
+        self.wire = wire
+        self.stamp_publish_time = stamp_publish_time
+        self._stations_sent = {} # Station topic -> last station message published this session
+        self.regions = topics.RegionIndex() # Bounding box per postcode region of every station published this session
+        self._regions_sent = False
+
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=client_id)
+        self.client.max_inflight_messages_set(max_inflight)
+        self.client.reconnect_delay_set(min_delay=1, max_delay=30)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_publish = self._on_publish
+
+        self._connected = threading.Event()
+        self._window = threading.BoundedSemaphore(max_inflight)
+        self._lock = threading.Lock()
+        self._sent_at = {} # mid -> send time, for messages still waiting for their ack
+        self._early_acks = {} # mid -> ack time, for acks that arrived before publish() returned
+        self._all_acked = threading.Condition(self._lock)
+        self.latencies = deque(maxlen=LATENCY_SAMPLES) # Publish-to-ack latency in seconds
+        self.messages_sent = 0
+        self.messages_acked = 0
+        self.messages_failed = 0
+
+
+    #   Connection Management
+    def start(self, timeout=CONNECT_TIMEOUT):
+        self.client.connect_async(self.host, self.port, keepalive=self.keepalive)
+        self.client.loop_start()
+        if not self._connected.wait(timeout):
+            log.warning("broker_unreachable", host=self.host, port=self.port, retrying=True)
+        return self
+
+
+    def stop(self, timeout=CONNECT_TIMEOUT):
+        self.flush(timeout)
+        self.client.disconnect()
+        self.client.loop_stop()
+
+
+    def __enter__(self):
+        return self.start()
+
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+    def _on_connect(self, client, userdata, connect_flags, reason_code, properties):
+        if reason_code == 0:
+            self._connected.set()
+        else:
+            log.error("bad_connection", host=self.host, port=self.port, reason_code=str(reason_code))
+
+
+    def _on_disconnect(self, client, userdata, disconnect_flags, reason_code, properties):
+        self._connected.clear()
+        if reason_code != 0:
+            log.warning("disconnected", host=self.host, port=self.port, reason_code=str(reason_code), reconnecting=True)
+
+
+    def _on_publish(self, client, userdata, mid, reason_code, properties):
+        now = time.perf_counter()
+        with self._lock:
+            sent_at = self._sent_at.pop(mid, None)
+            if sent_at is None:
+                self._early_acks[mid] = now
+                return
+            self._record_ack(now - sent_at)
+
+
+    def _record_ack(self, latency):
+        # Caller holds self._lock
+        self.latencies.append(latency)
+        ACK_SECONDS.observe(latency)
+        self.messages_acked += 1
+        self._window.release()
+        if not self._sent_at:
+            self._all_acked.notify_all()
+
+
+    #   Publishing
+    def serialize(self, df):
+        # One JSON document per record, produced by a single vectorized to_json call
+        if df.empty:
+            return []
+        columns = [column for column in PUBLISH_COLUMNS if column in df.columns]
+        records = df[columns]
+        if "PriceUpdatedDate" in records and pd.api.types.is_datetime64_any_dtype(records["PriceUpdatedDate"]):
+            # Subscribers expect the API's timestamp text, not ISO dates
+            records = records.assign(PriceUpdatedDate=records["PriceUpdatedDate"].dt.strftime(wire_format.PRICE_DATE_FORMAT))
+        return records.to_json(orient="records", lines=True, date_format="iso").splitlines()
+
+
+    def publish_payload(self, payload, topic=None, retain=False):
+        # Wait for a slot in the in-flight window and a pacing token, then hand the message to paho
+        self.pacing.acquire()
+        self._window.acquire()
+        if not self._connected.wait(CONNECT_TIMEOUT):
+            self._window.release()
+            raise ConnectionError(f"MQTT broker {self.host}:{self.port} unavailable")
+
+        if self.stamp_publish_time:
+            payload = wire_format.stamp_published(payload)
+        sent_at = time.perf_counter()
+        info = self.client.publish(topic or self.topic, payload, qos=self.qos, retain=retain)
+
+        with self._lock:
+            self.messages_sent += 1
+            if self._dropped(info):
+                self.messages_failed += 1
+                PUBLISHED_MESSAGES.inc(outcome="failed")
+                self._early_acks.pop(info.mid, None)
+                self._window.release()
+            else:
+                PUBLISHED_MESSAGES.inc(outcome="sent")
+                if info.mid in self._early_acks:
+                    self._record_ack(self._early_acks.pop(info.mid) - sent_at)
+                else:
+                    self._sent_at[info.mid] = sent_at
+        return info
+
+
+    def _dropped(self, info):
+        # QoS 0 messages are dropped while disconnected; QoS 1/2 ones stay queued in paho and are resent
+        return info.rc != mqtt.MQTT_ERR_SUCCESS and (self.qos == 0 or info.rc != mqtt.MQTT_ERR_NO_CONN)
+
+
+    def flush(self, timeout=CONNECT_TIMEOUT):
+        # Block until every message handed to paho has been acknowledged
+        with self._lock:
+            return self._all_acked.wait_for(lambda: not self._sent_at, timeout)
+
+
+    def station_messages(self, df, regions, positions):
+        # Retained station attribute messages for stations not yet sent this session (or whose attributes changed). Each carries the positions of its station's price rows, which subscribers can't show without it.
+        messages = []
+        latest = ~df["StationCode"].duplicated(keep="last").to_numpy()
+        station_rows = df.groupby(df["StationCode"].astype(str), sort=False).indices
+        for station, region in zip(df[latest].to_dict("records"), regions[latest]):
+            code = str(station["StationCode"])
+            topic = topics.station_topic(self.topic, region, code)
+            payload = wire_format.encode_station(station)
+            if self._stations_sent.get(topic) != payload:
+                self._stations_sent[topic] = payload
+                messages.append((topic, payload, True, positions[station_rows[code]]))
+        return messages
+
+
+    def price_messages(self, df, regions, encode, positions):
+        # (topic, payload, retain, rows) tuples, rows being the positions of the records a message carries: one retained message per station and fuel, or unretained batches per fuel and region
+        if df.empty:
+            return []
+        if self.batch_size == 1 and self.retain_latest:
+            return [(topic, payload, True, positions[i:i + 1]) for i, (topic, payload) in enumerate(zip(topics.price_topics(self.topic, df, regions), encode(df, 1)))]
+        batch_size = min(self.batch_size, wire_format.MAX_RECORDS_PER_MESSAGE)
+        messages = []
+        for (fuel_code, region), rows in df.groupby([df["FuelCode"].astype(str), regions], sort=False).indices.items():
+            topic = topics.shard_topic(self.topic, fuel_code, region)
+            payloads = encode(df.iloc[rows], batch_size)
+            messages.extend((topic, payload, False, positions[rows[i * batch_size:(i + 1) * batch_size]]) for i, payload in enumerate(payloads))
+        return messages
+
+
+    def region_messages(self, df, regions=None):
+        # The retained region index, when df has stations outside the boxes already sent (or it hasn't been sent yet)
+        if not self.regions.update(df, regions) and self._regions_sent:
+            return []
+        self._regions_sent = True
+        return [(topics.regions_topic(self.topic), self.regions.encode(), True, NO_ROWS)]
+
+
+    def publish_regions(self, df):
+        # Publishes the region index covering df's stations (e.g. every stored station at startup) if it grew
+        try:
+            for topic, payload, retain, _ in self.region_messages(df):
+                self.publish_payload(payload, topic=topic, retain=retain)
+        except ConnectionError:
+            self._regions_sent = False # Goes out with the next published rows instead
+            raise
+
+
+    def _encode_json(self, df, batch_size):
+        records = self.serialize(df)
+        if batch_size == 1:
+            return records
+        return ["[" + ",".join(records[i:i + batch_size]) + "]" for i in range(0, len(records), batch_size)]
+
+
+    def messages_for(self, df):
+        if df.empty:
+            return []
+        regions = topics.postcode_regions(df["Postcode"])
+        positions = np.arange(len(df))
+        messages = self.region_messages(df, regions)
+        if self.wire != "binary":
+            return messages + self.price_messages(df, regions, self._encode_json, positions)
+
+        binary = wire_format.encodable_mask(df)
+        binary_df, json_df = df[binary], df[~binary]
+        return (
+            messages
+            + self.station_messages(binary_df, regions[binary], positions[binary])
+            + self.price_messages(binary_df, regions[binary], lambda df, batch_size: wire_format.encode_price_messages(df, batch_size, timed=self.stamp_publish_time), positions[binary])
+            + self.price_messages(json_df, regions[~binary], self._encode_json, positions[~binary])
+        )
+
+
+    def _forget(self, topic):
+        # A retained station or region message that never reached the broker is sent again with the next rows that need it
+        self._stations_sent.pop(topic, None)
+        if topic == topics.regions_topic(self.topic):
+            self._regions_sent = False
+
+
+    def removal_messages(self, removed):
+        '''
+        Empty retained messages that delete the broker's last value for each (StationCode, FuelCode) row of removed, so new subscribers stop receiving prices that left the snapshot. removed also carries each station's Postcode, for its region, and StationGone, True when the station has no price left; with wire="binary" those stations' attribute messages are deleted too.
+        '''
+        if removed.empty:
+            return []
+        regions = topics.postcode_regions(removed["Postcode"])
+        positions = np.arange(len(removed))
+        messages = []
+        if self.batch_size == 1 and self.retain_latest:
+            messages.extend((topic, b"", True, positions[i:i + 1]) for i, topic in enumerate(topics.price_topics(self.topic, removed, regions)))
+        if self.wire == "binary":
+            station_rows = removed.groupby(removed["StationCode"].astype(str), sort=False).indices
+            gone = removed["StationGone"].to_numpy(dtype=bool) & ~removed["StationCode"].duplicated().to_numpy()
+            for code, region in zip(removed["StationCode"].astype(str)[gone], regions[gone]):
+                topic = topics.station_topic(self.topic, region, code)
+                self._stations_sent.pop(topic, None) # Sent again should the station come back
+                messages.append((topic, b"", True, positions[station_rows[code]]))
+        return messages
+
+
+    def _send(self, messages, n_rows):
+        # Publishes (topic, payload, retain, rows) messages and waits for the acks; returns (mask of the n_rows rows whose messages were all acknowledged, unacknowledged message count)
+        infos = [self.publish_payload(payload, topic=topic, retain=retain) for topic, payload, retain, _ in messages]
+        self.flush()
+
+        delivered = np.ones(n_rows, dtype=bool)
+        unacked = 0
+        with self._lock:
+            for (topic, _, _, rows), info in zip(messages, infos):
+                if self._dropped(info) or info.mid in self._sent_at:
+                    delivered[rows] = False
+                    unacked += 1
+                    self._forget(topic)
+        return delivered, unacked
+
+
+    def publish_dataframe(self, df):
+        '''
+        Publishes every row of df and waits for the acks. Returns throughput and publish-to-ack latency figures for this call, plus "delivered", a boolean mask of the rows of df whose messages were all acknowledged (for QoS 0, handed to the socket) before the flush timeout, and "unacked", the number of messages that were not.
+        '''
+        start = time.perf_counter()
+        acked_before = self.messages_acked
+
+        messages = self.messages_for(df)
+        delivered, unacked = self._send(messages, len(df))
+
+        elapsed = time.perf_counter() - start
+        acked = self.messages_acked - acked_before
+        if messages and elapsed:
+            PUBLISH_RATE.observe(len(messages) / elapsed)
+        latencies = sorted(list(self.latencies)[-acked:]) if acked else []
+        return {
+            "records": len(df),
+            "messages": len(messages),
+            "bytes": sum(len(payload) for _, payload, _, _ in messages),
+            "acked": acked,
+            "unacked": unacked,
+            "delivered": delivered,
+            "seconds": elapsed,
+            "messages_per_sec": len(messages) / elapsed if elapsed else 0.0,
+            "records_per_sec": len(df) / elapsed if elapsed else 0.0,
+            "ack_latency_ms_p50": latencies[len(latencies) // 2] * 1000 if latencies else None,
+            "ack_latency_ms_p95": latencies[int(len(latencies) * 0.95)] * 1000 if latencies else None,
+            "ack_latency_ms_max": latencies[-1] * 1000 if latencies else None,
+        }
+
+
+    def publish_removals(self, removed):
+        # Publishes removal_messages(removed); returns the mask of rows whose deletions were acknowledged and the unacknowledged message count
+        return self._send(self.removal_messages(removed), len(removed))
@@ -0,0 +1,333 @@
+# Import necessary libraries
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import numpy as np
+import pandas as pd
+
+from wire_format import PRICE_DATE_FORMAT
+
+# Constants
+REAL_CHANGES_PER_MINUTE = 10 # Estimated NSW-wide price changes per minute at the daytime peak: the "1x" volume
+TOKEN_PATH = "/oauth/client_credential/accesstoken"
+PRICES_PATH = "/fuelpricecheck/v1/fuel/prices"
+NEW_PRICES_PATH = "/fuelpricecheck/v1/fuel/prices/new"
+REFERENCE_PATH = "/fuelcheckrefdata/v1/fuel/lovs"
+STUB_TOKEN_EXPIRES_IN = "43199" # Seconds, as a string like the real token endpoint
+FUEL_BASE_PRICES = {"E10": 175.0, "U91": 178.0, "P95": 195.0, "P98": 205.0, "DL": 190.0, "PDL": 198.0, "LPG": 95.0, "E85": 160.0, "B20": 185.0, "EV": 60.0}
+BRANDS = ["7-Eleven", "Ampol", "BP", "Caltex", "Coles Express", "EG Ampol", "Metro Fuel", "Mobil", "Shell", "United", "Independent"]
+TOWNS = [("Sydney", 2000, -33.87, 151.21), ("Newcastle", 2300, -32.93, 151.78), ("Wollongong", 2500, -34.42, 150.89), ("Coffs Harbour", 2450, -30.30, 153.11), ("Dubbo", 2830, -32.25, 148.60), ("Wagga Wagga", 2650, -35.11, 147.37), ("Orange", 2800, -33.28, 149.10)]
+DEFAULT_WORKDIR = "replay_run" # Where the replayed pipeline keeps its database, caches and history
+
+
+def epoch_seconds(timestamp):
+    # Naive wall-clock time -> epoch seconds, the clock PriceUpdatedDate is read on throughout the pipeline
+    return pd.Timestamp(timestamp).value // 10**9
+
+
+# Replay Feed Class Definition
+class ReplayFeed:
+    '''
+    A replayable price stream: station reference records in API shape, the prices current at the start, and time-ordered price changes after it. Times are PriceUpdatedDate as epoch seconds ("at").
+    '''
+    def __init__(self, stations, initial, events, start):
+        self.stations = stations
+        self.initial = initial.reset_index(drop=True) # stationcode, fueltype, price, at
+        self.events = events.sort_values("at", kind="stable").reset_index(drop=True)
+        self.start = int(start)
+        self.end = int(self.events["at"].iloc[-1]) if len(self.events) else self.start
+        self._event_at = self.events["at"].to_numpy()
+        self._stations_by_code = {station["code"]: station for station in stations}
+
+
+    def prices_at(self, at):
+        # Latest price per station and fuel at simulated time "at"
+        upto = np.searchsorted(self._event_at, at, side="right")
+        return pd.concat([self.initial, self.events.iloc[:upto]]).drop_duplicates(subset=["stationcode", "fueltype"], keep="last")
+
+
+    def changes_between(self, after, upto):
+        # Price changes with after < at <= upto
+        return self.events.iloc[np.searchsorted(self._event_at, after, side="right"):np.searchsorted(self._event_at, upto, side="right")]
+
+
+    def payload(self, prices):
+        # "/prices"-shaped JSON body for the given price rows and their stations
+        lastupdated = pd.to_datetime(prices["at"].to_numpy(), unit="s").strftime(PRICE_DATE_FORMAT)
+        return {
+            "stations": [self._stations_by_code[code] for code in pd.unique(prices["stationcode"])],
+            "prices": [
+                {"stationcode": code, "state": "NSW", "fueltype": fuel, "price": float(price), "lastupdated": updated}
+                for code, fuel, price, updated in zip(prices["stationcode"], prices["fueltype"], prices["price"], lastupdated)
+            ],
+        }
+
+
+def synthetic_feed(n_stations=3000, days=2.0, volume=1.0, fuels_per_station=4, seed=0, start=None):
+    '''
+    Synthesized multi-day price walks: n_stations stations around NSW towns, each selling fuels_per_station fuels, with volume x REAL_CHANGES_PER_MINUTE price changes per simulated minute at random times over "days" days from start (default: now). Each change moves that station's price by a small random step.
+    '''
+    rng = np.random.default_rng(seed)
+    start = epoch_seconds(start if start is not None else pd.Timestamp.now().floor("min"))
+
+    towns = rng.integers(0, len(TOWNS), n_stations)
+    brands = rng.integers(0, len(BRANDS), n_stations)
+    stations = [
+        {
+            "brandid": "", "stationid": "", "brand": BRANDS[brand], "code": str(1000 + i),
+            "name": f"{BRANDS[brand]} {TOWNS[town][0]} {i}",
+            "address": f"{rng.integers(1, 999)} Main Rd, {TOWNS[town][0]} NSW {TOWNS[town][1] + int(rng.integers(0, 20))}",
+            "location": {"latitude": float(TOWNS[town][2] + rng.normal(0, 0.2)), "longitude": float(TOWNS[town][3] + rng.normal(0, 0.2))},
+            "state": "NSW",
+        }
+        for i, (town, brand) in enumerate(zip(towns.tolist(), brands.tolist()))
+    ]
+
+    fuel_names = np.array(list(FUEL_BASE_PRICES))
+    fuels = np.array([rng.choice(len(fuel_names), fuels_per_station, replace=False) for _ in range(n_stations)]).ravel()
+    codes = np.repeat([station["code"] for station in stations], fuels_per_station)
+    base = np.round(np.array(list(FUEL_BASE_PRICES.values()))[fuels] + rng.normal(0, 6, len(fuels)), 1)
+    initial = pd.DataFrame({"stationcode": codes, "fueltype": fuel_names[fuels], "price": base, "at": start - rng.integers(0, 3 * 86400, len(fuels))})
+
+    n_events = int(REAL_CHANGES_PER_MINUTE * volume * days * 1440)
+    keys = rng.integers(0, len(fuels), n_events)
+    at = np.sort(start + rng.integers(1, max(2, int(days * 86400)), n_events))
+    steps = pd.Series(np.round(rng.normal(0, 2, n_events), 1))
+    prices = np.round(base[keys] + steps.groupby(keys).cumsum().to_numpy(), 1).clip(50, 400)
+    events = pd.DataFrame({"stationcode": codes[keys], "fueltype": fuel_names[fuels][keys], "price": prices, "at": at})
+    return ReplayFeed(stations, initial, events, start)
+
+
+def csv_feed(csv_file="integrated_fuel_data.csv", days=7.0):
+    '''
+    Replays a recorded snapshot CSV: prices updated in the last "days" days before its newest PriceUpdatedDate become the change stream, older ones the initial prices. Files without StationCode get stable codes per station name and address.
+    '''
+    df = pd.read_csv(csv_file, dtype={"StationCode": str, "Postcode": str})
+    df["at"] = pd.to_datetime(df["PriceUpdatedDate"], format=PRICE_DATE_FORMAT, errors="coerce")
+    df = df.dropna(subset=["at", "Price", "Latitude", "Longitude"])
+    df["at"] = df["at"].to_numpy().astype("datetime64[s]").astype(np.int64)
+    if "StationCode" not in df.columns:
+        df["StationCode"] = (pd.factorize(df["ServiceStationName"].astype(str) + "|" + df["Address"].astype(str))[0] + 1000).astype(str)
+
+    station_rows = df.drop_duplicates(subset="StationCode", keep="last")
+    stations = [
+        {"brandid": "", "stationid": "", "brand": brand, "code": code, "name": name, "address": address,
+         "location": {"latitude": float(latitude), "longitude": float(longitude)}, "state": "NSW"}
+        for code, name, address, brand, latitude, longitude in zip(
+            station_rows["StationCode"], station_rows["ServiceStationName"], station_rows["Address"],
+            station_rows["Brand"], station_rows["Latitude"], station_rows["Longitude"])
+    ]
+    prices = df.rename(columns={"StationCode": "stationcode", "FuelCode": "fueltype", "Price": "price"})[["stationcode", "fueltype", "price", "at"]]
+    start = int(prices["at"].max() - days * 86400)
+    return ReplayFeed(stations, prices[prices["at"] <= start], prices[prices["at"] > start], start)
+
+
+# Stub FuelCheck API Class Definition
+class StubFuelCheckAPI:
+    '''
+    Local stand-in for the FuelCheck endpoints data_stream.py calls, serving a ReplayFeed on a simulated clock that runs "speedup" times faster than real time: the token endpoint (tokens valid for token_expires_in seconds), "/prices" (every price current at the simulated time), "/prices/new" (changes since the previous "/prices" or "/prices/new" request with the same apikey) and the reference "lovs" endpoint (304 when if-modified-since is sent, as replayed stations never change). With paused=True the clock stays at the feed's start until start_clock(). Requests are counted per endpoint and TCP connections in total.
+    '''
+    def __init__(self, feed, speedup=1.0, host="127.0.0.1", port=0, paused=False, token_expires_in=STUB_TOKEN_EXPIRES_IN):
+        self.feed = feed
+        self.speedup = speedup
+        self.token_expires_in = token_expires_in
+        self.requests = Counter() # Requests served per endpoint
+        self.connections = 0 # TCP connections accepted; a keep-alive client opens one and reuses it
+        self._lock = threading.Lock()
+        self._cursors = {} # apikey -> simulated time of its last price request
+        self._clock_started = None if paused else time.time()
+        handler = type("StubHandler", (StubRequestHandler,), {"stub": self})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+    def start(self):
+        self._thread.start()
+        return self
+
+
+    def start_clock(self):
+        if self._clock_started is None:
+            self._clock_started = time.time()
+
+
+    def sim_now(self):
+        if self._clock_started is None:
+            return self.feed.start
+        return self.feed.start + int((time.time() - self._clock_started) * self.speedup)
+
+
+    def available_at(self, at):
+        # Real time at which a change with PriceUpdatedDate "at" became visible through the stub
+        return self._clock_started + (at - self.feed.start) / self.speedup
+
+
+    def respond(self, path, headers):
+        # (HTTP status, JSON body or None) for one GET request
+        path = path.lower().rstrip("/")
+        self.requests[path] += 1
+        if path == TOKEN_PATH:
+            return 200, {"access_token": "replay-token", "expires_in": str(self.token_expires_in), "token_type": "BearerToken"}
+        if path == REFERENCE_PATH:
+            if headers.get("if-modified-since"):
+                return 304, None
+            return 200, {"stations": {"items": self.feed.stations}}
+        if path in (PRICES_PATH, NEW_PRICES_PATH):
+            with self._lock:
+                now = self.sim_now()
+                after = self._cursors.get(headers.get("apikey"), self.feed.start)
+                self._cursors[headers.get("apikey")] = now
+            prices = self.feed.prices_at(now) if path == PRICES_PATH else self.feed.changes_between(after, now)
+            return 200, self.feed.payload(prices)
+        return 404, {"message": f"No stub for {path}"}
+
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Keep-alive, like the real API behind data_stream's pooled session
+    stub = None
+
+    def setup(self):
+        super().setup()
+        with self.stub._lock:
+            self.stub.connections += 1
+
+    def do_GET(self):
+        status, body = self.stub.respond(urlparse(self.path).path, self.headers)
+        data = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass # One line per request would drown the pipeline's own output
+
+
+#   Pipeline Process Control
+def run_pipeline(api_url, broker_host, broker_port, poll_interval, publish_rate=None):
+    # Runs data_stream.main() against the stub API and a local broker, in this process
+    import data_stream
+    from publisher import PacingPolicy
+
+    data_stream.API_BASE_URL = api_url
+    data_stream.MQTT_BROKER_HOST, data_stream.MQTT_BROKER_PORT = broker_host, broker_port
+    data_stream.POLL_COOLDOWN = poll_interval
+    if publish_rate is not None:
+        data_stream.PUBLISH_PACING = PacingPolicy.per_second(publish_rate) if publish_rate > 0 else PacingPolicy.unthrottled()
+    data_stream.main([])
+
+
+def start_pipeline(api_url, broker_host, broker_port, poll_interval, workdir=DEFAULT_WORKDIR, publish_rate=None, log_file=None):
+    '''
+    Starts the replayed pipeline as a child process working in workdir (its database, station cache, CSV export and history stay there). Output goes to log_file, default workdir/pipeline.log.
+    '''
+    os.makedirs(workdir, exist_ok=True)
+    log = open(log_file or os.path.join(workdir, "pipeline.log"), "a")
+    command = [sys.executable, os.path.abspath(__file__), "pipeline", "--api", api_url, "--broker", f"{broker_host}:{broker_port}", "--poll-interval", str(poll_interval)]
+    if publish_rate is not None:
+        command += ["--publish-rate", str(publish_rate)]
+    process = subprocess.Popen(command, cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+    log.close()
+    return process
+
+
+def stop_pipeline(process, timeout=30):
+    # SIGTERM lets the pipeline drain what it already fetched, then it is killed if it doesn't exit in time
+    if process.poll() is None:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+    return process.returncode
+
+
+def peak_rss_mib(pid):
+    # High-water mark of a process's resident memory from /proc (Linux), None where unavailable
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def parse_broker(value):
+    host, _, port = value.rpartition(":")
+    return (host, int(port)) if host else (value, 1883)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline replay of FuelCheck data through the pipeline, a local broker and the dashboard")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="Serve a replay feed through the stub API and run the pipeline against it")
+    serve_parser.add_argument("--csv", help="Replay this recorded CSV instead of synthesized price walks")
+    serve_parser.add_argument("--days", type=float, default=2.0, help="Days of simulated price changes")
+    serve_parser.add_argument("--stations", type=int, default=3000, help="Synthesized stations")
+    serve_parser.add_argument("--volume", type=float, default=1.0, help=f"Price changes per simulated minute, as a multiple of {REAL_CHANGES_PER_MINUTE}")
+    serve_parser.add_argument("--speedup", type=float, default=1.0, help="Simulated seconds per real second")
+    serve_parser.add_argument("--port", type=int, default=8080, help="Stub API port")
+    serve_parser.add_argument("--broker", default="127.0.0.1:1883", help="Local MQTT broker host:port")
+    serve_parser.add_argument("--workdir", default=DEFAULT_WORKDIR)
+    serve_parser.add_argument("--no-pipeline", action="store_true", help="Only serve the stub API")
+
+    pipeline_parser = subparsers.add_parser("pipeline", help="Run data_stream.main() against a stub API (used by serve)")
+    pipeline_parser.add_argument("--api", required=True)
+    pipeline_parser.add_argument("--broker", default="127.0.0.1:1883")
+    pipeline_parser.add_argument("--poll-interval", type=float, default=60.0)
+    pipeline_parser.add_argument("--publish-rate", type=float, help="Messages per second, 0 for unthrottled (default: data_stream.PUBLISH_PACING)")
+
+    args = parser.parse_args()
+    if args.command == "pipeline":
+        run_pipeline(args.api, *parse_broker(args.broker), args.poll_interval, args.publish_rate)
+        return
+
+    feed = csv_feed(args.csv, args.days) if args.csv else synthetic_feed(args.stations, args.days, args.volume)
+    stub = StubFuelCheckAPI(feed, args.speedup, port=args.port).start()
+    broker_host, broker_port = parse_broker(args.broker)
+    print(f"Stub FuelCheck API at {stub.url}: {len(feed.stations):,} stations, {len(feed.initial):,} initial prices, {len(feed.events):,} changes over {(feed.end - feed.start) / 86400:.1f} simulated days at {args.speedup:g}x")
+    process = None
+    if not args.no_pipeline:
+        # One poll per simulated minute, like the real 60-second cooldown
+        process = start_pipeline(stub.url, broker_host, broker_port, 60 / args.speedup, args.workdir)
+        print(f"Pipeline running in {args.workdir} (log: {os.path.join(args.workdir, 'pipeline.log')})")
+    print(f"Dashboard: MQTT_BROKER_HOST={broker_host} MQTT_BROKER_PORT={broker_port} streamlit run dashboard.py")
+    try:
+        while stub.sim_now() <= feed.end and (process is None or process.poll() is None):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if process is not None:
+            stop_pipeline(process)
+        stub.stop()
+        print(f"Replay stopped at simulated {pd.Timestamp(stub.sim_now(), unit='s')}; requests served: {dict(stub.requests)}")
+
+
+if __name__ == "__main__":
+    main()
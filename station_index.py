@@ -0,0 +1,226 @@
+# Import necessary libraries
+import numpy as np
+
+# Constants
+DEFAULT_CELL_DEG = 0.05 # Grid cell size in degrees (~5 km), small enough that a city viewport touches few cells
+TILE_SIZE = 256 # Web Mercator tile size in pixels
+CLUSTER_CELL_PX = 80 # Stations closer than about this many screen pixels are clustered together
+CLUSTER_MAX_ZOOM = 12 # Below this zoom level nearby stations are always drawn as one aggregated marker
+MAX_INDIVIDUAL_MARKERS = 1000 # Above this many stations in view, markers are clustered at any zoom level
+EARTH_RADIUS_KM = 6371.0088 # Mean Earth radius used for haversine distances
+KM_PER_DEG_LAT = EARTH_RADIUS_KM * np.pi / 180
+
+
+# Spatial Grid Index Class Definition
+class GridIndex:
+    '''
+    Uniform lat/lon grid over station coordinates. Points are sorted by cell id once at build time, so a bounding-box query only touches the rows of cells that overlap the box: one searchsorted per grid row plus an exact filter on the candidates. Query cost grows with the number of stations in view, not with the total number of stations.
+    '''
+    def __init__(self, lat, lon, cell_deg=DEFAULT_CELL_DEG):
+        self.lat = np.asarray(lat, dtype=float)
+        self.lon = np.asarray(lon, dtype=float)
+        self.cell_deg = cell_deg
+
+        valid = np.isfinite(self.lat) & np.isfinite(self.lon)
+        self.lat0 = self.lat[valid].min() if valid.any() else 0.0
+        self.lon0 = self.lon[valid].min() if valid.any() else 0.0
+        self.ny = int((self.lat[valid].max() - self.lat0) // cell_deg) + 1 if valid.any() else 1
+        self.nx = int((self.lon[valid].max() - self.lon0) // cell_deg) + 1 if valid.any() else 1
+
+        cells = np.full(len(self.lat), -1, dtype=np.int64) # Points without coordinates sort first and are never returned
+        cells[valid] = self._row(self.lat[valid]) * self.nx + self._col(self.lon[valid])
+        self.order = np.argsort(cells, kind="stable")
+        self.sorted_cells = cells[self.order]
+
+
+    def __len__(self):
+        return len(self.lat)
+
+
+    def extend(self, lat, lon):
+        '''
+        Returns a new index over these points followed by (lat, lon), sharing this index's grid. New cell ids are merged into the sorted order with one searchsorted and insert instead of re-sorting everything. Points outside the grid's extent would pile up in its edge cells, so those (or an empty index) trigger a full rebuild instead.
+        '''
+        lat = np.asarray(lat, dtype=float)
+        lon = np.asarray(lon, dtype=float)
+        all_lat, all_lon = np.concatenate([self.lat, lat]), np.concatenate([self.lon, lon])
+        if self._outside(lat, lon):
+            return GridIndex(all_lat, all_lon, self.cell_deg)
+        return self._with_points(all_lat, all_lon, self.order, self.sorted_cells, np.arange(len(self.lat), len(all_lat)), lat, lon)
+
+
+    def move(self, rows, lat, lon):
+        '''
+        Returns a new index with the points at rows moved to (lat, lon), e.g. after a station's location was corrected. Only their entries are taken out of the sorted order and merged back in at their new cells; a move outside the grid's extent triggers a full rebuild, as in extend().
+        '''
+        rows = np.asarray(rows, dtype=np.int64)
+        lat = np.asarray(lat, dtype=float)
+        lon = np.asarray(lon, dtype=float)
+        all_lat, all_lon = self.lat.copy(), self.lon.copy()
+        all_lat[rows], all_lon[rows] = lat, lon
+        if self._outside(lat, lon):
+            return GridIndex(all_lat, all_lon, self.cell_deg)
+        kept = ~np.isin(self.order, rows)
+        return self._with_points(all_lat, all_lon, self.order[kept], self.sorted_cells[kept], rows, lat, lon)
+
+
+    def _outside(self, lat, lon):
+        # Whether any of the points falls outside the grid's extent, or the grid was built without any valid point
+        valid = np.isfinite(lat) & np.isfinite(lon)
+        return not np.isfinite(self.lat).any() or bool(
+            (lat[valid] < self.lat0).any() or (lat[valid] >= self.lat0 + self.ny * self.cell_deg).any() or
+            (lon[valid] < self.lon0).any() or (lon[valid] >= self.lon0 + self.nx * self.cell_deg).any()
+        )
+
+
+    def _with_points(self, all_lat, all_lon, order, sorted_cells, rows, lat, lon):
+        # Copy of this index over (all_lat, all_lon) whose sorted order is "order" with the points at rows, located at (lat, lon), merged in
+        index = GridIndex.__new__(GridIndex)
+        index.__dict__.update(self.__dict__)
+        index.lat, index.lon = all_lat, all_lon
+        valid = np.isfinite(lat) & np.isfinite(lon)
+        cells = np.full(len(rows), -1, dtype=np.int64)
+        cells[valid] = self._row(lat[valid]) * self.nx + self._col(lon[valid])
+        new_order = np.argsort(cells, kind="stable")
+        positions = np.searchsorted(sorted_cells, cells[new_order], side="right") # After existing points of the same cell
+        index.sorted_cells = np.insert(sorted_cells, positions, cells[new_order])
+        index.order = np.insert(order, positions, rows[new_order])
+        return index
+
+
+    def _row(self, lat):
+        return np.clip(((np.asarray(lat) - self.lat0) // self.cell_deg).astype(np.int64), 0, self.ny - 1)
+
+
+    def _col(self, lon):
+        return np.clip(((np.asarray(lon) - self.lon0) // self.cell_deg).astype(np.int64), 0, self.nx - 1)
+
+
+    def query_bbox(self, south, west, north, east):
+        # Indices (into the arrays the index was built from) of points inside the box
+        if len(self) == 0 or north < self.lat0 or east < self.lon0:
+            return np.empty(0, dtype=np.int64)
+        row0, row1 = int(self._row(south)), int(self._row(north))
+        col0, col1 = int(self._col(west)), int(self._col(east))
+
+        rows = np.arange(row0, row1 + 1)
+        starts = np.searchsorted(self.sorted_cells, rows * self.nx + col0, side="left")
+        ends = np.searchsorted(self.sorted_cells, rows * self.nx + col1, side="right")
+        if not (ends > starts).any():
+            return np.empty(0, dtype=np.int64)
+        candidates = self.order[np.concatenate([np.arange(a, b) for a, b in zip(starts, ends) if b > a])]
+
+        lat, lon = self.lat[candidates], self.lon[candidates]
+        inside = (lat >= south) & (lat <= north) & (lon >= west) & (lon <= east)
+        return np.sort(candidates[inside])
+
+
+    def query_radius(self, lat, lon, radius_km, mask=None):
+        '''
+        Points within radius_km (great-circle distance) of (lat, lon), nearest first: a bounding-box query over the circle, then an exact haversine filter. Returns (indices, distances in km). mask, a boolean array over the points, limits the search to points where it is True.
+        '''
+        candidates = self.query_bbox(*radius_bounds(lat, lon, radius_km))
+        if mask is not None:
+            candidates = candidates[mask[candidates]]
+        distances = haversine_km(lat, lon, self.lat[candidates], self.lon[candidates])
+        inside = distances <= radius_km
+        candidates, distances = candidates[inside], distances[inside]
+        order = np.argsort(distances, kind="stable")
+        return candidates[order], distances[order]
+
+
+    def query_nearest(self, lat, lon, k, mask=None):
+        '''
+        The k points nearest to (lat, lon), nearest first, as (indices, distances in km). Searches a radius that starts at about one grid cell and doubles until it holds k points or covers the whole grid, so the cost depends on local density rather than the total number of points.
+        '''
+        if len(self) == 0 or k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        radius_km = self.cell_deg * KM_PER_DEG_LAT
+        # Farthest any indexed point can be: the distance to the opposite corner of the grid extent, plus the query's own offset from it
+        max_radius_km = haversine_km(lat, lon, self.lat0, self.lon0) + haversine_km(self.lat0, self.lon0, self.lat0 + self.ny * self.cell_deg, self.lon0 + self.nx * self.cell_deg)
+        while True:
+            indices, distances = self.query_radius(lat, lon, radius_km, mask)
+            if len(indices) >= k or radius_km >= max_radius_km:
+                return indices[:k], distances[:k]
+            radius_km *= 2
+
+
+#   Distance Helpers
+def haversine_km(lat1, lon1, lat2, lon2):
+    # Great-circle distance in km between points given in degrees (NumPy broadcasting)
+    lat1, lon1, lat2, lon2 = (np.radians(value) for value in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+#   Viewport Helpers
+def degrees_per_pixel(zoom):
+    # Longitude degrees covered by one screen pixel at a Web Mercator zoom level
+    return 360.0 / (TILE_SIZE * 2 ** zoom)
+
+
+def viewport_bounds(center, zoom, width_px, height_px, margin=0.25):
+    '''
+    Approximate (south, west, north, east) of the visible map, grown by "margin" of its size on every side so markers just outside the edge are already there when the user pans.
+    '''
+    lat, lon = center
+    half_width = width_px / 2 * degrees_per_pixel(zoom) * (1 + 2 * margin)
+    half_height = height_px / 2 * degrees_per_pixel(zoom) * np.cos(np.radians(lat)) * (1 + 2 * margin)
+    return lat - half_height, lon - half_width, lat + half_height, lon + half_width
+
+
+def radius_bounds(lat, lon, radius_km):
+    # (south, west, north, east) enclosing the circle of radius_km around (lat, lon)
+    dlat = radius_km / KM_PER_DEG_LAT
+    dlon = dlat / max(np.cos(np.radians(min(abs(lat) + dlat, 89.0))), 1e-6) # Widest at the circle's edge nearest the pole
+    return lat - dlat, lon - dlon, lat + dlat, lon + dlon
+
+
+def expand_bounds(bounds, margin=0.25):
+    south, west, north, east = bounds
+    dlat, dlon = (north - south) * margin, (east - west) * margin
+    return south - dlat, west - dlon, north + dlat, east + dlon
+
+
+#   Clustering
+def cluster_points(lat, lon, values, cell_deg):
+    '''
+    Groups points into grid cells of cell_deg degrees and aggregates each cell. Returns a dict of arrays: centroid latitude/longitude, count, min and median of values, and "members", the position of each input point's cluster.
+    '''
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    values = np.asarray(values, dtype=float)
+    if len(lat) == 0:
+        empty = np.empty(0)
+        return {"lat": empty, "lon": empty, "count": np.empty(0, dtype=np.int64), "min": empty, "median": empty, "members": np.empty(0, dtype=np.int64)}
+
+    # One key per (row, col) cell; the multiplier spans the actual column range, so cells never collide however small cell_deg is
+    row = np.floor(lat / cell_deg).astype(np.int64)
+    col = np.floor(lon / cell_deg).astype(np.int64)
+    col -= col.min()
+    keys = (row - row.min()) * (col.max() + 1) + col
+    _, members, counts = np.unique(keys, return_inverse=True, return_counts=True)
+
+    # Sort by (cluster, value) once; min and median are then positional lookups per cluster
+    order = np.lexsort((values, members))
+    sorted_values = values[order]
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    median = (sorted_values[starts + (counts - 1) // 2] + sorted_values[starts + counts // 2]) / 2
+
+    return {
+        "lat": np.bincount(members, weights=lat) / counts,
+        "lon": np.bincount(members, weights=lon) / counts,
+        "count": counts,
+        "min": sorted_values[starts],
+        "median": median,
+        "members": members,
+    }
+
+
+def cluster_cell_deg(zoom, cell_px=CLUSTER_CELL_PX):
+    return cell_px * degrees_per_pixel(zoom)
+
+
+def needs_clustering(zoom, stations_in_view):
+    # Cluster when zoomed out, or when a dense viewport would otherwise send too many individual markers
+    return zoom < CLUSTER_MAX_ZOOM or stations_in_view > MAX_INDIVIDUAL_MARKERS
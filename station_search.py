@@ -0,0 +1,52 @@
+# Import necessary libraries
+import numpy as np
+import pandas as pd
+
+from wire_format import FUEL_CODE_IDS
+
+# Constants
+RESULT_COLUMNS = ["Station", "Address", "Brand", "Price", "Distance (km)", "Latitude", "Longitude"]
+
+
+def station_results(table, rows, distances, fuel_code=None):
+    # Result rows for the dashboard and API callers; Price is the given fuel's (NaN without one)
+    rows = np.asarray(rows, dtype=np.int64)
+    return pd.DataFrame({
+        "Station": [table.name[row] for row in rows],
+        "Address": [table.address[row] for row in rows],
+        "Brand": [table.brand[row] for row in rows],
+        "Price": table.prices(fuel_code)[rows] if fuel_code is not None else np.full(len(rows), np.nan),
+        "Distance (km)": np.round(distances, 2),
+        "Latitude": table.latitude[rows],
+        "Longitude": table.longitude[rows],
+    }, index=pd.Index(rows, name="row"), columns=RESULT_COLUMNS)
+
+
+def _fuel_mask(table, fuel_code):
+    # Stations with a valid price for the fuel, as a mask over the index's points (None when no fuel is given)
+    return None if fuel_code is None else table.valid[:len(table), FUEL_CODE_IDS[fuel_code]]
+
+
+def nearest_stations(snapshot, latitude, longitude, k=10, fuel_code=None):
+    '''
+    The k stations nearest to (latitude, longitude), nearest first. With fuel_code, only stations that currently have a price for that fuel are considered.
+    '''
+    rows, distances = snapshot.index.query_nearest(latitude, longitude, k, _fuel_mask(snapshot.table, fuel_code))
+    return station_results(snapshot.table, rows, distances, fuel_code)
+
+
+def stations_within(snapshot, latitude, longitude, radius_km, fuel_code=None):
+    '''
+    Every station within radius_km of (latitude, longitude), nearest first, optionally limited to stations with a price for fuel_code.
+    '''
+    rows, distances = snapshot.index.query_radius(latitude, longitude, radius_km, _fuel_mask(snapshot.table, fuel_code))
+    return station_results(snapshot.table, rows, distances, fuel_code)
+
+
+def cheapest_within(snapshot, latitude, longitude, radius_km, fuel_code, n=10):
+    '''
+    The n cheapest stations for fuel_code within radius_km of (latitude, longitude), ranked by price with the nearer station first on equal prices.
+    '''
+    rows, distances = snapshot.index.query_radius(latitude, longitude, radius_km, _fuel_mask(snapshot.table, fuel_code))
+    order = np.lexsort((distances, snapshot.table.prices(fuel_code)[rows]))[:n] # Last key is the primary one
+    return station_results(snapshot.table, rows[order], distances[order], fuel_code)
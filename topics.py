@@ -0,0 +1,240 @@
+# Import necessary libraries
+import json
+import re
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from metrics import RESUBSCRIPTIONS, TOPIC_FILTERS, get_logger
+
+# Constants
+# Topic hierarchy below the base topic:
+#   <FuelCode>/<region>/<StationCode>   retained last price per station and fuel (batches of a fuel and region go to <FuelCode>/<region>)
+#   Station/<region>/<StationCode>      retained static station attributes (binary wire format)
+#   Regions                             retained RegionIndex, the bounding box of every region
+REGION_DIGITS = 3 # Leading postcode digits naming a region: "200" holds 2000-2009, about one district
+OTHER_REGION = "other" # Region of stations without a 4-digit postcode
+STATION_SUBTOPIC = "Station"
+REGIONS_SUBTOPIC = "Regions"
+MAX_REGION_FILTERS = 40 # A view overlapping more regions than this subscribes the fuel's whole subtree instead
+SUBSCRIPTION_LINGER = 300 # Seconds a session's filters outlive its last report
+
+log = get_logger("topics")
+
+
+#   Topic Layout
+def postcode_regions(postcodes):
+    # Region of every postcode in a Series, looking at each distinct postcode once
+    codes, uniques = pd.factorize(postcodes)
+    uniques = pd.Index(uniques.astype(str), dtype=object).str.strip()
+    regions = uniques.str[:REGION_DIGITS].where(uniques.str.fullmatch(r"\d{4}"), OTHER_REGION)
+    return pd.Series(np.append(regions.to_numpy(dtype=object), OTHER_REGION)[codes], index=postcodes.index, dtype=object) # Code -1 (missing) takes the appended OTHER_REGION
+
+
+def postcode_region(postcode):
+    # Region of a single postcode, by the same rule as postcode_regions
+    code = str(postcode).strip() if postcode is not None else ""
+    return code[:REGION_DIGITS] if re.fullmatch(r"\d{4}", code) else OTHER_REGION
+
+
+def shard_topic(base, fuel_code, region):
+    return f"{base}/{fuel_code}/{region}"
+
+
+def price_topics(base, df, regions):
+    # Retained per-station/fuel topic of every row, built in one vectorized string concatenation
+    return (base + "/" + df["FuelCode"].astype(str) + "/" + regions + "/" + df["StationCode"].astype(str)).tolist()
+
+
+def parse_price_topic(base, topic):
+    # (fuel code, region, station code) of a retained per-station price topic, None for any other topic
+    parts = topic[len(base) + 1:].split("/") if topic.startswith(base + "/") else []
+    if len(parts) != 3 or parts[0] in (STATION_SUBTOPIC, REGIONS_SUBTOPIC):
+        return None
+    return tuple(parts)
+
+
+def parse_price_filter(base, topic):
+    # (fuel code, region) of a price filter from price_filters, with region None for the fuel's whole subtree; None for any other filter
+    parts = topic[len(base) + 1:].split("/") if topic.startswith(base + "/") else []
+    if len(parts) not in (2, 3) or parts[-1] != "#" or parts[0] in (STATION_SUBTOPIC, REGIONS_SUBTOPIC):
+        return None
+    return parts[0], (parts[1] if len(parts) == 3 else None)
+
+
+def station_topic(base, region, station_code):
+    return f"{base}/{STATION_SUBTOPIC}/{region}/{station_code}"
+
+
+def regions_topic(base):
+    return f"{base}/{REGIONS_SUBTOPIC}"
+
+
+def price_filters(base, fuel_code, regions=None):
+    # Filters for one fuel in the given regions, or its whole subtree when regions is None. "a/#" also matches "a", so batches are included.
+    if regions is None:
+        return [f"{base}/{fuel_code}/#"]
+    return [f"{shard_topic(base, fuel_code, region)}/#" for region in regions]
+
+
+def station_filters(base, regions=None):
+    if regions is None:
+        return [f"{base}/{STATION_SUBTOPIC}/#"]
+    return [f"{base}/{STATION_SUBTOPIC}/{region}/#" for region in regions]
+
+
+# Region Index Class Definition
+class RegionIndex:
+    '''
+    Bounding box of the stations in each postcode region. The publisher grows it from the rows it publishes and keeps it on a retained topic; subscribers use it to turn a map area into the regions it overlaps, and so into topic filters.
+    '''
+    def __init__(self, bounds=None):
+        self.bounds = {region: list(box) for region, box in (bounds or {}).items()} # region -> [south, west, north, east]
+
+
+    def __len__(self):
+        return len(self.bounds)
+
+
+    def update(self, df, regions=None):
+        # Grows the boxes to cover the stations of df; returns whether any box changed
+        regions = postcode_regions(df["Postcode"]) if regions is None else regions
+        points = pd.DataFrame({
+            "region": regions.to_numpy(),
+            "lat": pd.to_numeric(df["Latitude"], errors="coerce").to_numpy(),
+            "lon": pd.to_numeric(df["Longitude"], errors="coerce").to_numpy(),
+        }).dropna()
+        boxes = points.groupby("region", sort=False).agg(south=("lat", "min"), west=("lon", "min"), north=("lat", "max"), east=("lon", "max"))
+
+        changed = False
+        for region, (south, west, north, east) in zip(boxes.index, boxes.itertuples(index=False, name=None)):
+            old = self.bounds.get(region)
+            box = [float(south), float(west), float(north), float(east)] if old is None else [min(old[0], south), min(old[1], west), max(old[2], north), max(old[3], east)]
+            if box != old:
+                self.bounds[region] = [float(value) for value in box]
+                changed = True
+        return changed
+
+
+    def regions_in(self, south, west, north, east):
+        return sorted(region for region, (s, w, n, e) in self.bounds.items() if s <= north and n >= south and w <= east and e >= west)
+
+
+    def encode(self):
+        return json.dumps(self.bounds, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+
+    @classmethod
+    def decode(cls, payload):
+        return cls(json.loads(payload.decode("utf-8")) if payload else {})
+
+
+# Topic Subscriptions Class Definition
+class TopicSubscriptions:
+    '''
+    Topic filters of one shared subscriber, derived from what its sessions are showing. Each session reports its selected fuel and the areas it needs (viewport, search circle) with want(); the client holds the union of their fuel and region filters, subscribing new ones (the broker replays their retained last values straight away) and unsubscribing the ones no session wants any more. A session that stops reporting drops out after linger seconds. Until the region index has arrived, or when a session's areas overlap more than max_regions regions, the fuel's whole subtree is subscribed. Prices of unsubscribed regions stop updating, so on_dropped(fuel_code, keep), when set, is called for every fuel that lost filters, with the regions still subscribed for it; prices of that fuel elsewhere are stale.
+    '''
+    def __init__(self, base, linger=SUBSCRIPTION_LINGER, max_regions=MAX_REGION_FILTERS, qos=0):
+        self.base = base
+        self.linger = linger
+        self.max_regions = max_regions
+        self.qos = qos
+        self.regions = RegionIndex()
+        self.regions_topic = regions_topic(base)
+        self.subscribed = set() # Filters held on the client, besides the region index
+        self._views = {} # session id -> (fuel code, areas, time.monotonic() of its last report)
+        self._client = None
+        self._lock = threading.Lock()
+        self.on_dropped = None # Called with (fuel code, regions still subscribed for it) under the lock, see the class docstring
+
+
+    def attach(self, client):
+        # Called on every (re)connect: a new connection starts without subscriptions, so everything is subscribed again
+        with self._lock:
+            self._client = client
+            self.subscribed = set()
+            client.subscribe(self.regions_topic, self.qos)
+            self._sync()
+
+
+    def want(self, session, fuel_code, areas):
+        # areas: (south, west, north, east) boxes the session needs prices in
+        with self._lock:
+            self._views[session] = (fuel_code, tuple(areas), time.monotonic())
+            self._sync()
+
+
+    def touch(self, session):
+        # Keeps an idle session's filters alive; False when it already expired and has to report its view again
+        with self._lock:
+            view = self._views.get(session)
+            if view is not None:
+                self._views[session] = view[:2] + (time.monotonic(),)
+            self._sync()
+            return view is not None
+
+
+    def set_regions(self, regions):
+        with self._lock:
+            self.regions = regions
+            self._sync()
+
+
+    def filters(self):
+        # Filters wanted by the sessions that reported within the linger time, without the ones a wider wildcard already covers
+        with self._lock:
+            return self._filters()
+
+
+    def _filters(self):
+        # Caller holds self._lock; sessions past the linger time are dropped
+        now = time.monotonic()
+        self._views = {session: view for session, view in self._views.items() if now - view[2] <= self.linger}
+        wanted = set()
+        for fuel_code, areas, _ in self._views.values():
+            regions = self._regions_for(areas)
+            wanted.update(price_filters(self.base, fuel_code, regions))
+            wanted.update(station_filters(self.base, regions))
+        wildcards = [topic[:-1] for topic in wanted if topic.count("/") == self.base.count("/") + 2]
+        return {topic for topic in wanted if not any(topic != prefix + "#" and topic.startswith(prefix) for prefix in wildcards)}
+
+
+    def _report_dropped(self, removed, wanted):
+        # Fuels whose whole subtree is still subscribed lost nothing; for the others every region outside the remaining filters is stale
+        remaining = {}
+        for fuel_code, region in filter(None, (parse_price_filter(self.base, topic) for topic in wanted)):
+            remaining.setdefault(fuel_code, set()).add(region)
+        dropped = {parsed[0] for parsed in (parse_price_filter(self.base, topic) for topic in removed) if parsed is not None}
+        for fuel_code in sorted(dropped):
+            keep = remaining.get(fuel_code, set())
+            if None not in keep:
+                self.on_dropped(fuel_code, keep)
+
+
+    def _regions_for(self, areas):
+        if not self.regions:
+            return None
+        regions = set()
+        for area in areas:
+            regions.update(self.regions.regions_in(*area))
+        return None if len(regions) > self.max_regions else sorted(regions)
+
+
+    def _sync(self):
+        # Caller holds self._lock. New filters are subscribed before old ones are dropped, so no update falls into the gap.
+        wanted = self._filters()
+        if self._client is None or wanted == self.subscribed:
+            return
+        added, removed = sorted(wanted - self.subscribed), sorted(self.subscribed - wanted)
+        if added:
+            self._client.subscribe([(topic, self.qos) for topic in added])
+        if removed:
+            self._client.unsubscribe(removed)
+        self.subscribed = wanted
+        if removed and self.on_dropped is not None:
+            self._report_dropped(removed, wanted)
+        RESUBSCRIPTIONS.inc()
+        TOPIC_FILTERS.set(len(wanted))
+        log.info("resubscribed", added=len(added), removed=len(removed), filters=len(wanted), sessions=len(self._views))
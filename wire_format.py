@@ -0,0 +1,187 @@
+# Import necessary libraries
+import json
+import struct
+import time
+from functools import lru_cache
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+# Constants
+MAGIC = 0xF5 # First byte of every binary message; JSON messages always start with "{" or "["
+VERSION = 1
+TYPE_STATION = 1
+TYPE_PRICES = 2
+TYPE_PRICES_TIMED = 3 # Price message that also carries the time it was handed to the broker
+PRICE_DATE_FORMAT = "%d/%m/%Y %H:%M:%S" # Format of PriceUpdatedDate as returned by the FuelCheck API, shared by every module that parses or writes it
+
+# Fuel code enum. Append only: the position of a code is its wire value.
+FUEL_CODES = ['DL', 'E10', 'P95', 'P98', 'U91', 'PDL', 'EV', 'LPG', 'E85', 'B20', 'CNG', 'LNG', 'H2']
+FUEL_CODE_IDS = {code: i for i, code in enumerate(FUEL_CODES)}
+
+NO_PRICE = 0xFFFFFFFF
+HEADER = struct.Struct("<BBB") # magic, version, message type
+STATION_FIXED = struct.Struct("<Idd") # station id, latitude, longitude
+PRICE_COUNT = struct.Struct("<H")
+PUBLISHED_AT = struct.Struct("<d") # Epoch seconds, stamped by the publisher right before sending
+PRICE_RECORD = np.dtype([("station", "<u4"), ("fuel", "u1"), ("price", "<u4"), ("updated", "<u4")]) # price in tenths of a cent, updated as epoch seconds
+PRICE_STRUCT = struct.Struct("<IBII") # Same packed layout as PRICE_RECORD, for decoding without numpy overhead
+STATION_TEXT_FIELDS = ["ServiceStationName", "Address", "Suburb", "Postcode", "Brand"]
+MAX_RECORDS_PER_MESSAGE = 0xFFFF
+
+
+#   Encoding
+def is_binary(payload):
+    return len(payload) >= HEADER.size and payload[0] == MAGIC
+
+
+def encodable_mask(df):
+    # Rows that fit the binary format: numeric station code (without leading zeros, so it survives the round trip) and a known fuel code
+    codes = df["StationCode"].astype(str)
+    return (codes.str.fullmatch(r"[1-9]\d{0,8}|0") & df["FuelCode"].isin(FUEL_CODE_IDS)).to_numpy()
+
+
+def encode_station(station):
+    '''
+    Encodes the static attributes of one station (a mapping with StationCode, Latitude, Longitude and the STATION_TEXT_FIELDS). Sent once per station, on a retained topic.
+    '''
+    parts = [
+        HEADER.pack(MAGIC, VERSION, TYPE_STATION),
+        STATION_FIXED.pack(int(station["StationCode"]), float(station["Latitude"]), float(station["Longitude"]))
+    ]
+    for field in STATION_TEXT_FIELDS:
+        value = station.get(field)
+        text = b"" if value is None or (isinstance(value, float) and np.isnan(value)) else str(value).encode("utf-8")[:0xFFFF]
+        parts.append(struct.pack("<H", len(text)))
+        parts.append(text)
+    return b"".join(parts)
+
+
+def price_records(df):
+    # Packs the station id, fuel enum, price and timestamp columns into a structured array in one vectorized pass
+    records = np.empty(len(df), dtype=PRICE_RECORD)
+    records["station"] = df["StationCode"].astype(str).astype(np.int64).to_numpy()
+    records["fuel"] = df["FuelCode"].map(FUEL_CODE_IDS).to_numpy()
+
+    price = pd.to_numeric(df["Price"], errors="coerce").to_numpy(dtype=float)
+    records["price"] = np.where(np.isnan(price), NO_PRICE, np.round(price * 10)).astype(np.uint32)
+
+    updated = pd.to_datetime(df["PriceUpdatedDate"], format=PRICE_DATE_FORMAT, errors="coerce")
+    records["updated"] = np.where(updated.isna(), 0, updated.astype("int64", copy=False) // 10**9).astype(np.uint32)
+    return records
+
+
+def price_header(timed=False):
+    # Timed messages reserve a publish timestamp after the header; stamp_published() fills it in
+    if timed:
+        return HEADER.pack(MAGIC, VERSION, TYPE_PRICES_TIMED) + PUBLISHED_AT.pack(0.0)
+    return HEADER.pack(MAGIC, VERSION, TYPE_PRICES)
+
+
+def encode_prices(records, timed=False):
+    # One message carrying any number of packed price records
+    return price_header(timed) + PRICE_COUNT.pack(len(records)) + records.tobytes()
+
+
+def encode_price_messages(df, batch_size=1, timed=False):
+    '''
+    Encodes the rows of df as binary price messages of up to batch_size records each. Rows must satisfy encodable_mask. With timed=True the messages carry a publish timestamp slot for stamp_published().
+    '''
+    records = price_records(df)
+    batch_size = min(max(1, batch_size), MAX_RECORDS_PER_MESSAGE)
+    if batch_size == 1:
+        single = price_header(timed) + PRICE_COUNT.pack(1)
+        return [single + record.tobytes() for record in records]
+    return [encode_prices(records[i:i + batch_size], timed) for i in range(0, len(records), batch_size)]
+
+
+def stamp_published(payload, published_at=None):
+    # Writes the publish time into a timed price message; any other payload is returned unchanged
+    if not (is_binary(payload) and payload[2] == TYPE_PRICES_TIMED):
+        return payload
+    return payload[:HEADER.size] + PUBLISHED_AT.pack(time.time() if published_at is None else published_at) + payload[HEADER.size + PUBLISHED_AT.size:]
+
+
+#   Decoding
+@lru_cache(maxsize=65536)
+def format_timestamp(seconds):
+    if not seconds:
+        return None
+    return datetime.fromtimestamp(int(seconds), tz=timezone.utc).strftime(PRICE_DATE_FORMAT)
+
+
+class WireDecoder:
+    '''
+    Decodes binary and JSON fuel price messages into the record dicts the dashboard consumes (same keys as the JSON format). Station attributes from station messages are kept in a table and joined onto price records; prices that arrive before their station message are held back until it does. decode() only returns price records; a station message that changes a known station's attributes is collected separately, and take_station_changes() hands those corrections over so they reach stations whose prices don't change.
+    '''
+    def __init__(self):
+        self.stations = {} # station code -> dict of static attributes
+        self.pending = {} # station code -> {fuel code: latest price record waiting for the station message}
+        self.station_changes = {} # station code -> corrected attributes of a known station, not yet taken
+
+
+    def decode(self, payload):
+        if not is_binary(payload):
+            data = json.loads(payload.decode("utf-8"))
+            return data if isinstance(data, list) else [data]
+
+        magic, version, message_type = HEADER.unpack_from(payload)
+        if version > VERSION:
+            raise ValueError(f"Unsupported wire format version {version}")
+        if message_type == TYPE_STATION:
+            return self._decode_station(payload)
+        if message_type == TYPE_PRICES:
+            return self._decode_prices(payload, HEADER.size)
+        if message_type == TYPE_PRICES_TIMED:
+            (published_at,) = PUBLISHED_AT.unpack_from(payload, HEADER.size)
+            return self._decode_prices(payload, HEADER.size + PUBLISHED_AT.size, published_at or None)
+        raise ValueError(f"Unknown message type {message_type}")
+
+
+    def _decode_station(self, payload):
+        offset = HEADER.size
+        station_id, latitude, longitude = STATION_FIXED.unpack_from(payload, offset)
+        offset += STATION_FIXED.size
+
+        station = {"StationCode": str(station_id), "Latitude": latitude, "Longitude": longitude}
+        for field in STATION_TEXT_FIELDS:
+            (length,) = struct.unpack_from("<H", payload, offset)
+            offset += 2
+            station[field] = payload[offset:offset + length].decode("utf-8") or None
+            offset += length
+
+        previous = self.stations.get(station["StationCode"])
+        self.stations[station["StationCode"]] = station
+        if previous is not None and previous != station:
+            self.station_changes[station["StationCode"]] = dict(station)
+        return [dict(station, **price) for price in self.pending.pop(station["StationCode"], {}).values()]
+
+
+    def take_station_changes(self):
+        # Station-only records (attributes, no price) for the stations whose attributes changed since the last call
+        changes, self.station_changes = self.station_changes, {}
+        return list(changes.values())
+
+
+    def _decode_prices(self, payload, offset, published_at=None):
+        (count,) = PRICE_COUNT.unpack_from(payload, offset)
+        offset += PRICE_COUNT.size
+
+        decoded = []
+        for station_id, fuel, price, updated in PRICE_STRUCT.iter_unpack(payload[offset:offset + count * PRICE_STRUCT.size]):
+            code = str(station_id)
+            price_record = {
+                "StationCode": code,
+                "FuelCode": FUEL_CODES[fuel] if fuel < len(FUEL_CODES) else None,
+                "Price": None if price == NO_PRICE else price / 10,
+                "PriceUpdatedDate": format_timestamp(updated),
+            }
+            if published_at is not None:
+                price_record["PublishedAt"] = published_at
+            station = self.stations.get(code)
+            if station is None:
+                self.pending.setdefault(code, {})[price_record["FuelCode"]] = price_record
+            else:
+                decoded.append(dict(station, **price_record))
+        return decoded